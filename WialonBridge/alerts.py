@@ -0,0 +1,528 @@
+"""
+Rule-based alerts on stored points
+
+A rule is one condition on a point field or a sensor reading, optionally held
+for a time:
+
+    panic                               panic_button is set
+    SENSOR_GNSS_JAMMING                 any non-zero reading
+    engine_temperature > 110 for 60s    SENSOR_ENGINE_TEMPERATURE above 110 for a minute
+    speed >= 130 for 2m
+
+Fields are TrackingData columns (panic, ignition and fuel are short for
+panic_button, ignition_status and fuel_level) or sensor names from the Xirgo
+table, with or without the SENSOR_ prefix. Active rules are compiled into
+dispatch tables keyed by column and by sensor id, so a point only evaluates
+the rules on the columns it has and the sensors it carries.
+
+A rule fires once when its condition has held for its duration and fires again
+only after the condition was false in between. Per device, the rules
+currently true and since when are kept in AlertState together with the newest
+evaluated point; older points are late and are not evaluated. A point that
+doesn't carry a rule's field leaves that rule's state alone.
+
+Alerts are stored in the same transaction as the points and, once committed,
+handed to a notifier in batches of ALERT_NOTIFY_BATCH or every
+ALERT_NOTIFY_FLUSH_MS from a background thread. Alerts are POSTed as JSON to
+ALERT_WEBHOOK_URL when it is set and logged otherwise; init_alerts takes any
+other AlertNotifier.
+"""
+
+import atexit
+import json
+import logging
+import operator
+import re
+import threading
+import time
+from datetime import datetime
+
+import requests
+from sqlalchemy import select, func, insert
+
+from telemetry_mapping import XIRGO_SENSOR_MAP
+
+SEVERITIES = ('info', 'warning', 'critical')
+
+# TrackingData columns rules can refer to
+COLUMN_FIELDS = frozenset((
+    'speed', 'altitude', 'heading', 'odometer', 'fuel_level', 'engine_hours', 'battery_voltage',
+    'external_voltage', 'ignition_status', 'panic_button', 'gps_valid',
+))
+
+FIELD_ALIASES = {'panic': 'panic_button', 'ignition': 'ignition_status', 'fuel': 'fuel_level'}
+
+_SENSOR_IDS = {sensor['name']: sensor_id for sensor_id, sensor in XIRGO_SENSOR_MAP.items()}
+
+OPERATORS = {
+    '>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le,
+    '==': operator.eq, '=': operator.eq, '!=': operator.ne,
+}
+
+DURATION_UNITS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600}
+
+RULE_PATTERN = re.compile(
+    r'^\s*(?P<field>[A-Za-z_][A-Za-z0-9_]*)'
+    r'(?:\s*(?P<op>>=|<=|==|!=|>|<|=)\s*(?P<value>-?\d+(?:\.\d+)?|true|false|on|off))?'
+    r'(?:\s+for\s+(?P<duration>\d+(?:\.\d+)?)\s*(?P<unit>s|sec|min|m|h)?)?\s*$',
+    re.IGNORECASE,
+)
+
+# Alerts kept while the notifier fails before the oldest are dropped
+MAX_PENDING_FACTOR = 100
+
+class AlertRuleError(ValueError):
+    """Rule expression that can't be compiled"""
+
+class Rule:
+    """Compiled AlertRule"""
+
+    __slots__ = ('id', 'name', 'severity', 'expression', 'field', 'sensor_id', 'compare', 'threshold',
+                 'for_seconds')
+
+    def __init__(self, rule_id, name, expression, severity='warning'):
+        match = RULE_PATTERN.match(expression or '')
+        if match is None:
+            raise AlertRuleError("expression must look like 'field [op value] [for 60s]'")
+        if severity not in SEVERITIES:
+            raise AlertRuleError(f"severity must be one of {', '.join(SEVERITIES)}")
+        self.id = rule_id
+        self.name = name
+        self.severity = severity
+        self.expression = expression.strip()
+
+        field = match['field'].lower()
+        field = FIELD_ALIASES.get(field, field)
+        if field in COLUMN_FIELDS:
+            self.field = field
+            self.sensor_id = None
+        else:
+            sensor_name = match['field'].upper()
+            sensor_id = _SENSOR_IDS.get(sensor_name) or _SENSOR_IDS.get('SENSOR_' + sensor_name)
+            if sensor_id is None:
+                raise AlertRuleError(f"unknown field or sensor '{match['field']}'")
+            self.field = XIRGO_SENSOR_MAP[sensor_id]['name']
+            self.sensor_id = sensor_id
+
+        if match['op'] is None:
+            self.compare, self.threshold = operator.ne, 0.0
+        else:
+            value = match['value'].lower()
+            self.compare = OPERATORS[match['op']]
+            self.threshold = {'true': 1.0, 'on': 1.0, 'false': 0.0, 'off': 0.0}.get(value)
+            if self.threshold is None:
+                self.threshold = float(value)
+
+        self.for_seconds = 0.0
+        if match['duration'] is not None:
+            self.for_seconds = float(match['duration']) * DURATION_UNITS[(match['unit'] or 's').lower()]
+
+    def test(self, value):
+        return self.compare(value, self.threshold)
+
+def _reading_value(value, text_value):
+    """Numeric value of a sensor reading, booleans as 1/0, None when it has none"""
+    if value is not None:
+        return value
+    if text_value is None:
+        return None
+    text = text_value.strip().lower()
+    if text in ('true', 'on'):
+        return 1.0
+    if text in ('false', 'off'):
+        return 0.0
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+class AlertEngine:
+    """Active rules in per-column and per-sensor dispatch tables, reloaded when AlertRule rows change"""
+
+    def __init__(self, reload_seconds=30):
+        self.reload_seconds = reload_seconds
+        self.by_column = {}
+        self.by_sensor = {}
+        self.rule_ids = frozenset()
+        self._version = None
+        self._checked = None
+        self._lock = threading.Lock()
+        self.points = 0
+        self.evaluations = 0
+        self.alerts = 0
+        self.compile_errors = 0
+
+    def build(self, rules):
+        by_column = {}
+        by_sensor = {}
+        for rule in rules:
+            if rule.sensor_id is None:
+                by_column.setdefault(rule.field, []).append(rule)
+            else:
+                by_sensor.setdefault(rule.sensor_id, []).append(rule)
+        self.by_column = by_column
+        self.by_sensor = by_sensor
+        self.rule_ids = frozenset(rule.id for rule in rules)
+
+    def matches(self, row, readings):
+        """(rule, value) of every rule whose field the point carries"""
+        matched = []
+        for column, rules in self.by_column.items():
+            value = row.get(column)
+            if value is not None:
+                value = float(value)
+                matched.extend((rule, value) for rule in rules)
+        if self.by_sensor:
+            for sensor_id, value, text_value in readings:
+                rules = self.by_sensor.get(sensor_id)
+                if rules:
+                    value = _reading_value(value, text_value)
+                    if value is not None:
+                        matched.extend((rule, value) for rule in rules)
+        return matched
+
+    def invalidate(self):
+        self._checked = None
+
+    def ensure_loaded(self):
+        """Recompile the rules when AlertRule rows changed, checked every reload_seconds"""
+        from app import db
+        from models import AlertRule
+
+        if self._checked is not None and time.monotonic() - self._checked < self.reload_seconds:
+            return
+        with self._lock:
+            if self._checked is not None and time.monotonic() - self._checked < self.reload_seconds:
+                return
+            version = tuple(db.session.execute(
+                select(func.count(AlertRule.id), func.max(AlertRule.updated_at))
+            ).one())
+            self._checked = time.monotonic()
+            if version == self._version:
+                return
+            rules = []
+            for rule in AlertRule.query.filter(AlertRule.is_active.isnot(False)).all():
+                try:
+                    rules.append(Rule(rule.id, rule.name, rule.expression, rule.severity))
+                except AlertRuleError as e:
+                    self.compile_errors += 1
+                    logging.error(f"Skipping alert rule {rule.id} ({rule.name}): {e}")
+            self.build(rules)
+            self._version = version
+            logging.info(f"Compiled {len(rules)} alert rules")
+
+    def stats(self):
+        return {
+            'rules': len(self.rule_ids),
+            'columns': sorted(self.by_column),
+            'sensors': len(self.by_sensor),
+            'points': self.points,
+            'evaluations': self.evaluations,
+            'alerts': self.alerts,
+            'compile_errors': self.compile_errors,
+        }
+
+# Process-wide engine, built from the app config on first use
+_alert_engine = None
+
+def get_alert_engine():
+    """Return the process-wide alert engine"""
+    global _alert_engine
+    if _alert_engine is None:
+        from app import app
+        _alert_engine = AlertEngine(reload_seconds=app.config["ALERT_RELOAD_SECONDS"])
+    return _alert_engine
+
+class AlertNotifier:
+    """Receives committed alerts in batches; send raises to have the batch retried"""
+
+    def send(self, alerts):
+        raise NotImplementedError
+
+class LogNotifier(AlertNotifier):
+    def send(self, alerts):
+        for alert in alerts:
+            logging.warning(f"Alert [{alert['severity']}] {alert['unit_id']}: {alert['message']}")
+
+class WebhookNotifier(AlertNotifier):
+    """POSTs {"alerts": [...]} as JSON to a URL"""
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def send(self, alerts):
+        response = self._session.post(self.url, json={'alerts': alerts}, timeout=self.timeout)
+        response.raise_for_status()
+
+class AlertDispatcher:
+    """Hands alerts to a notifier in batches from a background thread"""
+
+    def __init__(self, notifier, batch_size=50, flush_ms=2000):
+        self.notifier = notifier
+        self.batch_size = batch_size
+        self.flush_seconds = flush_ms / 1000
+        self.max_pending = batch_size * MAX_PENDING_FACTOR
+        self._alerts = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='alert-notifier', daemon=True)
+        self.sent = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self.flush()
+
+    def add(self, alerts):
+        with self._lock:
+            self._alerts.extend(alerts)
+            overflow = len(self._alerts) - self.max_pending
+            if overflow > 0:
+                del self._alerts[:overflow]
+                self.dropped += overflow
+            full = len(self._alerts) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._alerts)
+
+    def flush(self):
+        """Send every pending alert in batches, returns the number sent"""
+        with self._flush_lock:
+            with self._lock:
+                alerts, self._alerts = self._alerts, []
+            sent = 0
+            while sent < len(alerts):
+                batch = alerts[sent:sent + self.batch_size]
+                try:
+                    self.notifier.send(batch)
+                except Exception as e:
+                    self.failures += 1
+                    logging.error(f"Failed to deliver {len(batch)} alerts: {e}")
+                    with self._lock:
+                        # Retried with the next flush, oldest alerts first
+                        self._alerts[:0] = alerts[sent:]
+                        overflow = len(self._alerts) - self.max_pending
+                        if overflow > 0:
+                            del self._alerts[:overflow]
+                            self.dropped += overflow
+                    break
+                sent += len(batch)
+                self.batches += 1
+            self.sent += sent
+            return sent
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def stats(self):
+        return {
+            'notifier': type(self.notifier).__name__,
+            'pending': self.pending(),
+            'sent': self.sent,
+            'batches': self.batches,
+            'failures': self.failures,
+            'dropped': self.dropped,
+        }
+
+# Process-wide dispatcher, set up by init_alerts
+_alert_dispatcher = None
+
+def get_alert_dispatcher():
+    """Return the running dispatcher, None before init_alerts (e.g. in CLI scripts)"""
+    return _alert_dispatcher
+
+def init_alerts(app, notifier=None):
+    """Start delivering alerts through notifier, by default the ALERT_WEBHOOK_URL one or the log"""
+    global _alert_dispatcher
+    if notifier is None:
+        if app.config["ALERT_WEBHOOK_URL"]:
+            notifier = WebhookNotifier(app.config["ALERT_WEBHOOK_URL"], timeout=app.config["ALERT_NOTIFY_TIMEOUT"])
+        else:
+            notifier = LogNotifier()
+    if _alert_dispatcher is not None:
+        _alert_dispatcher.stop()
+    _alert_dispatcher = AlertDispatcher(
+        notifier,
+        batch_size=app.config["ALERT_NOTIFY_BATCH"],
+        flush_ms=app.config["ALERT_NOTIFY_FLUSH_MS"],
+    )
+    _alert_dispatcher.start()
+    return _alert_dispatcher
+
+def _load_states(device_ids):
+    """{device_id: ({rule_id: [since, fired]}, timestamp)}"""
+    from app import db
+    from models import AlertState
+
+    states = {}
+    for device_id, state, timestamp in db.session.execute(
+        select(AlertState.device_id, AlertState.state, AlertState.timestamp)
+        .where(AlertState.device_id.in_(device_ids))
+    ):
+        active = {
+            int(rule_id): [datetime.fromisoformat(since), fired]
+            for rule_id, (since, fired) in json.loads(state).items()
+        }
+        states[device_id] = (active, timestamp)
+    return states
+
+def _dump_state(active):
+    return json.dumps({rule_id: [since.isoformat(), fired] for rule_id, (since, fired) in active.items()},
+                      separators=(',', ':'))
+
+def evaluate_alerts(rows, tracking_ids, readings):
+    """
+    Evaluate alert rules for a batch of inserted TrackingData rows and their readings (caller commits)
+    Returns the number of alerts
+    """
+    from app import db
+    from ingest import dialect_insert, on_commit
+    from models import Alert, AlertState, Device
+
+    engine = get_alert_engine()
+    engine.ensure_loaded()
+    if not engine.rule_ids:
+        return 0
+
+    points_by_device = {}
+    for row, tracking_id, point_readings in zip(rows, tracking_ids, readings):
+        matched = engine.matches(row, point_readings)
+        if matched:
+            points_by_device.setdefault(row['device_id'], []).append((row['timestamp'], tracking_id, matched))
+    if not points_by_device:
+        return 0
+
+    states = _load_states(list(points_by_device))
+    alerts = []
+    updates = []
+    evaluated = 0
+    evaluations = 0
+    for device_id, points in points_by_device.items():
+        active, last_timestamp = states.get(device_id, ({}, None))
+        changed = False
+        for timestamp, tracking_id, matched in sorted(points, key=lambda point: point[:2]):
+            if last_timestamp is not None and timestamp <= last_timestamp:
+                continue
+            evaluated += 1
+            evaluations += len(matched)
+            for rule, value in matched:
+                if not rule.test(value):
+                    active.pop(rule.id, None)
+                    continue
+                entry = active.get(rule.id)
+                if entry is None:
+                    entry = active[rule.id] = [timestamp, False]
+                if not entry[1] and (timestamp - entry[0]).total_seconds() >= rule.for_seconds:
+                    entry[1] = True
+                    alerts.append({
+                        'device_id': device_id, 'rule_id': rule.id, 'tracking_id': tracking_id,
+                        'timestamp': timestamp, 'since': entry[0], 'value': value, 'severity': rule.severity,
+                        'message': f"{rule.name}: {rule.field} = {value:g} ({rule.expression})"[:255],
+                    })
+            last_timestamp, changed = timestamp, True
+        if changed:
+            # Rules deactivated since are forgotten
+            active = {rule_id: entry for rule_id, entry in active.items() if rule_id in engine.rule_ids}
+            updates.append({'device_id': device_id, 'state': _dump_state(active), 'timestamp': last_timestamp,
+                            'updated_at': datetime.utcnow()})
+
+    if alerts:
+        db.session.execute(insert(Alert.__table__), alerts)
+    if updates:
+        stmt = dialect_insert(AlertState.__table__)
+        if hasattr(stmt, 'on_conflict_do_update'):
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['device_id'],
+                set_={
+                    'state': stmt.excluded.state,
+                    'timestamp': stmt.excluded.timestamp,
+                    'updated_at': stmt.excluded.updated_at,
+                },
+                where=stmt.excluded.timestamp > AlertState.__table__.c.timestamp,
+            ), updates)
+        else:
+            for values in updates:
+                state = db.session.get(AlertState, values['device_id'])
+                if state is None:
+                    db.session.add(AlertState(**values))
+                elif values['timestamp'] > state.timestamp:
+                    state.state = values['state']
+                    state.timestamp = values['timestamp']
+                    state.updated_at = values['updated_at']
+
+    notifications = []
+    dispatcher = get_alert_dispatcher()
+    if alerts and dispatcher is not None:
+        unit_ids = dict(db.session.execute(
+            select(Device.id, Device.unit_id).where(Device.id.in_({alert['device_id'] for alert in alerts}))
+        ).all())
+        notifications = [
+            dict(alert, unit_id=unit_ids.get(alert['device_id']), timestamp=alert['timestamp'].isoformat(),
+                 since=alert['since'].isoformat())
+            for alert in alerts
+        ]
+
+    alert_count = len(alerts)
+
+    def count():
+        engine.points += evaluated
+        engine.evaluations += evaluations
+        engine.alerts += alert_count
+        if notifications:
+            dispatcher.add(notifications)
+    on_commit(count)
+    return alert_count
+
+def rule_from_request(data):
+    """(name, expression, severity) of a rule posted to the API, raises AlertRuleError"""
+    name = (data.get('name') or '').strip()
+    if not name:
+        raise AlertRuleError("name is required")
+    expression = (data.get('expression') or '').strip()
+    severity = data.get('severity') or 'warning'
+    Rule(None, name, expression, severity)
+    return name, expression, severity
+
+def rule_dict(rule):
+    return {
+        'id': rule.id,
+        'name': rule.name,
+        'expression': rule.expression,
+        'severity': rule.severity,
+        'is_active': rule.is_active is not False,
+        'created_at': rule.created_at.isoformat() if rule.created_at else None,
+    }
+
+def alert_dict(alert, rule_name=None, unit_id=None):
+    return {
+        'id': alert.id,
+        'device_id': alert.device_id,
+        'unit_id': unit_id,
+        'rule_id': alert.rule_id,
+        'rule_name': rule_name,
+        'severity': alert.severity,
+        'timestamp': alert.timestamp.isoformat(),
+        'since': alert.since.isoformat(),
+        'value': alert.value,
+        'message': alert.message,
+        'tracking_id': alert.tracking_id,
+    }
@@ -34,8 +34,95 @@ app.config["RATE_LIMIT_PER_MINUTE"] = int(os.environ.get("RATE_LIMIT_PER_MINUTE"
 # Webhook configuration
 app.config["WEBHOOK_AUTH_TOKEN"] = os.environ.get("WEBHOOK_AUTH_TOKEN", "default_webhook_token")
 app.config["RATE_LIMIT_PER_MINUTE"] = int(os.environ.get("RATE_LIMIT_PER_MINUTE", "100"))
+app.config["RATE_LIMITS"] = os.environ.get("RATE_LIMITS", "")
+app.config["RATE_LIMIT_BACKEND"] = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+app.config["RATE_LIMIT_SQLITE_PATH"] = os.environ.get("RATE_LIMIT_SQLITE_PATH", "rate_limit.db")
+app.config["RATE_LIMIT_REDIS_URL"] = os.environ.get("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB max request size
 
+# Ingest configuration ("sync" writes to the database in the request, "queued" uses the durable ingest queue)
+app.config["INGEST_MODE"] = os.environ.get("INGEST_MODE", "sync")
+app.config["INGEST_QUEUE_PATH"] = os.environ.get("INGEST_QUEUE_PATH", "ingest_queue.db")
+app.config["INGEST_QUEUE_MAX_DEPTH"] = int(os.environ.get("INGEST_QUEUE_MAX_DEPTH", "100000"))
+app.config["INGEST_WORKERS"] = int(os.environ.get("INGEST_WORKERS", "2"))
+app.config["INGEST_BATCH_SIZE"] = int(os.environ.get("INGEST_BATCH_SIZE", "50"))
+app.config["INGEST_LEASE_SECONDS"] = int(os.environ.get("INGEST_LEASE_SECONDS", "60"))
+app.config["INGEST_MAX_ATTEMPTS"] = int(os.environ.get("INGEST_MAX_ATTEMPTS", "5"))
+# Idempotent ingest (see dedup.py); off by default because it adds a unique index at startup
+app.config["INGEST_DEDUP"] = os.environ.get("INGEST_DEDUP", "false").lower() == "true"
+app.config["DEDUP_WINDOW"] = int(os.environ.get("DEDUP_WINDOW", "256"))
+app.config["DEDUP_FALSE_POSITIVE_RATE"] = float(os.environ.get("DEDUP_FALSE_POSITIVE_RATE", "1e-6"))
+
+# Extra vendor field aliases (JSON file mapping tracking fields to additional source keys)
+app.config["FIELD_ALIASES_FILE"] = os.environ.get("FIELD_ALIASES_FILE")
+
+# Typed msgspec decoding for JSON payloads (used only when msgspec is installed)
+app.config["JSON_FAST_PATH"] = os.environ.get("JSON_FAST_PATH", "true").lower() == "true"
+
+# Telemetry value count per request from which calibration runs as one NumPy batch (0 disables)
+app.config["TELEMETRY_BATCH_THRESHOLD"] = int(os.environ.get("TELEMETRY_BATCH_THRESHOLD", "2000"))
+
+# Live feed (Server-Sent Events). Each open stream holds a worker for up to LIVE_FEED_STREAM_SECONDS,
+# so it is off unless the server runs threaded or async workers; pages poll instead
+app.config["LIVE_FEED_ENABLED"] = os.environ.get("LIVE_FEED_ENABLED", "false").lower() == "true"
+app.config["LIVE_FEED_MAX_CLIENTS"] = int(os.environ.get("LIVE_FEED_MAX_CLIENTS", "50"))
+app.config["LIVE_FEED_QUEUE_SIZE"] = int(os.environ.get("LIVE_FEED_QUEUE_SIZE", "100"))
+app.config["LIVE_FEED_HEARTBEAT_SECONDS"] = int(os.environ.get("LIVE_FEED_HEARTBEAT_SECONDS", "15"))
+app.config["LIVE_FEED_STREAM_SECONDS"] = int(os.environ.get("LIVE_FEED_STREAM_SECONDS", "300"))
+
+# How often the rolling dashboard counters are saved to the database
+app.config["METRICS_PERSIST_SECONDS"] = int(os.environ.get("METRICS_PERSIST_SECONDS", "60"))
+app.config["ROLLUP_INTERVAL_SECONDS"] = int(os.environ.get("ROLLUP_INTERVAL_SECONDS", "60"))
+app.config["ROLLUP_BATCH_SIZE"] = int(os.environ.get("ROLLUP_BATCH_SIZE", "5000"))
+app.config["ROLLUP_MAX_GAP_SECONDS"] = int(os.environ.get("ROLLUP_MAX_GAP_SECONDS", "600"))
+app.config["ROLLUP_SETTLE_SECONDS"] = int(os.environ.get("ROLLUP_SETTLE_SECONDS", "30"))
+# Lock file electing the one worker that runs the rollup job (PostgreSQL uses an advisory lock)
+app.config["ROLLUP_LOCK_PATH"] = os.environ.get("ROLLUP_LOCK_PATH", "rollup.lock")
+app.config["TRACKING_RETENTION_DAYS"] = int(os.environ.get("TRACKING_RETENTION_DAYS", "0"))
+app.config["ARCHIVE_DIR"] = os.environ.get("ARCHIVE_DIR", "archive")
+app.config["ARCHIVE_FORMAT"] = os.environ.get("ARCHIVE_FORMAT", "csv")
+app.config["RETENTION_BATCH_SIZE"] = int(os.environ.get("RETENTION_BATCH_SIZE", "5000"))
+app.config["RETENTION_CHECK_HOURS"] = int(os.environ.get("RETENTION_CHECK_HOURS", "6"))
+# Lock file electing the one worker that runs the retention job (PostgreSQL uses an advisory lock)
+app.config["RETENTION_LOCK_PATH"] = os.environ.get("RETENTION_LOCK_PATH", "retention.lock")
+app.config["WEBHOOK_LOG_BUFFER"] = os.environ.get("WEBHOOK_LOG_BUFFER", "true").lower() == "true"
+app.config["WEBHOOK_LOG_FLUSH_ROWS"] = int(os.environ.get("WEBHOOK_LOG_FLUSH_ROWS", "200"))
+app.config["WEBHOOK_LOG_FLUSH_MS"] = int(os.environ.get("WEBHOOK_LOG_FLUSH_MS", "1000"))
+app.config["WEBHOOK_LOG_SAMPLE_RATE"] = int(os.environ.get("WEBHOOK_LOG_SAMPLE_RATE", "100"))
+app.config["WEBHOOK_LOG_SAMPLE_CHARS"] = int(os.environ.get("WEBHOOK_LOG_SAMPLE_CHARS", "2000"))
+app.config["WEBHOOK_LOG_RETENTION_DAYS"] = int(os.environ.get("WEBHOOK_LOG_RETENTION_DAYS", "30"))
+
+# Track history API: raw points read per response and simplification tolerance in screen pixels
+app.config["TRACK_MAX_POINTS"] = int(os.environ.get("TRACK_MAX_POINTS", "100000"))
+app.config["TRACK_PIXEL_TOLERANCE"] = float(os.environ.get("TRACK_PIXEL_TOLERANCE", "1.5"))
+
+# Map viewport: devices shown before switching to clusters, and how often other processes' positions are read
+app.config["MAP_MAX_MARKERS"] = int(os.environ.get("MAP_MAX_MARKERS", "500"))
+app.config["SPATIAL_INDEX_SYNC_SECONDS"] = int(os.environ.get("SPATIAL_INDEX_SYNC_SECONDS", "10"))
+
+# How often each process checks the geofence table for changed zones
+app.config["GEOFENCE_RELOAD_SECONDS"] = int(os.environ.get("GEOFENCE_RELOAD_SECONDS", "30"))
+
+# Trip/stop segmentation on ingest: reorder window, idle time ending a trip, moving speed (km/h), shortest trip
+app.config["TRIP_SEGMENTATION"] = os.environ.get("TRIP_SEGMENTATION", "true").lower() == "true"
+app.config["TRIP_REORDER_SECONDS"] = int(os.environ.get("TRIP_REORDER_SECONDS", "60"))
+app.config["TRIP_STOP_SECONDS"] = int(os.environ.get("TRIP_STOP_SECONDS", "180"))
+app.config["TRIP_MOVING_SPEED"] = float(os.environ.get("TRIP_MOVING_SPEED", "5"))
+app.config["TRIP_MIN_DISTANCE_M"] = float(os.environ.get("TRIP_MIN_DISTANCE_M", "200"))
+
+# Alert rules: how often rule changes are picked up, and batched delivery (logged when no URL is set)
+app.config["ALERT_RELOAD_SECONDS"] = int(os.environ.get("ALERT_RELOAD_SECONDS", "30"))
+app.config["ALERT_WEBHOOK_URL"] = os.environ.get("ALERT_WEBHOOK_URL", "")
+app.config["ALERT_NOTIFY_BATCH"] = int(os.environ.get("ALERT_NOTIFY_BATCH", "50"))
+app.config["ALERT_NOTIFY_FLUSH_MS"] = int(os.environ.get("ALERT_NOTIFY_FLUSH_MS", "2000"))
+app.config["ALERT_NOTIFY_TIMEOUT"] = float(os.environ.get("ALERT_NOTIFY_TIMEOUT", "5"))
+
+# unit_id -> device cache used by the ingest path
+app.config["DEVICE_CACHE_SIZE"] = int(os.environ.get("DEVICE_CACHE_SIZE", "10000"))
+app.config["DEVICE_CACHE_TTL"] = int(os.environ.get("DEVICE_CACHE_TTL", "3600"))
+# How often each process checks the device table for devices created or edited elsewhere
+app.config["DEVICE_CACHE_RELOAD_SECONDS"] = int(os.environ.get("DEVICE_CACHE_RELOAD_SECONDS", "30"))
+
 # initialize extensions
 db.init_app(app)
 login_manager.init_app(app)
@@ -53,12 +140,36 @@ with app.app_context():
     import routes
     import auth
     
+    # Parser configuration
+    import json_fastpath
+    json_fastpath.configure(app.config["JSON_FAST_PATH"])
+    
+    import telemetry_mapping
+    telemetry_mapping.configure_batch_calibration(app.config["TELEMETRY_BATCH_THRESHOLD"])
+    
+    if app.config["FIELD_ALIASES_FILE"]:
+        from field_aliases import configure_aliases, load_alias_file
+        configure_aliases(load_alias_file(app.config["FIELD_ALIASES_FILE"]))
+    
     # Register blueprints
     app.register_blueprint(auth.auth_bp)
     
     # Create tables
     db.create_all()
     
+    # Add columns introduced after the tables were created
+    from schema_upgrade import upgrade_schema
+    upgrade_schema()
+    
+    # Unique (device_id, timestamp) index for idempotent ingest
+    if app.config["INGEST_DEDUP"]:
+        from dedup import ensure_unique_index
+        ensure_unique_index()
+    
+    # Map positions for databases created before DeviceLatestState
+    from latest_state import ensure_latest_state
+    ensure_latest_state()
+    
     # Create default admin user if none exists
     from models import User
     from werkzeug.security import generate_password_hash
@@ -73,3 +184,28 @@ with app.app_context():
         db.session.add(admin_user)
         db.session.commit()
         logging.info("Created default admin user: admin/admin123")
+    
+    # Rolling dashboard counters, restored from the last snapshot
+    from metrics import init_metrics
+    init_metrics(app)
+    
+    # Buffered writer and sweeper for webhook logs not linked to points
+    from webhook_log_buffer import init_webhook_log_buffer
+    init_webhook_log_buffer(app)
+    
+    # Hourly/daily rollups for the dashboard charts
+    from rollups import init_rollups
+    init_rollups(app)
+    
+    # Batched delivery of alerts raised by the alert rules
+    from alerts import init_alerts
+    init_alerts(app)
+    
+    # Archive and delete points past TRACKING_RETENTION_DAYS
+    from retention import init_retention
+    init_retention(app)
+    
+    # Start background writers for queued ingest
+    if app.config["INGEST_MODE"] == "queued":
+        from ingest_queue import init_ingest_queue
+        init_ingest_queue(app)
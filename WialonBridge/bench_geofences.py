@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: geofence point tests through the STR R-tree vs testing every zone
+Reports build time and microseconds per point for growing numbers of zones
+
+Usage: python bench_geofences.py [--points 20000] [--seed 1]
+"""
+
+import argparse
+import math
+import random
+import time
+
+from geofences import GeofenceEngine, PreparedPolygon, Circle
+
+# Zones and points are spread over a metropolitan area of about 200 x 140 km
+REGION = (29.5, 49.8, 32.5, 51.1)
+
+ZONE_COUNTS = (100, 1000, 5000, 10000)
+
+# Brute force is only run up to this many zones
+BRUTE_FORCE_LIMIT = 1000
+
+def random_zone(rng):
+    """(shape, ring): a star-shaped polygon of 8-64 vertices with its ring, or a circle, 100 m to 3 km across"""
+    longitude = rng.uniform(REGION[0], REGION[2])
+    latitude = rng.uniform(REGION[1], REGION[3])
+    radius = rng.uniform(50, 1500)
+    if rng.random() < 0.3:
+        return Circle(latitude, longitude, radius), None
+    vertices = rng.randint(8, 64)
+    ring = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        r = radius * rng.uniform(0.5, 1.0) / 111320.0
+        ring.append((longitude + r * math.cos(angle) / math.cos(math.radians(latitude)), latitude + r * math.sin(angle)))
+    return PreparedPolygon([ring]), ring
+
+def ring_contains(ring, x, y):
+    """Plain even-odd ray casting over a whole ring"""
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 <= y < y2 or y2 <= y < y1) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+def brute_force(zones, rings, latitude, longitude):
+    """Zones containing a point, testing every zone without an index"""
+    found = set()
+    for zone_id, shape in zones.items():
+        ring = rings.get(zone_id)
+        if ring is None:
+            if shape.contains(longitude, latitude):
+                found.add(zone_id)
+        elif ring_contains(ring, longitude, latitude):
+            found.add(zone_id)
+    return frozenset(found)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--points', type=int, default=20000, help="points tested per zone count")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    points = [(rng.uniform(REGION[1], REGION[3]), rng.uniform(REGION[0], REGION[2])) for _ in range(args.points)]
+
+    print(f"{'zones':>7} {'build ms':>9} {'us/point':>9} {'hits/point':>11} {'brute us/point':>15} {'speedup':>8}")
+    for count in ZONE_COUNTS:
+        zone_rng = random.Random(args.seed + count)
+        zones = {}
+        rings = {}
+        for zone_id in range(count):
+            zones[zone_id], ring = random_zone(zone_rng)
+            if ring is not None:
+                rings[zone_id] = ring
+
+        engine = GeofenceEngine()
+        start = time.perf_counter()
+        engine.build(zones)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        hits = 0
+        start = time.perf_counter()
+        for latitude, longitude in points:
+            hits += len(engine.zones_at(latitude, longitude))
+        per_point = (time.perf_counter() - start) / len(points) * 1e6
+
+        brute = '-'
+        speedup = '-'
+        if count <= BRUTE_FORCE_LIMIT:
+            sample = points[:max(1, len(points) // 10)]
+            start = time.perf_counter()
+            expected = [brute_force(zones, rings, latitude, longitude) for latitude, longitude in sample]
+            brute_per_point = (time.perf_counter() - start) / len(sample) * 1e6
+            actual = [engine.zones_at(latitude, longitude) for latitude, longitude in sample]
+            if actual != expected:
+                raise SystemExit(f"R-tree and brute force disagree with {count} zones")
+            brute = f"{brute_per_point:,.1f}"
+            speedup = f"{brute_per_point / per_point:.0f}x"
+
+        print(f"{count:>7} {build_ms:>9,.1f} {per_point:>9.2f} {hits / len(points):>11.3f} {brute:>15} {speedup:>8}")
+
+if __name__ == "__main__":
+    main()
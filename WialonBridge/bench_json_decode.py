@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: typed msgspec JSON fast path vs the generic extract_tracking_data path
+Reports records/second for 1, 100 and 10,000-entry arrays
+"""
+
+import json
+import time
+import random
+
+import json_fastpath
+from webhook_parser import WebhookPayload, parse_json_data, extract_tracking_data
+
+def make_payload(count):
+    """Build a JSON array shaped like Wialon retranslator output"""
+    entries = []
+    for i in range(count):
+        entries.append({
+            'unitId': f'XG3780_{i % 500:04d}',
+            'lat': round(40.0 + random.random(), 6),
+            'lon': round(-73.0 - random.random(), 6),
+            'alt': 15.2,
+            'speed': round(random.random() * 120, 1),
+            'course': random.randint(0, 359),
+            'time': 1754390880 + i,
+            'fuel': 54.5,
+            'ignition': 1,
+            'telemetryDetails': [
+                {'sensorCode': 'sensor8192', 'value': '45.6'},
+                {'sensorCode': 'sensor8200', 'value': '125'},
+                {'sensorCode': 'sensor109', 'value': '1'},
+            ],
+        })
+    return json.dumps(entries).encode('utf-8')
+
+def run_legacy(body):
+    """Previous behaviour: dict decode, alias probing and json.dumps per entry"""
+    return [extract_tracking_data(entry, 'json', json.dumps(entry)) for entry in json.loads(body)]
+
+def run_generic(body):
+    json_fastpath.configure(False)
+    return parse_json_data(WebhookPayload(body, 'application/json'))
+
+def run_fast(body):
+    json_fastpath.configure(True)
+    return parse_json_data(WebhookPayload(body, 'application/json'))
+
+def measure(func, body, count, min_seconds=1.0):
+    """Return records/second for func over body"""
+    func(body)  # warm up (schema compilation, caches)
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        result = func(body)
+        iterations += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+    assert len(result) == count
+    return iterations * count / elapsed
+
+def main():
+    random.seed(42)
+    paths = [('legacy', run_legacy), ('generic', run_generic)]
+    if json_fastpath.msgspec is not None:
+        paths.append(('msgspec', run_fast))
+    else:
+        print("msgspec is not installed, only the generic paths are measured")
+
+    print(f"{'entries':>8} " + " ".join(f"{name + ' rec/s':>16}" for name, _ in paths) + f" {'speedup':>8}")
+    for count in (1, 100, 10000):
+        body = make_payload(count)
+        rates = [measure(func, body, count) for _, func in paths]
+        speedup = rates[-1] / rates[0]
+        print(f"{count:>8} " + " ".join(f"{rate:>16,.0f}" for rate in rates) + f" {speedup:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
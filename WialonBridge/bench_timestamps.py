@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: TimestampDecoder vs dateutil.parser.parse
+Reports parses/second per timestamp shape seen from Wialon retranslators
+"""
+
+import time
+from datetime import datetime
+
+from dateutil import parser as date_parser
+
+from timestamps import TimestampDecoder
+
+CORPUS = [
+    ('iso utc', '2025-08-05T10:48:00Z'),
+    ('iso offset', '2025-08-05T10:48:00.123+03:00'),
+    ('epoch string', '1754390880'),
+    ('epoch millis', '1754390880123'),
+    ('epoch int', 1754390880),
+    ('dotted', '05.08.2025 10:48:00'),
+    ('space separated', '2025-08-05 10:48:00'),
+    ('compact', '20250805104800'),
+    ('rfc 1123', 'Tue, 05 Aug 2025 10:48:00 GMT'),
+]
+
+def legacy_parse(value):
+    """Previous behaviour: fromtimestamp for numbers, dateutil for strings (failures fell back to now)"""
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    try:
+        return date_parser.parse(value)
+    except (ValueError, OverflowError):
+        return datetime.utcnow()
+
+def measure(func, value, min_seconds=0.5):
+    """Return calls/second of func(value)"""
+    func(value)  # warm up (remembered decoder)
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(100):
+            func(value)
+        iterations += 100
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+    return iterations / elapsed
+
+def main():
+    print(f"{'shape':>16} {'dateutil/s':>14} {'decoder/s':>14} {'speedup':>8}")
+    for name, value in CORPUS:
+        decoder = TimestampDecoder()
+        legacy_rate = measure(legacy_parse, value)
+        fast_rate = measure(lambda v: decoder.decode(v, 'unit'), value)
+        print(f"{name:>16} {legacy_rate:>14,.0f} {fast_rate:>14,.0f} {fast_rate / legacy_rate:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
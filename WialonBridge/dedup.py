@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Idempotent ingest of retranslator retries
+
+Wialon's retranslator resends buffered messages after a connection loss. With
+INGEST_DEDUP on, tracking_data carries a unique (device_id, timestamp) index
+and points are inserted with ON CONFLICT DO NOTHING, so a resent point is
+stored once.
+
+Before the database, each device's newest committed timestamp (high-water
+mark) and a small rotating bloom filter of its recent timestamps skip points
+that were obviously stored already: a point newer than the high-water mark is
+always inserted, an older one is skipped when the filter has seen it. The
+filter errs only towards "seen" (DEDUP_FALSE_POSITIVE_RATE), so a late point
+never seen before is lost with at most that probability.
+
+INGEST_DEDUP is off by default. Databases holding duplicates from before
+can't get the unique index, so run `python dedup.py --remove-existing` before
+enabling it: it deletes the later copies and creates the index. Without the
+index the pre-filter still applies.
+"""
+
+import argparse
+import calendar
+import hashlib
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import inspect, select, func, text
+
+UNIQUE_INDEX = 'uq_tracking_data_device_timestamp'
+
+# Non-unique index made redundant by the unique one
+REPLACED_INDEX = 'ix_tracking_data_device_timestamp'
+
+# Whether the unique index exists, set by ensure_unique_index
+unique_index = False
+
+def timestamp_key(timestamp):
+    """Microseconds since the epoch of a naive UTC datetime"""
+    return calendar.timegm(timestamp.utctimetuple()) * 1000000 + timestamp.microsecond
+
+class BloomFilter:
+    """Fixed-size bloom filter over integers"""
+
+    def __init__(self, capacity, false_positive_rate):
+        self.size = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.to_bytes(8, 'little', signed=True), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+class DeviceHistory:
+    """High-water mark and two generations of recent timestamps of one device"""
+
+    __slots__ = ('high_water_mark', 'current', 'previous')
+
+    def __init__(self, capacity, false_positive_rate):
+        self.high_water_mark = None
+        self.current = BloomFilter(capacity, false_positive_rate)
+        self.previous = None
+
+class DedupFilter:
+    """Per-device pre-filter for points already stored by this process"""
+
+    def __init__(self, max_devices=10000, window=256, false_positive_rate=1e-6):
+        self.max_devices = max_devices
+        self.window = window
+        # Two generations are checked, so each gets half the rate
+        self.false_positive_rate = false_positive_rate / 2
+        self._devices = OrderedDict()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.skipped = 0
+        self.conflicts = 0
+        self.inserted = 0
+
+    def seen(self, device_id, timestamp):
+        """True when the point is older than the device's newest one and was stored before"""
+        with self._lock:
+            self.checked += 1
+            history = self._devices.get(device_id)
+            if history is None or history.high_water_mark is None or timestamp > history.high_water_mark:
+                return False
+            key = timestamp_key(timestamp)
+            if key in history.current or (history.previous is not None and key in history.previous):
+                self.skipped += 1
+                return True
+            return False
+
+    def remember(self, points):
+        """Record committed (device_id, timestamp) points"""
+        with self._lock:
+            for device_id, timestamp in points:
+                history = self._devices.get(device_id)
+                if history is None:
+                    history = self._devices[device_id] = DeviceHistory(self.window, self.false_positive_rate)
+                    if len(self._devices) > self.max_devices:
+                        self._devices.popitem(last=False)
+                else:
+                    self._devices.move_to_end(device_id)
+
+                if history.current.count >= self.window:
+                    history.previous = history.current
+                    history.current = BloomFilter(self.window, self.false_positive_rate)
+                history.current.add(timestamp_key(timestamp))
+                if history.high_water_mark is None or timestamp > history.high_water_mark:
+                    history.high_water_mark = timestamp
+
+    def count(self, inserted, conflicts, skipped=0):
+        """Record a committed batch; skipped counts repeats within the batch"""
+        with self._lock:
+            self.inserted += inserted
+            self.conflicts += conflicts
+            self.skipped += skipped
+
+    def stats(self):
+        with self._lock:
+            duplicates = self.skipped + self.conflicts
+            return {
+                'unique_index': unique_index,
+                'devices': len(self._devices),
+                'checked': self.checked,
+                'inserted': self.inserted,
+                'skipped_before_db': self.skipped,
+                'db_conflicts': self.conflicts,
+                'duplicate_rate': round(duplicates / (duplicates + self.inserted), 4) if duplicates else 0.0,
+                'prefilter_hit_rate': round(self.skipped / duplicates, 4) if duplicates else 0.0,
+            }
+
+# Process-wide filter, sized from the app config on first use
+_dedup_filter = None
+
+def get_dedup_filter():
+    """Return the process-wide dedup filter, or None when INGEST_DEDUP is off"""
+    global _dedup_filter
+    from app import app
+    if not app.config["INGEST_DEDUP"]:
+        return None
+    if _dedup_filter is None:
+        _dedup_filter = DedupFilter(
+            max_devices=app.config["DEVICE_CACHE_SIZE"],
+            window=app.config["DEDUP_WINDOW"],
+            false_positive_rate=app.config["DEDUP_FALSE_POSITIVE_RATE"],
+        )
+    return _dedup_filter
+
+def insert_new_tracking_rows(rows):
+    """
+    Insert TrackingData rows skipping (device_id, timestamp) pairs already stored
+    Returns ids in row order, None for rows that were duplicates
+    """
+    from app import db
+    from ingest import dialect_insert
+    from models import TrackingData
+
+    table = TrackingData.__table__
+    stmt = dialect_insert(table)
+    if not hasattr(stmt, 'on_conflict_do_nothing'):
+        from ingest import insert_tracking_rows
+        return insert_tracking_rows(rows)
+
+    if unique_index:
+        stmt = stmt.on_conflict_do_nothing(index_elements=['device_id', 'timestamp'])
+    else:
+        stmt = stmt.on_conflict_do_nothing()
+
+    # Skipped rows return nothing, so inserted ones are matched back by their key
+    stmt = stmt.returning(table.c.id, table.c.device_id, table.c.timestamp)
+    if db.engine.dialect.insert_executemany_returning:
+        returned = db.session.execute(stmt, rows).all()
+    else:
+        returned = [row for values in rows for row in db.session.execute(stmt, values)]
+    inserted = {(device_id, timestamp): tracking_id for tracking_id, device_id, timestamp in returned}
+    return [inserted.pop((row['device_id'], row['timestamp']), None) for row in rows]
+
+def ensure_unique_index():
+    """Create the unique (device_id, timestamp) index, replacing the plain one"""
+    global unique_index
+    from app import db
+
+    inspector = inspect(db.engine)
+    indexes = {index['name']: index for index in inspector.get_indexes('tracking_data')}
+    if UNIQUE_INDEX not in indexes:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(text(f'CREATE UNIQUE INDEX {UNIQUE_INDEX} ON tracking_data (device_id, timestamp)'))
+        except Exception as e:
+            logging.error(f"Could not create {UNIQUE_INDEX}, duplicates are only filtered in memory; "
+                          f"run `python dedup.py --remove-existing` to remove existing duplicates ({e})")
+            unique_index = False
+            return False
+        logging.info(f"Created unique index {UNIQUE_INDEX}")
+
+    if REPLACED_INDEX in indexes:
+        with db.engine.begin() as conn:
+            conn.execute(text(f'DROP INDEX {REPLACED_INDEX}'))
+    unique_index = True
+    return True
+
+def _repoint_points(value, ids, keep_id):
+    """Replace the ids of removed copies in segmenter points (dicts with 'id' and 't'), returns whether any changed"""
+    changed = False
+    if isinstance(value, dict):
+        if 't' in value and value.get('id') in ids:
+            value['id'] = keep_id
+            changed = True
+        for item in value.values():
+            changed = _repoint_points(item, ids, keep_id) or changed
+    elif isinstance(value, list):
+        for item in value:
+            changed = _repoint_points(item, ids, keep_id) or changed
+    return changed
+
+def repoint_tracking_references(device_id, ids, keep_id):
+    """Point every row that references one of the ids (copies about to be deleted) at keep_id"""
+    from app import db
+    from models import DeviceLatestState, GeofenceEvent, Alert, Trip, TripSegmenterState
+    from trips import load_state, dump_state
+
+    for column in (DeviceLatestState.tracking_id, GeofenceEvent.tracking_id, Alert.tracking_id,
+                   Trip.start_tracking_id, Trip.end_tracking_id):
+        db.session.execute(
+            column.table.update().where(column.in_(ids)).values({column.name: keep_id})
+        )
+
+    segmenter = db.session.get(TripSegmenterState, device_id)
+    if segmenter is not None:
+        state = load_state(segmenter.state)
+        if _repoint_points(state, set(ids), keep_id):
+            segmenter.state = dump_state(state)
+
+def remove_existing_duplicates(batch_size=1000):
+    """
+    Delete all but the first stored copy of every (device_id, timestamp), returns rows deleted
+    Rows referencing a deleted copy are repointed to the kept one first
+    """
+    from app import db
+    from models import TrackingData, TelemetryValue
+
+    deleted = 0
+    while True:
+        groups = db.session.execute(
+            select(TrackingData.device_id, TrackingData.timestamp, func.min(TrackingData.id))
+            .group_by(TrackingData.device_id, TrackingData.timestamp)
+            .having(func.count() > 1)
+            .limit(batch_size)
+        ).all()
+        if not groups:
+            return deleted
+
+        for device_id, timestamp, keep_id in groups:
+            ids = db.session.execute(
+                select(TrackingData.id).where(TrackingData.device_id == device_id,
+                                              TrackingData.timestamp == timestamp,
+                                              TrackingData.id != keep_id)
+            ).scalars().all()
+            repoint_tracking_references(device_id, ids, keep_id)
+            db.session.execute(TelemetryValue.__table__.delete().where(TelemetryValue.tracking_id.in_(ids)))
+            db.session.execute(TrackingData.__table__.delete().where(TrackingData.id.in_(ids)))
+            deleted += len(ids)
+        db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--remove-existing', action='store_true',
+                        help="delete all but the first copy of duplicate points, then create the unique index")
+    args = parser.parse_args()
+
+    from app import app
+    with app.app_context():
+        if args.remove_existing:
+            print(f"Deleted {remove_existing_duplicates()} duplicate points; "
+                  f"run `python rollups.py --rebuild` to recount them out of the rollups")
+        created = ensure_unique_index()
+        print(f"Unique index {UNIQUE_INDEX}: {'present' if created else 'missing'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+In-process cache of unit_id -> (device_id, is_active)
+
+The fleet changes rarely, so the webhook resolves devices from this bounded
+LRU/TTL cache and only queries the database for misses. Entries are
+invalidated when a device is created or edited. The cache is per process, so
+every reload_seconds it also compares the device table's count and newest
+updated_at with what it saw last and is cleared when another process created
+or edited a device.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import select, func
+
+CachedDevice = namedtuple('CachedDevice', ['device_id', 'is_active'])
+
+class DeviceCache:
+    """Bounded LRU cache with per-entry TTL and hit/miss counters"""
+
+    def __init__(self, max_size=10000, ttl_seconds=3600, reload_seconds=30):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.reload_seconds = reload_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = None
+        self._check_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.db_lookups = 0
+
+    def get_many(self, unit_ids):
+        """Return ({unit_id: CachedDevice} for cached ids, set of missing ids)"""
+        found = {}
+        missing = set()
+        now = time.monotonic()
+        with self._lock:
+            for unit_id in unit_ids:
+                entry = self._entries.get(unit_id)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(unit_id)
+                    found[unit_id] = entry[0]
+                else:
+                    if entry is not None:
+                        del self._entries[unit_id]
+                    missing.add(unit_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put(self, unit_id, device_id, is_active=True):
+        """Cache a device resolution"""
+        expires = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._entries[unit_id] = (CachedDevice(device_id, is_active), expires)
+            self._entries.move_to_end(unit_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, unit_id):
+        """Drop a single unit_id"""
+        with self._lock:
+            if self._entries.pop(unit_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def ensure_fresh(self):
+        """Clear the cache when Device rows changed in any process, checked every reload_seconds"""
+        from app import db
+        from models import Device
+
+        if self._checked is not None and time.monotonic() - self._checked < self.reload_seconds:
+            return
+        with self._check_lock:
+            if self._checked is not None and time.monotonic() - self._checked < self.reload_seconds:
+                return
+            version = tuple(db.session.execute(
+                select(func.count(Device.id), func.max(Device.updated_at))
+            ).one())
+            self._checked = time.monotonic()
+            if self._version is not None and version != self._version:
+                self.clear()
+            self._version = version
+
+    def record_lookup(self):
+        """Count a device SELECT issued because of cache misses"""
+        with self._lock:
+            self.db_lookups += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'db_lookups': self.db_lookups,
+            }
+
+# Process-wide cache, sized from the app config on first use
+_device_cache = None
+
+def get_device_cache():
+    """Return the process-wide device cache"""
+    global _device_cache
+    if _device_cache is None:
+        from app import app
+        _device_cache = DeviceCache(
+            max_size=app.config["DEVICE_CACHE_SIZE"],
+            ttl_seconds=app.config["DEVICE_CACHE_TTL"],
+            reload_seconds=app.config["DEVICE_CACHE_RELOAD_SECONDS"],
+        )
+    return _device_cache
@@ -0,0 +1,94 @@
+"""
+Declarative field alias table for incoming tracking records
+
+Each tracking field lists the source keys it may arrive under, in priority
+order. The table is compiled into a resolver per distinct set of incoming
+keys, so payloads repeating the same retranslator shape resolve every field
+with a single pass over the keys they actually carry.
+
+Vendor aliases can be added without code changes through a JSON file
+(FIELD_ALIASES_FILE) mapping field names to extra keys, e.g.
+{"unit_id": ["terminalId"], "latitude": ["gps_lat"]}.
+"""
+
+import json
+import logging
+from functools import lru_cache
+
+# Built-in aliases (the camelCase names at the end are from wialon_webhook.xsd)
+DEFAULT_FIELD_ALIASES = {
+    'unit_id': ('unit_id', 'unitId', 'id', 'device_id', 'deviceId', 'imei', 'uid', 'gpsCode', 'gps_code', 'code'),
+    'latitude': ('lat', 'latitude', 'y', 'coordY'),
+    'longitude': ('lon', 'lng', 'longitude', 'x', 'coordX'),
+    'altitude': ('alt', 'altitude', 'z'),
+    'speed': ('speed', 'spd'),
+    'heading': ('heading', 'course', 'dir'),
+    'timestamp': ('timestamp', 'time', 't', 'datetime', 'dt', 'server_time', 'date'),
+    'odometer': ('odometer', 'mileage'),
+    'fuel_level': ('fuel', 'fuel_level', 'fuelLevel'),
+    'engine_hours': ('engine_hours', 'hours', 'engineHours'),
+    'battery_voltage': ('battery', 'battery_voltage'),
+    'external_voltage': ('external_voltage', 'ext_voltage'),
+    'ignition_status': ('ignition', 'ign', 'ignitionStatus'),
+    'gps_valid': ('gps_valid', 'valid', 'gpsValid'),
+    'panic_button': ('panic', 'sos', 'panicButton'),
+}
+
+# Active table, updated in place by configure_aliases
+FIELD_ALIASES = dict(DEFAULT_FIELD_ALIASES)
+
+def configure_aliases(extra_aliases=None):
+    """Reset the table to the defaults plus extra aliases ({field: [keys]}) appended per field"""
+    FIELD_ALIASES.clear()
+    FIELD_ALIASES.update(DEFAULT_FIELD_ALIASES)
+
+    for field, aliases in (extra_aliases or {}).items():
+        if field not in FIELD_ALIASES:
+            logging.warning(f"Ignoring aliases for unknown tracking field '{field}'")
+            continue
+        if isinstance(aliases, str):
+            aliases = [aliases]
+        existing = FIELD_ALIASES[field]
+        FIELD_ALIASES[field] = existing + tuple(alias for alias in aliases if alias not in existing)
+
+    _compile_resolver.cache_clear()
+
+    # The typed JSON schema is generated from this table
+    import json_fastpath
+    json_fastpath.reset_schema()
+
+def load_alias_file(path):
+    """Load extra aliases from a JSON file"""
+    with open(path) as f:
+        extra_aliases = json.load(f)
+    if not isinstance(extra_aliases, dict):
+        raise ValueError(f"{path} must contain an object mapping field names to alias lists")
+    return extra_aliases
+
+def is_present(value):
+    """A value counts as present unless it is missing or empty; 0 and False are real readings"""
+    return value is not None and value != ''
+
+@lru_cache(maxsize=1024)
+def _compile_resolver(keys):
+    """Build the (field, candidate keys) plan for one incoming key set"""
+    plan = []
+    for field, aliases in FIELD_ALIASES.items():
+        candidates = tuple(alias for alias in aliases if alias in keys)
+        if candidates:
+            plan.append((field, candidates))
+    return tuple(plan)
+
+def resolve_fields(data):
+    """Resolve every tracking field of a record dict, returns {field: value} for present fields"""
+    values = {}
+    for field, candidates in _compile_resolver(frozenset(data)):
+        for key in candidates:
+            value = data[key]
+            if value is not None and value != '':
+                values[field] = value
+                break
+    return values
+
+def resolver_cache_info():
+    return _compile_resolver.cache_info()
@@ -0,0 +1,378 @@
+"""
+Geofences evaluated for every stored point
+
+Zones are polygons (GeoJSON, holes allowed) or circles. Active zones are
+compiled into an STR-packed R-tree over their bounding boxes. Each polygon is
+prepared by cutting its bounding box into horizontal bands that list only the
+edges crossing them, so a point test casts its ray against a handful of edges
+instead of the whole ring. A point therefore costs one tree descent plus a few
+edge tests however many zones exist; bench_geofences.py measures it.
+
+The ingest path evaluates points in time order per device against the zones
+the device was in at its previous point (GeofenceMembership) and records
+'enter' and 'exit' GeofenceEvent rows in the same transaction. Points older
+than the newest evaluated one are late or replayed and cause no transitions.
+Polygons are tested in plain longitude/latitude, so zones must not cross the
+antimeridian. The device's own SENSOR_INSIDE_GEOZONE reading is unaffected.
+"""
+
+import json
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import select, func, insert
+
+from geo import haversine_km
+
+# Children per R-tree node
+NODE_CAPACITY = 16
+
+# Edges per band aimed for when preparing a polygon
+EDGES_PER_BAND = 4
+
+MAX_BANDS = 256
+
+# Metres per degree of latitude
+METRES_PER_DEGREE = 111320.0
+
+class GeofenceError(ValueError):
+    """Invalid zone definition"""
+
+class PreparedPolygon:
+    """Polygon with its edges bucketed into horizontal bands for fast point tests"""
+
+    __slots__ = ('bbox', '_min_y', '_band_height', '_bands')
+
+    def __init__(self, rings):
+        edges = []
+        for ring in rings:
+            if len(ring) < 3:
+                raise GeofenceError("Polygon rings need at least 3 positions")
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                if y1 != y2:
+                    # (lower y, upper y, x at lower y, dx/dy)
+                    if y1 > y2:
+                        x1, y1, x2, y2 = x2, y2, x1, y1
+                    edges.append((y1, y2, x1, (x2 - x1) / (y2 - y1)))
+        xs = [x for ring in rings for x, _ in ring]
+        ys = [y for ring in rings for _, y in ring]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+
+        count = min(MAX_BANDS, max(1, len(edges) // EDGES_PER_BAND))
+        self._min_y = self.bbox[1]
+        self._band_height = (self.bbox[3] - self.bbox[1]) / count or 1.0
+        self._bands = [[] for _ in range(count)]
+        for edge in edges:
+            first = int((edge[0] - self._min_y) / self._band_height)
+            last = int((edge[1] - self._min_y) / self._band_height)
+            for band in range(max(first, 0), min(last, count - 1) + 1):
+                self._bands[band].append(edge)
+
+    def contains(self, x, y):
+        """Even-odd ray casting against the edges of the point's band"""
+        band = int((y - self._min_y) / self._band_height)
+        if band < 0 or band >= len(self._bands):
+            return False
+        inside = False
+        for low, high, x_low, slope in self._bands[band]:
+            if low <= y < high and x < x_low + (y - low) * slope:
+                inside = not inside
+        return inside
+
+class Circle:
+    """Circle of radius_m metres around a centre"""
+
+    __slots__ = ('bbox', 'latitude', 'longitude', 'radius_km')
+
+    def __init__(self, latitude, longitude, radius_m):
+        if radius_m <= 0:
+            raise GeofenceError("Circle radius must be positive")
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius_km = radius_m / 1000
+        dy = radius_m / METRES_PER_DEGREE
+        dx = dy / max(math.cos(math.radians(latitude)), 1e-6)
+        self.bbox = (longitude - dx, latitude - dy, longitude + dx, latitude + dy)
+
+    def contains(self, x, y):
+        return haversine_km(self.latitude, self.longitude, y, x) <= self.radius_km
+
+def compile_zone(kind, geometry, radius_m=None):
+    """Prepared shape of a zone from its stored kind, GeoJSON geometry and radius"""
+    if isinstance(geometry, str):
+        geometry = json.loads(geometry)
+    try:
+        if kind == 'circle':
+            longitude, latitude = geometry['coordinates'][:2]
+            return Circle(float(latitude), float(longitude), float(radius_m or 0))
+        if kind == 'polygon':
+            rings = []
+            for ring in geometry['coordinates']:
+                ring = [(float(position[0]), float(position[1])) for position in ring]
+                # GeoJSON rings repeat the first position at the end
+                if len(ring) > 1 and ring[0] == ring[-1]:
+                    ring.pop()
+                rings.append(ring)
+            if not rings:
+                raise GeofenceError("Polygon has no rings")
+            return PreparedPolygon(rings)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        if isinstance(e, GeofenceError):
+            raise
+        raise GeofenceError(f"Invalid {kind} geometry: {e}")
+    raise GeofenceError(f"Unknown zone kind: {kind}")
+
+class STRTree:
+    """Static R-tree packed with Sort-Tile-Recursive over (bbox, value) items"""
+
+    def __init__(self, items, node_capacity=NODE_CAPACITY):
+        self.node_capacity = node_capacity
+        # A node is (min_x, min_y, max_x, max_y, children, leaf); leaf children are values
+        nodes = [(*bbox, value, True) for bbox, value in items]
+        self.size = len(nodes)
+        while len(nodes) > node_capacity:
+            nodes = self._pack(nodes)
+        self.root = self._node(nodes) if nodes else None
+
+    def _node(self, children):
+        return (
+            min(child[0] for child in children),
+            min(child[1] for child in children),
+            max(child[2] for child in children),
+            max(child[3] for child in children),
+            children,
+            False,
+        )
+
+    def _pack(self, nodes):
+        """One level of parents: vertical slices by x centre, then runs by y centre"""
+        capacity = self.node_capacity
+        parent_count = math.ceil(len(nodes) / capacity)
+        slice_count = math.ceil(math.sqrt(parent_count))
+        slice_size = slice_count * capacity
+        nodes = sorted(nodes, key=lambda node: node[0] + node[2])
+        parents = []
+        for start in range(0, len(nodes), slice_size):
+            vertical = sorted(nodes[start:start + slice_size], key=lambda node: node[1] + node[3])
+            for offset in range(0, len(vertical), capacity):
+                parents.append(self._node(vertical[offset:offset + capacity]))
+        return parents
+
+    def query_point(self, x, y):
+        """Values whose bounding box contains the point"""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            min_x, min_y, max_x, max_y, children, leaf = stack.pop()
+            if x < min_x or x > max_x or y < min_y or y > max_y:
+                continue
+            if leaf:
+                found.append(children)
+            else:
+                stack.extend(children)
+        return found
+
+class GeofenceEngine:
+    """Compiled active zones, reloaded when Geofence rows change"""
+
+    def __init__(self, reload_seconds=30):
+        self.reload_seconds = reload_seconds
+        self.tree = STRTree([])
+        self.zone_ids = frozenset()
+        self._version = None
+        self._checked = None
+        self._lock = threading.Lock()
+        self.points = 0
+        self.events = 0
+        self.seconds = 0.0
+        self.compile_errors = 0
+
+    def build(self, zones):
+        """Index {zone_id: prepared shape}"""
+        self.tree = STRTree([(shape.bbox, (zone_id, shape)) for zone_id, shape in zones.items()])
+        self.zone_ids = frozenset(zones)
+
+    def zones_at(self, latitude, longitude):
+        """Ids of the zones containing a position"""
+        return frozenset(
+            zone_id for zone_id, shape in self.tree.query_point(longitude, latitude)
+            if shape.contains(longitude, latitude)
+        )
+
+    def invalidate(self):
+        self._checked = None
+
+    def ensure_loaded(self):
+        """Recompile the zones when Geofence rows changed, checked every reload_seconds"""
+        from app import db
+        from models import Geofence
+
+        if self._checked is not None and time.monotonic() - self._checked < self.reload_seconds:
+            return
+        with self._lock:
+            if self._checked is not None and time.monotonic() - self._checked < self.reload_seconds:
+                return
+            version = tuple(db.session.execute(
+                select(func.count(Geofence.id), func.max(Geofence.updated_at))
+            ).one())
+            self._checked = time.monotonic()
+            if version == self._version:
+                return
+            zones = {}
+            for zone in Geofence.query.filter(Geofence.is_active.isnot(False)).all():
+                try:
+                    zones[zone.id] = compile_zone(zone.kind, zone.geometry, zone.radius_m)
+                except GeofenceError as e:
+                    self.compile_errors += 1
+                    logging.error(f"Skipping geofence {zone.id} ({zone.name}): {e}")
+            self.build(zones)
+            self._version = version
+            logging.info(f"Compiled {len(zones)} geofences")
+
+    def stats(self):
+        return {
+            'zones': len(self.zone_ids),
+            'points': self.points,
+            'events': self.events,
+            # Zone tests and transitions only, without the membership query and inserts
+            'us_per_point': round(self.seconds / self.points * 1e6, 2) if self.points else 0.0,
+            'compile_errors': self.compile_errors,
+        }
+
+# Process-wide engine, built from the app config on first use
+_geofence_engine = None
+
+def get_geofence_engine():
+    """Return the process-wide geofence engine"""
+    global _geofence_engine
+    if _geofence_engine is None:
+        from app import app
+        _geofence_engine = GeofenceEngine(reload_seconds=app.config["GEOFENCE_RELOAD_SECONDS"])
+    return _geofence_engine
+
+def parse_memberships(value):
+    return frozenset(int(zone_id) for zone_id in value.split(',') if zone_id)
+
+def evaluate_geofences(rows, tracking_ids):
+    """
+    Record zone enter/exit events for a batch of inserted TrackingData rows (caller commits)
+    Returns the number of events
+    """
+    from app import db
+    from ingest import dialect_insert, on_commit
+    from models import GeofenceMembership, GeofenceEvent
+
+    engine = get_geofence_engine()
+    engine.ensure_loaded()
+    if not engine.zone_ids:
+        return 0
+
+    points_by_device = {}
+    for row, tracking_id in zip(rows, tracking_ids):
+        if row['latitude'] is None or row['longitude'] is None:
+            continue
+        points_by_device.setdefault(row['device_id'], []).append((row['timestamp'], tracking_id, row))
+    if not points_by_device:
+        return 0
+
+    memberships = {
+        device_id: (parse_memberships(geofence_ids), timestamp)
+        for device_id, geofence_ids, timestamp in db.session.execute(
+            select(GeofenceMembership.device_id, GeofenceMembership.geofence_ids, GeofenceMembership.timestamp)
+            .where(GeofenceMembership.device_id.in_(list(points_by_device)))
+        )
+    }
+
+    events = []
+    updates = []
+    evaluated = 0
+    started = time.perf_counter()
+    for device_id, points in points_by_device.items():
+        inside, last_timestamp = memberships.get(device_id, (frozenset(), None))
+        changed = False
+        for timestamp, tracking_id, row in sorted(points, key=lambda point: point[:2]):
+            if last_timestamp is not None and timestamp <= last_timestamp:
+                continue
+            now_inside = engine.zones_at(row['latitude'], row['longitude'])
+            evaluated += 1
+            for zone_id in now_inside - inside:
+                events.append({'device_id': device_id, 'geofence_id': zone_id, 'tracking_id': tracking_id,
+                               'event': 'enter', 'timestamp': timestamp})
+            # Zones deleted or deactivated since are left silently
+            for zone_id in (inside - now_inside) & engine.zone_ids:
+                events.append({'device_id': device_id, 'geofence_id': zone_id, 'tracking_id': tracking_id,
+                               'event': 'exit', 'timestamp': timestamp})
+            inside, last_timestamp, changed = now_inside, timestamp, True
+        if changed:
+            updates.append({'device_id': device_id, 'geofence_ids': ','.join(map(str, sorted(inside))),
+                            'timestamp': last_timestamp, 'updated_at': datetime.utcnow()})
+
+    elapsed = time.perf_counter() - started
+
+    if events:
+        db.session.execute(insert(GeofenceEvent.__table__), events)
+    if updates:
+        stmt = dialect_insert(GeofenceMembership.__table__)
+        if hasattr(stmt, 'on_conflict_do_update'):
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['device_id'],
+                set_={
+                    'geofence_ids': stmt.excluded.geofence_ids,
+                    'timestamp': stmt.excluded.timestamp,
+                    'updated_at': stmt.excluded.updated_at,
+                },
+                where=stmt.excluded.timestamp > GeofenceMembership.__table__.c.timestamp,
+            ), updates)
+        else:
+            for values in updates:
+                membership = db.session.get(GeofenceMembership, values['device_id'])
+                if membership is None:
+                    db.session.add(GeofenceMembership(**values))
+                elif values['timestamp'] > membership.timestamp:
+                    membership.geofence_ids = values['geofence_ids']
+                    membership.timestamp = values['timestamp']
+                    membership.updated_at = values['updated_at']
+
+    event_count = len(events)
+
+    def count():
+        engine.points += evaluated
+        engine.events += event_count
+        engine.seconds += elapsed
+    on_commit(count)
+    return event_count
+
+def zone_from_request(data):
+    """(name, kind, geometry JSON, radius_m) of a zone posted to the API, raises GeofenceError"""
+    name = (data.get('name') or '').strip()
+    if not name:
+        raise GeofenceError("name is required")
+    kind = data.get('kind')
+    if kind == 'circle':
+        geometry = {'type': 'Point', 'coordinates': [data.get('longitude'), data.get('latitude')]}
+        radius_m = data.get('radius_m')
+    elif kind == 'polygon':
+        geometry = data.get('geometry') or {}
+        if geometry.get('type') != 'Polygon':
+            raise GeofenceError("geometry must be a GeoJSON Polygon")
+        radius_m = None
+    else:
+        raise GeofenceError("kind must be 'polygon' or 'circle'")
+    compile_zone(kind, geometry, radius_m)
+    return name, kind, json.dumps(geometry, separators=(',', ':')), radius_m
+
+def geofence_dict(zone):
+    return {
+        'id': zone.id,
+        'name': zone.name,
+        'kind': zone.kind,
+        'geometry': json.loads(zone.geometry),
+        'radius_m': zone.radius_m,
+        'is_active': zone.is_active,
+        'created_at': zone.created_at.isoformat() if zone.created_at else None,
+    }
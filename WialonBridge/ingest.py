@@ -0,0 +1,263 @@
+"""
+Persistence of parsed Wialon entries into TrackingData
+Shared by the synchronous webhook path and the background ingest workers
+"""
+
+import logging
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import event, insert, select, update
+from app import db
+from models import Device, TrackingData, TelemetryValue
+from device_cache import get_device_cache
+from telemetry_mapping import pack_telemetry
+from latest_state import update_latest_state, latest_points, MAP_TELEMETRY_CATEGORIES
+from live_feed import get_live_feed
+from spatial_index import get_spatial_index
+from dedup import get_dedup_filter, insert_new_tracking_rows
+from geofences import evaluate_geofences
+from trips import segment_trips
+from alerts import evaluate_alerts
+import metrics
+from webhook_parser import raw_data_text
+
+def on_commit(callback):
+    """Run callback once the current transaction commits; it is discarded on rollback"""
+    db.session.info.setdefault('post_commit', []).append(callback)
+
+@event.listens_for(db.session, 'after_commit')
+def run_post_commit(session):
+    # Callbacks run outside the transaction and must not use the session
+    for callback in session.info.pop('post_commit', ()):
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f"Post-commit hook failed: {e}")
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_post_commit(session):
+    session.info.pop('post_commit', None)
+
+def dialect_insert(table):
+    """INSERT construct of the active dialect, supporting ON CONFLICT clauses where available"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        return pg_insert(table)
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        return sqlite_insert(table)
+    return insert(table)
+
+def resolve_devices(unit_ids):
+    """
+    Map unit_ids to device ids, served from the device cache where possible
+    Cache misses are resolved with a single IN query and missing devices are
+    created with a single upsert and selected back
+    """
+    unit_ids = set(unit_ids)
+    if not unit_ids:
+        return {}
+
+    cache = get_device_cache()
+    cache.ensure_fresh()
+    cached, missing = cache.get_many(unit_ids)
+    device_ids = {unit_id: entry.device_id for unit_id, entry in cached.items()}
+    if not missing:
+        return device_ids
+
+    cache.record_lookup()
+    found = dict(db.session.execute(
+        select(Device.unit_id, Device.id).where(Device.unit_id.in_(missing))
+    ).all())
+
+    # Ingest marks every resolved device active
+    for unit_id, device_id in found.items():
+        cache.put(unit_id, device_id, True)
+    device_ids.update(found)
+
+    unknown = missing - found.keys()
+    if unknown:
+        stmt = dialect_insert(Device).values([{
+            'unit_id': unit_id,
+            'name': f"Device {unit_id}",
+            'device_type': 'Xirgo/Sensata XG3780',
+        } for unit_id in unknown])
+        if hasattr(stmt, 'on_conflict_do_nothing'):
+            # Another request may have created the same device concurrently
+            stmt = stmt.on_conflict_do_nothing(index_elements=['unit_id'])
+        db.session.execute(stmt)
+
+        # New devices are not cached until committed; the next request picks them up
+        for unit_id in unknown:
+            cache.invalidate(unit_id)
+        device_ids.update(db.session.execute(
+            select(Device.unit_id, Device.id).where(Device.unit_id.in_(unknown))
+        ).all())
+
+    return device_ids
+
+def build_tracking_row(data_entry, device_id):
+    """Column values for one TrackingData row (telemetry is stored separately in TelemetryValue)"""
+    return {
+        'device_id': device_id,
+        'latitude': data_entry.get('latitude'),
+        'longitude': data_entry.get('longitude'),
+        'altitude': data_entry.get('altitude'),
+        'speed': data_entry.get('speed'),
+        'heading': data_entry.get('heading'),
+        'timestamp': data_entry.get('timestamp') or datetime.utcnow(),
+        'odometer': data_entry.get('odometer'),
+        'fuel_level': data_entry.get('fuel_level'),
+        'engine_hours': data_entry.get('engine_hours'),
+        'battery_voltage': data_entry.get('battery_voltage'),
+        'external_voltage': data_entry.get('external_voltage'),
+        'ignition_status': data_entry.get('ignition_status'),
+        'gps_valid': data_entry.get('gps_valid', True),
+        'panic_button': data_entry.get('panic_button', False),
+        'raw_data': raw_data_text(data_entry.get('raw_data')),
+        'data_format': data_entry.get('data_format'),
+        'webhook_log_id': data_entry.get('webhook_log_id'),
+    }
+
+def insert_tracking_rows(rows):
+    """Insert TrackingData rows and return their ids in row order"""
+    if db.engine.dialect.insert_executemany_returning_sort_by_parameter_order:
+        stmt = insert(TrackingData.__table__).returning(TrackingData.id, sort_by_parameter_order=True)
+        return db.session.execute(stmt, rows).scalars().all()
+
+    # Older SQLite without RETURNING: one statement per row
+    return [
+        db.session.execute(insert(TrackingData.__table__), row).inserted_primary_key[0]
+        for row in rows
+    ]
+
+def store_tracking_entries(parsed_data):
+    """
+    Bulk insert parsed entries as TrackingData rows in the current session
+    Devices are resolved with one query, points and their telemetry readings are
+    written with one executemany each, Device.last_seen is updated once per device,
+    DeviceLatestState is moved forward for devices with a newer position,
+    geofence transitions are recorded, the points are fed to trip segmentation and
+    alert rules are evaluated
+    Returns the number of stored entries; the caller is responsible for committing
+    """
+    if not parsed_data:
+        return 0
+
+    device_ids = resolve_devices(entry['unit_id'] for entry in parsed_data if entry.get('unit_id'))
+    dedup_filter = get_dedup_filter()
+
+    rows = []
+    readings = []
+    stored_entries = []
+    batch_keys = set()
+    repeated = 0
+    skipped = 0
+    for data_entry in parsed_data:
+        try:
+            row = build_tracking_row(data_entry, device_ids[data_entry['unit_id']])
+        except Exception as e:
+            logging.error(f"Error processing data entry: {e}")
+            continue
+        if dedup_filter is not None:
+            # Points repeated in the batch or already stored by this process never reach the database
+            key = (row['device_id'], row['timestamp'])
+            if key in batch_keys:
+                repeated += 1
+                skipped += 1
+                continue
+            if dedup_filter.seen(*key):
+                skipped += 1
+                continue
+            batch_keys.add(key)
+        rows.append(row)
+        stored_entries.append(data_entry)
+        telemetry = data_entry.get('telemetry')
+        readings.append(pack_telemetry(telemetry) if telemetry else [])
+
+    if skipped:
+        on_commit(lambda: metrics.counters.record_duplicates(skipped))
+
+    if not rows:
+        return 0
+
+    if dedup_filter is None:
+        tracking_ids = insert_tracking_rows(rows)
+    else:
+        tracking_ids, rows, readings, stored_entries = drop_conflicts(
+            insert_new_tracking_rows(rows), rows, readings, stored_entries, dedup_filter, repeated)
+        if not rows:
+            return 0
+    if any(readings):
+        db.session.execute(insert(TelemetryValue.__table__), [
+            {'tracking_id': tracking_id, 'sensor_id': sensor_id, 'value': value, 'text_value': text_value}
+            for tracking_id, point_readings in zip(tracking_ids, readings)
+            for sensor_id, value, text_value in point_readings
+        ])
+
+    update_latest_state(rows, tracking_ids)
+    evaluate_geofences(rows, tracking_ids)
+    segment_trips(rows, tracking_ids, readings)
+    evaluate_alerts(rows, tracking_ids, readings)
+
+    # Update device last seen once per device
+    now = datetime.utcnow()
+    db.session.execute(update(Device), [
+        {'id': device_id, 'last_seen': now, 'is_active': True}
+        for device_id in {row['device_id'] for row in rows}
+    ])
+
+    # Rolling counters, live clients and the map index see the points once committed
+    points_by_unit = Counter(data_entry['unit_id'] for data_entry in stored_entries)
+    on_commit(lambda: metrics.counters.record_points(points_by_unit))
+    
+    live_feed = get_live_feed()
+    spatial_index = get_spatial_index()
+    if live_feed.active or spatial_index.loaded:
+        positions = position_events(rows, tracking_ids, stored_entries)
+        if live_feed.active:
+            on_commit(lambda: live_feed.publish('positions', positions))
+        if spatial_index.loaded:
+            on_commit(lambda: spatial_index.upsert(positions['devices']))
+
+    return len(rows)
+
+def drop_conflicts(tracking_ids, rows, readings, entries, dedup_filter, repeated):
+    """Keep the rows the dedup insert stored; every key is remembered once committed"""
+    keys = [(row['device_id'], row['timestamp']) for row in rows]
+    stored = [i for i, tracking_id in enumerate(tracking_ids) if tracking_id is not None]
+    conflicts = len(rows) - len(stored)
+
+    def remember():
+        dedup_filter.remember(keys)
+        dedup_filter.count(len(stored), conflicts, repeated)
+        if conflicts:
+            metrics.counters.record_duplicates(conflicts)
+    on_commit(remember)
+
+    return ([tracking_ids[i] for i in stored], [rows[i] for i in stored],
+            [readings[i] for i in stored], [entries[i] for i in stored])
+
+def position_events(rows, tracking_ids, entries):
+    """Live feed payload: point count and the newest position per device in the batch"""
+    entry_by_tracking_id = dict(zip(tracking_ids, zip(rows, entries)))
+    devices = []
+    for device_id, (timestamp, tracking_id) in latest_points(rows, tracking_ids).items():
+        row, data_entry = entry_by_tracking_id[tracking_id]
+        devices.append({
+            'device_id': device_id,
+            'unit_id': data_entry['unit_id'],
+            'latitude': row['latitude'],
+            'longitude': row['longitude'],
+            'speed': row['speed'] or 0,
+            'heading': row['heading'] or 0,
+            'timestamp': timestamp.isoformat(),
+            'is_active': True,
+            'telemetry': {
+                sensor_name: sensor_data
+                for sensor_name, sensor_data in (data_entry.get('telemetry') or {}).items()
+                if sensor_data.get('category') in MAP_TELEMETRY_CATEGORIES
+            },
+        })
+    return {'points': len(rows), 'devices': devices}
@@ -0,0 +1,402 @@
+"""
+Durable ingest queue between /webhook/wialon and the database
+
+In queued ingest mode the webhook authenticates the request, checks that the body's
+first record names a unit and appends the raw body to a local SQLite (WAL) queue file,
+then answers Wialon without touching the database.
+A pool of background writer threads drains the queue into TrackingData in batches.
+
+Entries are leased to a worker while they are being written and only deleted
+after the database commit succeeds, so anything queued but never written
+(worker crash, process restart, database outage) is replayed once its lease
+expires.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import logging
+from datetime import datetime
+
+class QueueFullError(Exception):
+    """Raised when the queue depth has reached its configured maximum"""
+    pass
+
+class IngestQueue:
+    """Append-only SQLite queue of raw webhook bodies"""
+
+    def __init__(self, path, max_depth=100000, lease_seconds=60, max_attempts=5):
+        self.path = path
+        self.max_depth = max_depth
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._depth_cache = (0, 0.0)
+
+        # Backpressure and throughput counters (per process)
+        self.counters = {
+            'enqueued': 0,
+            'rejected_full': 0,
+            'written_requests': 0,
+            'written_points': 0,
+            'failed_attempts': 0,
+            'dead_lettered': 0,
+            'replayed': 0,
+            'batches': 0,
+        }
+        self.last_batch_ms = 0
+
+        self._init_schema()
+
+    def _connect(self):
+        """Get the SQLite connection for the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                received_at REAL NOT NULL,
+                content_type TEXT,
+                remote_addr TEXT,
+                user_agent TEXT,
+                body BLOB NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_expires REAL,
+                last_error TEXT,
+                dead INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_ingest_queue_ready ON ingest_queue (dead, lease_expires, id)')
+
+    def count(self, name, amount=1):
+        """Increment a monitoring counter"""
+        with self._lock:
+            self.counters[name] += amount
+
+    def depth(self, max_age=1.0):
+        """Number of entries waiting to be written (cached for max_age seconds)"""
+        value, checked_at = self._depth_cache
+        now = time.time()
+        if now - checked_at > max_age:
+            row = self._connect().execute('SELECT COUNT(*) FROM ingest_queue WHERE dead = 0').fetchone()
+            value = row[0]
+            self._depth_cache = (value, now)
+        return value
+
+    def enqueue(self, body, content_type=None, remote_addr=None, user_agent=None):
+        """Durably append a raw request body, returns the queue entry id"""
+        if self.depth() >= self.max_depth:
+            self.count('rejected_full')
+            raise QueueFullError(f"Ingest queue is full ({self.max_depth} entries)")
+
+        cursor = self._connect().execute(
+            'INSERT INTO ingest_queue (received_at, content_type, remote_addr, user_agent, body) VALUES (?, ?, ?, ?, ?)',
+            (time.time(), content_type, remote_addr, user_agent, sqlite3.Binary(body))
+        )
+        self.count('enqueued')
+        value, checked_at = self._depth_cache
+        self._depth_cache = (value + 1, checked_at)
+        return cursor.lastrowid
+
+    def claim(self, limit):
+        """
+        Lease up to `limit` ready entries, including expired leases from crashed workers
+        Entries whose lease expired on their last attempt are dead-lettered instead
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                '''SELECT id, received_at, content_type, remote_addr, user_agent, body, attempts
+                   FROM ingest_queue
+                   WHERE dead = 0 AND (lease_expires IS NULL OR lease_expires < ?)
+                   ORDER BY id LIMIT ?''',
+                (now, limit)
+            ).fetchall()
+            # Neither acknowledged nor failed: the worker died on them (crash, OOM on that body)
+            exhausted = [row[0] for row in rows if row[6] >= self.max_attempts]
+            if exhausted:
+                conn.executemany(
+                    'UPDATE ingest_queue SET lease_expires = NULL, dead = 1, last_error = ? WHERE id = ?',
+                    [(f"Lease expired on all {self.max_attempts} attempts", entry_id) for entry_id in exhausted]
+                )
+                rows = [row for row in rows if row[6] < self.max_attempts]
+            if rows:
+                conn.executemany(
+                    'UPDATE ingest_queue SET lease_expires = ?, attempts = attempts + 1 WHERE id = ?',
+                    [(now + self.lease_seconds, row[0]) for row in rows]
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        if exhausted:
+            self.count('dead_lettered', len(exhausted))
+            self._depth_cache = (0, 0.0)
+            logging.error(f"Ingest queue entries {exhausted} dead-lettered: lease expired on all "
+                          f"{self.max_attempts} attempts")
+
+        replayed = sum(1 for row in rows if row[6] > 0)
+        if replayed:
+            self.count('replayed', replayed)
+
+        return [{
+            'id': row[0],
+            'received_at': row[1],
+            'content_type': row[2],
+            'remote_addr': row[3],
+            'user_agent': row[4],
+            'body': bytes(row[5]),
+            'attempts': row[6] + 1,
+        } for row in rows]
+
+    def ack(self, entry_ids):
+        """Remove entries that have been committed to the database"""
+        if not entry_ids:
+            return
+        self._connect().executemany('DELETE FROM ingest_queue WHERE id = ?', [(i,) for i in entry_ids])
+        self._depth_cache = (0, 0.0)
+
+    def fail(self, entry, error):
+        """Release a failed entry for retry, or dead-letter it after max_attempts"""
+        dead = 1 if entry['attempts'] >= self.max_attempts else 0
+        self._connect().execute(
+            'UPDATE ingest_queue SET lease_expires = NULL, last_error = ?, dead = ? WHERE id = ?',
+            (str(error)[:1000], dead, entry['id'])
+        )
+        self.count('failed_attempts')
+        if dead:
+            self.count('dead_lettered')
+            logging.error(f"Ingest queue entry {entry['id']} dead-lettered after {entry['attempts']} attempts: {error}")
+
+    def pending_replay_count(self):
+        """Entries that were leased before and never acknowledged"""
+        row = self._connect().execute(
+            'SELECT COUNT(*) FROM ingest_queue WHERE dead = 0 AND attempts > 0'
+        ).fetchone()
+        return row[0]
+
+    def stats(self):
+        """Backpressure metrics for monitoring"""
+        conn = self._connect()
+        now = time.time()
+        ready, in_flight, dead, oldest = conn.execute(
+            '''SELECT
+                   SUM(CASE WHEN dead = 0 AND (lease_expires IS NULL OR lease_expires < ?) THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN dead = 0 AND lease_expires >= ? THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN dead = 1 THEN 1 ELSE 0 END),
+                   MIN(CASE WHEN dead = 0 THEN received_at END)
+               FROM ingest_queue''',
+            (now, now)
+        ).fetchone()
+
+        with self._lock:
+            counters = dict(self.counters)
+
+        ready = ready or 0
+        in_flight = in_flight or 0
+        return {
+            'depth': ready + in_flight,
+            'ready': ready,
+            'in_flight': in_flight,
+            'dead': dead or 0,
+            'max_depth': self.max_depth,
+            'utilization': round((ready + in_flight) / self.max_depth, 4) if self.max_depth else None,
+            'oldest_age_seconds': round(now - oldest, 3) if oldest else 0,
+            'last_batch_ms': self.last_batch_ms,
+            **counters,
+        }
+
+class IngestWorkerPool:
+    """Background threads that drain the ingest queue into the database"""
+
+    def __init__(self, app, queue, workers=2, batch_size=50, poll_interval=0.5):
+        self.app = app
+        self.queue = queue
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"ingest-writer-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    written = self.drain_once()
+            except Exception as e:
+                logging.error(f"Ingest worker error: {e}")
+                written = 0
+
+            if not written:
+                self._stop.wait(self.poll_interval)
+
+    def drain_once(self):
+        """Write one batch from the queue, returns the number of queue entries handled"""
+        from app import db
+
+        entries = self.queue.claim(self.batch_size)
+        if not entries:
+            return 0
+
+        start_time = time.time()
+        parsed = []
+        for entry in entries:
+            # A body that can't even be parsed goes through fail() like a failed write
+            try:
+                parsed.append((entry, parse_queued_entry(entry)))
+            except Exception as e:
+                logging.warning(f"Queued entry {entry['id']} could not be parsed: {e}")
+                self.queue.fail(entry, e)
+        if not parsed:
+            return len(entries)
+
+        try:
+            points = write_queued_batch(parsed)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.warning(f"Batch write of {len(parsed)} queued entries failed, retrying individually: {e}")
+            points = 0
+            written = []
+            for entry, parsed_data in parsed:
+                try:
+                    points += write_queued_batch([(entry, parsed_data)])
+                    db.session.commit()
+                    written.append(entry)
+                except Exception as entry_error:
+                    db.session.rollback()
+                    self.queue.fail(entry, entry_error)
+            self.queue.ack([entry['id'] for entry in written])
+            self.queue.count('written_requests', len(written))
+        else:
+            self.queue.ack([entry['id'] for entry, _ in parsed])
+            self.queue.count('written_requests', len(parsed))
+
+        self.queue.count('written_points', points)
+        self.queue.count('batches')
+        self.queue.last_batch_ms = int((time.time() - start_time) * 1000)
+        return len(entries)
+
+def parse_queued_entry(entry):
+    """Parse a queued raw body with the same parser the synchronous path uses"""
+    from webhook_parser import parse_wialon_data, WebhookPayload
+
+    entry['payload'] = WebhookPayload(entry['body'], entry['content_type'])
+    return parse_wialon_data(entry['payload'])
+
+def write_queued_batch(parsed):
+    """Store parsed queue entries and their webhook logs in the current session"""
+    from app import app, db
+    from models import WebhookLog
+    from ingest import store_tracking_entries, on_commit
+    from live_feed import get_live_feed, message_event
+    from webhook_log_buffer import sample_request_data
+    import metrics
+
+    # Logs are written first so every point can reference the request that delivered it
+    log_entries = []
+    sample_chars = app.config["WEBHOOK_LOG_SAMPLE_CHARS"]
+    for entry, parsed_data in parsed:
+        body = entry['body']
+        status_code = 200 if parsed_data else 400
+        log_entries.append(WebhookLog(
+            timestamp=datetime.utcfromtimestamp(entry['received_at']),
+            endpoint='/webhook/wialon',
+            method='POST',
+            content_type=entry['content_type'],
+            content_length=len(body),
+            remote_addr=entry['remote_addr'],
+            user_agent=entry['user_agent'] or '',
+            status_code=status_code,
+            processing_time_ms=int((time.time() - entry['received_at']) * 1000),
+            error_message=None if parsed_data else "No valid data found in queued request",
+            request_data_sample=sample_request_data(status_code, entry['payload'].sample(sample_chars))
+        ))
+    db.session.add_all(log_entries)
+    db.session.flush()
+
+    for log_entry, (_, parsed_data) in zip(log_entries, parsed):
+        for data_entry in parsed_data:
+            data_entry['webhook_log_id'] = log_entry.id
+
+    # One bulk write for every point in the batch
+    points = store_tracking_entries([data_entry for _, parsed_data in parsed for data_entry in parsed_data])
+
+    status_codes = [log_entry.status_code for log_entry in log_entries]
+
+    def count_requests():
+        for status_code in status_codes:
+            metrics.counters.record_request(status_code)
+    on_commit(count_requests)
+
+    live_feed = get_live_feed()
+    if live_feed.active:
+        messages = [message_event(log_entry) for log_entry in log_entries]
+
+        def publish_messages():
+            for message in messages:
+                live_feed.publish('message', message)
+        on_commit(publish_messages)
+    return points
+
+# Process-wide queue and worker pool, set up by init_ingest_queue
+_ingest_queue = None
+_worker_pool = None
+
+def get_ingest_queue():
+    """Return the active ingest queue, or None in synchronous mode"""
+    return _ingest_queue
+
+def init_ingest_queue(app):
+    """Open the queue file and start the writer pool when INGEST_MODE is 'queued'"""
+    global _ingest_queue, _worker_pool
+
+    path = app.config["INGEST_QUEUE_PATH"]
+    if not os.path.isabs(path):
+        os.makedirs(app.instance_path, exist_ok=True)
+        path = os.path.join(app.instance_path, path)
+
+    _ingest_queue = IngestQueue(
+        path,
+        max_depth=app.config["INGEST_QUEUE_MAX_DEPTH"],
+        lease_seconds=app.config["INGEST_LEASE_SECONDS"],
+        max_attempts=app.config["INGEST_MAX_ATTEMPTS"],
+    )
+
+    pending = _ingest_queue.pending_replay_count()
+    if pending:
+        logging.warning(f"Ingest queue has {pending} entries that were never written, replaying")
+
+    _worker_pool = IngestWorkerPool(
+        app,
+        _ingest_queue,
+        workers=app.config["INGEST_WORKERS"],
+        batch_size=app.config["INGEST_BATCH_SIZE"],
+    )
+    _worker_pool.start()
+    logging.info(f"Queued ingest enabled: {path} with {_worker_pool.workers} writer threads")
+    return _ingest_queue
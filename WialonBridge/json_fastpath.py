@@ -0,0 +1,152 @@
+"""
+Typed fast path for JSON retranslator payloads
+
+When msgspec is installed, JSON bodies are decoded straight into a compiled
+WialonRecord struct covering the documented field aliases, skipping the
+intermediate dicts and per-key probing of the generic path. Top-level entries
+are first split as msgspec.Raw slices of the body, so each record's raw_data
+is a view of the original bytes. Records that don't fit the schema (unknown
+keys or types) are handed to the generic extract_tracking_data path.
+
+msgspec is optional; without it parse_json_fast returns None and the caller
+uses the generic path for the whole payload.
+"""
+
+import json
+import logging
+from typing import Any, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Value types accepted by the schema per tracking field
+_ID_TYPE = Union[str, int, None]
+_NUMBER_TYPE = Union[float, str, None]
+_TIMESTAMP_TYPE = Union[int, float, str, None]
+_FLAG_TYPE = Union[bool, int, float, str, None]
+
+_FIELD_TYPES = {
+    'unit_id': _ID_TYPE,
+    'timestamp': _TIMESTAMP_TYPE,
+    'ignition_status': _FLAG_TYPE,
+    'gps_valid': _FLAG_TYPE,
+    'panic_button': _FLAG_TYPE,
+}
+
+# Set from the JSON_FAST_PATH config by configure()
+enabled = msgspec is not None
+
+_record_decoder = None
+_entries_decoder = None
+_field_plan = None
+
+def configure(use_fast_path=True):
+    """Enable or disable the fast path (it stays off when msgspec is missing)"""
+    global enabled
+    enabled = bool(use_fast_path) and msgspec is not None
+    if use_fast_path and msgspec is None:
+        logging.info("msgspec is not installed, JSON payloads use the generic parser")
+
+def reset_schema():
+    """Drop the compiled schema so it is rebuilt from the current alias table"""
+    global _record_decoder, _entries_decoder, _field_plan
+    _record_decoder = _entries_decoder = _field_plan = None
+
+def _build_schema(field_aliases):
+    """Compile the record struct and decoders from the alias table"""
+    global _record_decoder, _entries_decoder, _field_plan
+
+    class TelemetryDetail(msgspec.Struct):
+        sensorCode: Union[str, None] = None
+        value: Any = None
+
+    # Struct attributes get positional names and are renamed to the source keys,
+    # so vendor aliases don't need to be valid Python identifiers
+    fields = []
+    rename = {}
+    attributes = {}
+    for field, aliases in field_aliases.items():
+        field_type = _FIELD_TYPES.get(field, _NUMBER_TYPE)
+        for alias in aliases:
+            if alias not in attributes:
+                attributes[alias] = f'f{len(attributes)}'
+                rename[attributes[alias]] = alias
+                fields.append((attributes[alias], field_type, None))
+    fields.append(('telemetryDetails', Union[list[TelemetryDetail], TelemetryDetail, None], None))
+    fields.append(('sensors', Union[dict[str, Any], None], None))
+
+    record_type = msgspec.defstruct('WialonRecord', fields, rename=rename, forbid_unknown_fields=True)
+
+    _record_decoder = msgspec.json.Decoder(record_type)
+    _entries_decoder = msgspec.json.Decoder(list[msgspec.Raw])
+    _field_plan = tuple(
+        (field, tuple(attributes[alias] for alias in aliases))
+        for field, aliases in field_aliases.items()
+    )
+
+def parse_json_fast(payload):
+    """
+    Parse a JSON WebhookPayload through the typed schema
+    Returns the list of parsed entries, or None when the fast path is unavailable
+    """
+    if not enabled:
+        return None
+
+    from field_aliases import FIELD_ALIASES
+    from webhook_parser import build_tracking_entry, extract_tracking_data
+
+    if _record_decoder is None:
+        _build_schema(FIELD_ALIASES)
+
+    body = payload.body
+    try:
+        if body.lstrip()[:1] == b'[':
+            raw_entries = _entries_decoder.decode(body)
+        else:
+            raw_entries = [msgspec.Raw(body.strip())]
+    except msgspec.DecodeError:
+        # Malformed JSON, let the generic path report it
+        return None
+
+    parsed_entries = []
+    for raw in raw_entries:
+        raw_data = memoryview(raw)
+        try:
+            record = _record_decoder.decode(raw)
+        except msgspec.ValidationError:
+            # Unknown shape: fall back to generic dict extraction for this record
+            entry = json.loads(raw_data.tobytes())
+            if isinstance(entry, dict) and entry:
+                parsed_entry = extract_tracking_data(entry, 'json', raw_data)
+                if parsed_entry:
+                    parsed_entries.append(parsed_entry)
+            continue
+        except msgspec.DecodeError:
+            # A single-object body isn't split first, so it is only found malformed here
+            return None
+
+        values = {}
+        for field, aliases in _field_plan:
+            for alias in aliases:
+                value = getattr(record, alias)
+                if value is not None and value != '':
+                    values[field] = value
+                    break
+
+        details = record.telemetryDetails
+        if details is not None and not isinstance(details, list):
+            details = [details]
+        if details:
+            details = [(detail.sensorCode, detail.value) for detail in details]
+
+        try:
+            parsed_entry = build_tracking_entry(values, 'json', raw_data, details, record.sensors)
+        except Exception as e:
+            logging.error(f"Error extracting tracking data: {e}")
+            continue
+        if parsed_entry:
+            parsed_entries.append(parsed_entry)
+
+    return parsed_entries
@@ -0,0 +1,140 @@
+"""
+Latest position per device for the map
+
+DeviceLatestState points at each device's newest tracking point with
+coordinates. The ingest path upserts it in the same transaction as the points,
+and the upsert only moves forward in time, so late or replayed points never
+replace a newer position. Reading the map is then one row per device no matter
+how much history TrackingData holds.
+"""
+
+import logging
+from datetime import datetime
+from sqlalchemy import select, func
+from sqlalchemy.orm import contains_eager
+from app import db
+from models import TrackingData, DeviceLatestState
+
+# Telemetry categories shown in map popups
+MAP_TELEMETRY_CATEGORIES = ('gps', 'engine', 'fuel', 'power')
+
+def latest_points(rows, tracking_ids):
+    """Newest positioned point per device in a batch, as {device_id: (timestamp, tracking_id)}"""
+    latest = {}
+    for row, tracking_id in zip(rows, tracking_ids):
+        if row['latitude'] is None or row['longitude'] is None:
+            continue
+        candidate = (row['timestamp'], tracking_id)
+        current = latest.get(row['device_id'])
+        if current is None or candidate > current:
+            latest[row['device_id']] = candidate
+    return latest
+
+def update_latest_state(rows, tracking_ids):
+    """Upsert DeviceLatestState for a batch of inserted TrackingData rows (caller commits)"""
+    latest = latest_points(rows, tracking_ids)
+    if not latest:
+        return
+
+    from ingest import dialect_insert
+    now = datetime.utcnow()
+    values = [
+        {'device_id': device_id, 'tracking_id': tracking_id, 'timestamp': timestamp, 'updated_at': now}
+        for device_id, (timestamp, tracking_id) in latest.items()
+    ]
+    stmt = dialect_insert(DeviceLatestState).values(values)
+    if hasattr(stmt, 'on_conflict_do_update'):
+        # Monotonic: an existing newer position is kept
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['device_id'],
+            set_={
+                'tracking_id': stmt.excluded.tracking_id,
+                'timestamp': stmt.excluded.timestamp,
+                'updated_at': stmt.excluded.updated_at,
+            },
+            where=stmt.excluded.timestamp >= DeviceLatestState.timestamp,
+        ))
+        return
+
+    for value in values:
+        state = db.session.get(DeviceLatestState, value['device_id'])
+        if state is None:
+            db.session.add(DeviceLatestState(**value))
+        elif value['timestamp'] >= state.timestamp:
+            state.tracking_id = value['tracking_id']
+            state.timestamp = value['timestamp']
+            state.updated_at = now
+
+def rebuild_latest_state():
+    """Recompute DeviceLatestState from the full TrackingData history"""
+    latest_timestamps = select(
+        TrackingData.device_id,
+        func.max(TrackingData.timestamp).label('max_timestamp')
+    ).where(
+        TrackingData.latitude.isnot(None),
+        TrackingData.longitude.isnot(None)
+    ).group_by(TrackingData.device_id).subquery()
+
+    # Highest id wins when a device has several points at its latest timestamp
+    latest = db.session.execute(
+        select(TrackingData.device_id, func.max(TrackingData.id), TrackingData.timestamp)
+        .join(latest_timestamps, db.and_(
+            TrackingData.device_id == latest_timestamps.c.device_id,
+            TrackingData.timestamp == latest_timestamps.c.max_timestamp))
+        .where(TrackingData.latitude.isnot(None), TrackingData.longitude.isnot(None))
+        .group_by(TrackingData.device_id, TrackingData.timestamp)
+    ).all()
+
+    now = datetime.utcnow()
+    db.session.execute(DeviceLatestState.__table__.delete())
+    if latest:
+        db.session.execute(DeviceLatestState.__table__.insert(), [
+            {'device_id': device_id, 'tracking_id': tracking_id, 'timestamp': timestamp, 'updated_at': now}
+            for device_id, tracking_id, timestamp in latest
+        ])
+    db.session.commit()
+    return len(latest)
+
+def ensure_latest_state():
+    """Backfill DeviceLatestState once for databases that predate it"""
+    if db.session.query(DeviceLatestState.device_id).first() is not None:
+        return
+    if db.session.query(TrackingData.id).first() is None:
+        return
+    count = rebuild_latest_state()
+    logging.info(f"Backfilled latest position for {count} devices")
+
+def latest_state_snapshot(updated_since=None):
+    """
+    Latest position of every device with one, in the shape used by the map page
+    With updated_since, only positions that changed since then
+    """
+    query = db.session.query(TrackingData)\
+        .join(DeviceLatestState, DeviceLatestState.tracking_id == TrackingData.id)\
+        .join(TrackingData.device)\
+        .options(contains_eager(TrackingData.device))
+    if updated_since is not None:
+        query = query.filter(DeviceLatestState.updated_at >= updated_since)
+    latest_locations = query.all()
+
+    map_data = []
+    for tracking in latest_locations:
+        telemetry_info = {
+            sensor_name: sensor_data
+            for sensor_name, sensor_data in tracking.telemetry.items()
+            if sensor_data.get('category') in MAP_TELEMETRY_CATEGORIES
+        }
+
+        map_data.append({
+            'device_id': tracking.device.id,
+            'unit_id': tracking.device.unit_id,
+            'device_name': tracking.device.name or tracking.device.unit_id,
+            'latitude': float(tracking.latitude),
+            'longitude': float(tracking.longitude),
+            'speed': tracking.speed or 0,
+            'heading': tracking.heading or 0,
+            'timestamp': tracking.timestamp.isoformat(),
+            'is_active': tracking.device.is_active,
+            'telemetry': telemetry_info
+        })
+    return map_data
@@ -0,0 +1,141 @@
+"""
+In-process publish/subscribe feed behind the /api/live/stream Server-Sent Events endpoint
+
+The ingest path publishes position and webhook message events after its
+transaction commits. Every subscriber (one per open browser tab) gets a
+bounded queue; a subscriber that falls behind and fills its queue is dropped
+with a final 'resync' event instead of slowing down ingest or growing memory,
+and the browser reconnects and reloads its snapshot.
+
+Events only reach clients connected to the same process, and every stream
+holds a worker while it is open, so the endpoint is off unless
+LIVE_FEED_ENABLED is set; enable it with gunicorn threads (e.g.
+--worker-class gthread --threads 8) rather than several sync processes.
+"""
+
+import json
+import logging
+import queue
+import threading
+
+class LiveFeedFull(Exception):
+    """Raised when the maximum number of live clients is connected"""
+
+class Subscription:
+    """Bounded event queue of one connected client"""
+
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+
+    def get(self, timeout):
+        """Next encoded event, '' on timeout, None once the subscription is closed"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return ''
+
+    def close(self, final_message=None):
+        """Discard pending events and end the stream after final_message"""
+        self.closed = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        if final_message:
+            self.queue.put_nowait(final_message)
+        self.queue.put_nowait(None)
+
+def encode_event(event, data):
+    """Server-Sent Events wire format"""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'), default=str)}\n\n"
+
+class LiveFeed:
+    """Fan-out of events to a bounded set of subscribers with bounded queues"""
+
+    def __init__(self, max_clients=50, max_queue=100):
+        self.max_clients = max_clients
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.dropped_clients = 0
+        self.rejected_clients = 0
+
+    def subscribe(self):
+        """Register a client, raises LiveFeedFull when max_clients are connected"""
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                self.rejected_clients += 1
+                raise LiveFeedFull()
+            subscription = Subscription(self.max_queue + 2)
+            self._subscribers.add(subscription)
+            return subscription
+
+    @property
+    def active(self):
+        """True while at least one client is connected"""
+        return bool(self._subscribers)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event, data):
+        """Send an event to every subscriber; slow subscribers are dropped"""
+        with self._lock:
+            if not self._subscribers:
+                return
+            message = encode_event(event, data)
+            self.published += 1
+            for subscription in list(self._subscribers):
+                # Two slots are reserved for the resync event and the end marker
+                if subscription.queue.qsize() < self.max_queue:
+                    subscription.queue.put_nowait(message)
+                    self.delivered += 1
+                else:
+                    self._subscribers.discard(subscription)
+                    subscription.close(encode_event('resync', {'reason': 'slow consumer'}))
+                    self.dropped_clients += 1
+                    logging.info("Dropped slow live feed client")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._subscribers),
+                'max_clients': self.max_clients,
+                'max_queue': self.max_queue,
+                'published': self.published,
+                'delivered': self.delivered,
+                'dropped_clients': self.dropped_clients,
+                'rejected_clients': self.rejected_clients,
+            }
+
+# Process-wide feed, sized from the app config on first use
+_live_feed = None
+
+def get_live_feed():
+    """Return the process-wide live feed"""
+    global _live_feed
+    if _live_feed is None:
+        from app import app
+        _live_feed = LiveFeed(
+            max_clients=app.config["LIVE_FEED_MAX_CLIENTS"],
+            max_queue=app.config["LIVE_FEED_QUEUE_SIZE"],
+        )
+    return _live_feed
+
+def message_event(log_entry):
+    """Event payload for a flushed WebhookLog row"""
+    return {
+        'id': log_entry.id,
+        'timestamp': log_entry.timestamp.isoformat() if log_entry.timestamp else None,
+        'endpoint': log_entry.endpoint,
+        'status_code': log_entry.status_code,
+        'content_length': log_entry.content_length,
+        'remote_addr': log_entry.remote_addr,
+        'processing_time_ms': log_entry.processing_time_ms,
+        'error_message': (log_entry.error_message or '')[:200] or None,
+    }
@@ -0,0 +1,382 @@
+"""
+In-memory rolling ingest counters for the dashboard, live messages and health views
+
+Requests (received / succeeded / failed), stored points and duplicate points
+dropped by idempotent ingest are counted in a ring of per-minute buckets
+covering seven days. A running total is kept for each reporting window and
+buckets are subtracted as they age out, so reading a window is O(1) instead
+of a COUNT(*) over WebhookLog or TrackingData.
+Points per device are kept in hourly buckets for the 7-day top-N.
+
+Counts are by server receive time. Each process counts the requests it
+handles and saves its counters to its own metrics_snapshot row every
+METRICS_PERSIST_SECONDS and at shutdown; window() adds the other workers'
+saved rows, so views see all workers. Rows of processes that exited are
+merged into a running process's row, so a restart doesn't zero them.
+"""
+
+import atexit
+import heapq
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy.exc import SQLAlchemyError
+
+# Reporting windows in minutes
+WINDOWS = {
+    '5m': 5,
+    '1h': 60,
+    '24h': 1440,
+    '7d': 10080,
+}
+
+BUCKET_MINUTES = WINDOWS['7d']
+DEVICE_BUCKET_HOURS = BUCKET_MINUTES // 60
+
+# Counter positions inside a bucket
+FIELDS = ('received', 'succeeded', 'failed', 'points', 'duplicates')
+RECEIVED, SUCCEEDED, FAILED, POINTS, DUPLICATES = range(len(FIELDS))
+
+class RollingCounters:
+    """Per-minute request/point counters with O(1) windowed totals"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = [[0] * len(FIELDS) for _ in range(BUCKET_MINUTES)]
+        self._totals = {window: [0] * len(FIELDS) for window in WINDOWS}
+        self._device_buckets = [Counter() for _ in range(DEVICE_BUCKET_HOURS)]
+        self._device_totals = Counter()
+        self._minute = int(time.time() // 60)
+
+    def _advance(self, minute):
+        """Expire buckets up to minute (lock held)"""
+        if minute <= self._minute:
+            return
+        if minute - self._minute >= BUCKET_MINUTES:
+            # Idle for longer than the longest window
+            self._reset(minute)
+            return
+
+        for step in range(self._minute + 1, minute + 1):
+            # Buckets leaving each window are subtracted before their slot is reused
+            for window, minutes in WINDOWS.items():
+                leaving = self._buckets[(step - minutes) % BUCKET_MINUTES]
+                totals = self._totals[window]
+                for i in range(len(FIELDS)):
+                    totals[i] -= leaving[i]
+            self._buckets[step % BUCKET_MINUTES] = [0] * len(FIELDS)
+
+            if step % 60 == 0:
+                hour_slot = (step // 60) % DEVICE_BUCKET_HOURS
+                self._device_totals.subtract(self._device_buckets[hour_slot])
+                self._device_totals += Counter()  # drop zero counts
+                self._device_buckets[hour_slot] = Counter()
+        self._minute = minute
+
+    def _reset(self, minute):
+        self._buckets = [[0] * len(FIELDS) for _ in range(BUCKET_MINUTES)]
+        self._totals = {window: [0] * len(FIELDS) for window in WINDOWS}
+        self._device_buckets = [Counter() for _ in range(DEVICE_BUCKET_HOURS)]
+        self._device_totals = Counter()
+        self._minute = minute
+
+    def _add(self, field, amount):
+        self._buckets[self._minute % BUCKET_MINUTES][field] += amount
+        for totals in self._totals.values():
+            totals[field] += amount
+
+    def record_request(self, status_code):
+        """Count one webhook request by its response status"""
+        with self._lock:
+            self._advance(int(time.time() // 60))
+            self._add(RECEIVED, 1)
+            self._add(SUCCEEDED if status_code == 200 else FAILED, 1)
+
+    def record_points(self, points_by_unit):
+        """Count stored points, given as {unit_id: points}"""
+        with self._lock:
+            self._advance(int(time.time() // 60))
+            self._add(POINTS, sum(points_by_unit.values()))
+            self._device_buckets[(self._minute // 60) % DEVICE_BUCKET_HOURS].update(points_by_unit)
+            self._device_totals.update(points_by_unit)
+
+    def record_duplicates(self, count):
+        """Count points dropped as already stored"""
+        with self._lock:
+            self._advance(int(time.time() // 60))
+            self._add(DUPLICATES, count)
+
+    def window(self, name):
+        """Totals for one window ('5m', '1h', '24h', '7d') as a dict"""
+        with self._lock:
+            self._advance(int(time.time() // 60))
+            return dict(zip(FIELDS, self._totals[name]))
+
+    def top_devices(self, limit=10):
+        """Most active devices over 7 days as [(unit_id, points)]"""
+        with self._lock:
+            self._advance(int(time.time() // 60))
+            return heapq.nlargest(limit, self._device_totals.items(), key=lambda item: item[1])
+
+    def hourly_points(self, hours=24):
+        """Points per hour for the last hours, oldest first, as [(hour_start_epoch, points)]"""
+        with self._lock:
+            self._advance(int(time.time() // 60))
+            current_hour = self._minute // 60
+            result = []
+            for hour in range(current_hour - hours + 1, current_hour + 1):
+                first_minute = max(hour * 60, self._minute - BUCKET_MINUTES + 1)
+                last_minute = min(hour * 60 + 59, self._minute)
+                points = sum(self._buckets[minute % BUCKET_MINUTES][POINTS]
+                             for minute in range(first_minute, last_minute + 1))
+                result.append((hour * 3600, points))
+            return result
+
+    def to_dict(self):
+        """Serialisable snapshot"""
+        with self._lock:
+            self._advance(int(time.time() // 60))
+            return {
+                'minute': self._minute,
+                'buckets': {
+                    str(minute): self._buckets[minute % BUCKET_MINUTES]
+                    for minute in range(self._minute - BUCKET_MINUTES + 1, self._minute + 1)
+                    if any(self._buckets[minute % BUCKET_MINUTES])
+                },
+                'device_buckets': {
+                    str(hour): dict(self._device_buckets[hour % DEVICE_BUCKET_HOURS])
+                    for hour in range(self._minute // 60 - DEVICE_BUCKET_HOURS + 1, self._minute // 60 + 1)
+                    if self._device_buckets[hour % DEVICE_BUCKET_HOURS]
+                },
+            }
+
+    def load_dict(self, snapshot):
+        """Restore a snapshot taken by to_dict, expiring what aged out since"""
+        with self._lock:
+            self._reset(int(time.time() // 60))
+        self.merge_dict(snapshot)
+
+    def merge_dict(self, snapshot):
+        """Add the counts of a snapshot taken by to_dict (of this or another process)"""
+        with self._lock:
+            self._advance(int(time.time() // 60))
+            for minute, counts in snapshot.get('buckets', {}).items():
+                minute = int(minute)
+                if not self._minute - BUCKET_MINUTES < minute <= self._minute:
+                    continue
+                # Snapshots from before a field was added lack its count
+                counts = list(counts) + [0] * (len(FIELDS) - len(counts))
+                bucket = self._buckets[minute % BUCKET_MINUTES]
+                for i in range(len(FIELDS)):
+                    bucket[i] += counts[i]
+                for window, minutes in WINDOWS.items():
+                    if minute > self._minute - minutes:
+                        totals = self._totals[window]
+                        for i in range(len(FIELDS)):
+                            totals[i] += counts[i]
+            current_hour = self._minute // 60
+            for hour, devices in snapshot.get('device_buckets', {}).items():
+                hour = int(hour)
+                if current_hour - DEVICE_BUCKET_HOURS < hour <= current_hour:
+                    self._device_buckets[hour % DEVICE_BUCKET_HOURS].update(devices)
+                    self._device_totals.update(devices)
+
+# Process-wide counters
+counters = RollingCounters()
+
+SNAPSHOT_PREFIX = 'rolling_counters'
+
+def _host():
+    # Bounded so the row name fits the 64-character key with the pid
+    return socket.gethostname()[:32]
+
+def snapshot_name():
+    """metrics_snapshot row of this process: every worker saves its own counters"""
+    return f"{SNAPSHOT_PREFIX}:{_host()}:{os.getpid()}"
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _orphaned(snapshot, stale_before):
+    """Whether a snapshot row's process is gone: its pid is dead on this host, or it stopped saving"""
+    parts = snapshot.name.split(':')
+    if len(parts) != 3:
+        # The single row written before snapshots were kept per process
+        return True
+    _, host, pid = parts
+    if host == _host() and pid.isdigit() and not _process_alive(int(pid)):
+        return True
+    return snapshot.saved_at is None or snapshot.saved_at < stale_before
+
+def _merge_row(target, snapshot):
+    try:
+        target.merge_dict(json.loads(snapshot.data or '{}'))
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Ignoring unreadable metrics snapshot {snapshot.name}: {e}")
+
+def save_snapshot(stale_seconds=None):
+    """Persist this process's counters, taking over the rows of processes that have exited
+
+    An orphaned row is deleted and its counts saved in this process's row in
+    the same transaction, so each count stays in exactly one row. Rows saved
+    within stale_seconds are only taken over when their pid is gone from this
+    host. Returns the number of rows taken over.
+    """
+    from app import app, db
+    from models import MetricsSnapshot
+    from datetime import datetime, timedelta
+
+    if stale_seconds is None:
+        stale_seconds = 3 * app.config["METRICS_PERSIST_SECONDS"]
+    name = snapshot_name()
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=stale_seconds)
+    try:
+        claimed = RollingCounters()
+        claimed_rows = 0
+        others = MetricsSnapshot.query.filter(
+            MetricsSnapshot.name != name,
+            MetricsSnapshot.name.startswith(SNAPSHOT_PREFIX)
+        ).all()
+        for other in others:
+            if not _orphaned(other, stale_before):
+                continue
+            # Only the process whose delete matched the row it read takes it over
+            deleted = db.session.execute(
+                db.delete(MetricsSnapshot)
+                .where(MetricsSnapshot.name == other.name, MetricsSnapshot.saved_at == other.saved_at)
+            ).rowcount
+            if deleted:
+                _merge_row(claimed, other)
+                claimed_rows += 1
+
+        data = counters.to_dict()
+        if claimed_rows:
+            combined = RollingCounters()
+            combined.merge_dict(data)
+            combined.merge_dict(claimed.to_dict())
+            data = combined.to_dict()
+
+        snapshot = db.session.get(MetricsSnapshot, name)
+        if snapshot is None:
+            snapshot = MetricsSnapshot(name=name)
+            db.session.add(snapshot)
+        snapshot.data = json.dumps(data, separators=(',', ':'))
+        snapshot.saved_at = now
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if claimed_rows:
+        # Counted here from now on; the other processes' view drops the deleted rows
+        counters.merge_dict(claimed.to_dict())
+        _peers.invalidate()
+    return claimed_rows
+
+def load_snapshot():
+    """Restore the counters of processes that ran before this one, if any"""
+    from app import db
+    from models import MetricsSnapshot
+
+    # A row under this process's own name is left from an earlier process with the same pid
+    previous = db.session.get(MetricsSnapshot, snapshot_name())
+    if previous is not None:
+        _merge_row(counters, previous)
+    return save_snapshot() > 0 or previous is not None
+
+class PeerCounters:
+    """Sum of the rows saved by the other processes, reread at most every max_age seconds"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = RollingCounters()
+        self._loaded_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def get(self, max_age):
+        from app import db
+        from models import MetricsSnapshot
+
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < max_age:
+                return self._counters
+            combined = RollingCounters()
+            try:
+                rows = MetricsSnapshot.query.filter(
+                    MetricsSnapshot.name != snapshot_name(),
+                    MetricsSnapshot.name.startswith(SNAPSHOT_PREFIX)
+                ).all()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                logging.warning(f"Could not read other processes' metrics snapshots: {e}")
+                return self._counters
+            for row in rows:
+                _merge_row(combined, row)
+            self._counters = combined
+            self._loaded_at = time.monotonic()
+            return combined
+
+_peers = PeerCounters()
+
+def window(name):
+    """Totals for one window across all processes: this one's live counters plus the others' last saves"""
+    from app import app
+
+    totals = counters.window(name)
+    peers = _peers.get(app.config["METRICS_PERSIST_SECONDS"]).window(name)
+    return {field: totals[field] + peers[field] for field in FIELDS}
+
+class SnapshotWriter:
+    """Daemon thread saving the counters periodically and once more at exit"""
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-snapshot', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._save()
+
+    def _save(self):
+        with self.app.app_context():
+            try:
+                save_snapshot()
+            except Exception as e:
+                logging.error(f"Failed to save metrics snapshot: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._save()
+
+_snapshot_writer = None
+
+def init_metrics(app):
+    """Restore saved counters and start saving them periodically"""
+    global _snapshot_writer
+    if load_snapshot():
+        logging.info("Restored rolling ingest counters")
+    _snapshot_writer = SnapshotWriter(app, app.config["METRICS_PERSIST_SECONDS"])
+    _snapshot_writer.start()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Move legacy TrackingData.telemetry_data JSON into the TelemetryValue table
+
+Rows are processed in id order in batches, each committed on its own, and
+telemetry_data is cleared once a row's readings are stored, so the tool can be
+interrupted and run again. Rows whose JSON can't be parsed are left untouched.
+Raw values the calibrated value can't reproduce are kept as text (see
+pack_telemetry), so the stored raw_value survives the move.
+
+Usage: python migrate_telemetry.py [--batch-size 1000] [--dry-run]
+"""
+
+import argparse
+import json
+import logging
+
+from sqlalchemy import insert, select, update
+
+from app import app, db
+from models import TrackingData, TelemetryValue
+from telemetry_mapping import pack_telemetry
+
+def migrate_batch(after_id, batch_size, dry_run=False):
+    """Migrate the next batch of rows after after_id, returns (last_id, migrated, readings, skipped)"""
+    rows = db.session.execute(
+        select(TrackingData.id, TrackingData.telemetry_data)
+        .where(TrackingData.id > after_id, TrackingData.telemetry_data.isnot(None))
+        .order_by(TrackingData.id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return None, 0, 0, 0
+
+    values = []
+    migrated_ids = []
+    skipped = 0
+    for tracking_id, telemetry_data in rows:
+        try:
+            telemetry = json.loads(telemetry_data)
+            readings = pack_telemetry(telemetry) if isinstance(telemetry, dict) else []
+        except (ValueError, KeyError, AttributeError) as e:
+            logging.warning(f"Skipping tracking row {tracking_id}: {e}")
+            skipped += 1
+            continue
+        migrated_ids.append(tracking_id)
+        values.extend(
+            {'tracking_id': tracking_id, 'sensor_id': sensor_id, 'value': value, 'text_value': text_value}
+            for sensor_id, value, text_value in readings
+        )
+
+    if not dry_run:
+        # Rows were already partially migrated if the previous run stopped mid-commit
+        db.session.execute(
+            TelemetryValue.__table__.delete().where(TelemetryValue.tracking_id.in_(migrated_ids))
+        )
+        if values:
+            db.session.execute(insert(TelemetryValue.__table__), values)
+        if migrated_ids:
+            db.session.execute(update(TrackingData), [
+                {'id': tracking_id, 'telemetry_data': None} for tracking_id in migrated_ids
+            ])
+        db.session.commit()
+
+    return rows[-1][0], len(migrated_ids), len(values), skipped
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true', help="parse and count without writing")
+    args = parser.parse_args()
+
+    totals = {'rows': 0, 'readings': 0, 'skipped': 0}
+    with app.app_context():
+        last_id = 0
+        while True:
+            last_id, migrated, readings, skipped = migrate_batch(last_id, args.batch_size, args.dry_run)
+            if last_id is None:
+                break
+            totals['rows'] += migrated
+            totals['readings'] += readings
+            totals['skipped'] += skipped
+            print(f"migrated {totals['rows']} rows ({totals['readings']} readings) up to id {last_id}")
+
+    action = "would migrate" if args.dry_run else "migrated"
+    print(f"Done: {action} {totals['rows']} rows, {totals['readings']} readings, skipped {totals['skipped']}")
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,8 @@ class Device(db.Model):
     last_seen = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Set on edits (not by ingest's last_seen updates) so device caches notice them
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationship with tracking data
     tracking_data = db.relationship('TrackingData', backref='device', lazy=True)
@@ -50,13 +52,18 @@ class TrackingData(db.Model):
     gps_valid = db.Column(db.Boolean, default=True)
     panic_button = db.Column(db.Boolean, default=False)
     
-    # Structured telemetry data (JSON)
-    telemetry_data = db.Column(db.Text)  # Store structured sensor data as JSON
+    # Legacy structured telemetry (JSON); new points store readings in TelemetryValue
+    telemetry_data = db.Column(db.Text)
+    telemetry_values = db.relationship('TelemetryValue', lazy='selectin',
+                                       cascade='all, delete-orphan', passive_deletes=True)
     
     # Raw data for debugging
     raw_data = db.Column(db.Text)
     data_format = db.Column(db.String(32))  # json, xml, form
     
+    # Webhook request that delivered this point
+    webhook_log_id = db.Column(db.Integer, db.ForeignKey('webhook_log.id', ondelete='SET NULL'), index=True)
+    
     # Index for performance
     __table_args__ = (
         Index('ix_tracking_data_device_timestamp', 'device_id', 'timestamp'),
@@ -65,19 +72,49 @@ class TrackingData(db.Model):
     
     @property
     def telemetry(self):
-        """Get parsed telemetry data as dict"""
+        """Get telemetry as a dict keyed by sensor name, descriptors joined from the sensor map"""
         if self.telemetry_data:
+            # Row not yet migrated by migrate_telemetry.py
             try:
                 import json
                 return json.loads(self.telemetry_data)
             except:
                 return {}
+        if self.telemetry_values:
+            from telemetry_mapping import unpack_telemetry
+            return unpack_telemetry(
+                (reading.sensor_id, reading.value, reading.text_value)
+                for reading in self.telemetry_values
+            )
         return {}
     
     def set_telemetry(self, telemetry_dict):
         """Set telemetry data from dict"""
-        import json
-        self.telemetry_data = json.dumps(telemetry_dict) if telemetry_dict else None
+        from telemetry_mapping import pack_telemetry
+        self.telemetry_data = None
+        self.telemetry_values = [
+            TelemetryValue(sensor_id=sensor_id, value=value, text_value=text_value)
+            for sensor_id, value, text_value in pack_telemetry(telemetry_dict or {})
+        ]
+
+class TelemetryValue(db.Model):
+    """One sensor reading of a tracking point, keyed by the Xirgo sensor id"""
+    tracking_id = db.Column(db.Integer, db.ForeignKey('tracking_data.id', ondelete='CASCADE'), primary_key=True)
+    sensor_id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Float)  # Calibrated value
+    text_value = db.Column(db.String(255))  # Non-numeric readings, or raw text that value can't reproduce
+    
+    # Sensor threshold queries (e.g. engine temperature above 100)
+    __table_args__ = (
+        Index('ix_telemetry_value_sensor_value', 'sensor_id', 'value'),
+    )
+
+class DeviceLatestState(db.Model):
+    """Latest positioned tracking point per device, kept current by the ingest path"""
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), primary_key=True)
+    tracking_id = db.Column(db.Integer, db.ForeignKey('tracking_data.id', ondelete='CASCADE'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)  # Point timestamp, only ever moves forward
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class WebhookLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -108,3 +145,175 @@ class ApiKey(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_used = db.Column(db.DateTime)
     usage_count = db.Column(db.Integer, default=0)
+
+class MetricsSnapshot(db.Model):
+    """Saved state of the in-memory rolling counters (see metrics.py)"""
+    name = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text)
+    saved_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class TrackingRollupHourly(db.Model):
+    """Per-device aggregates of TrackingData for one hour of point time (see rollups.py)"""
+    __tablename__ = 'tracking_rollup_hourly'
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    point_count = db.Column(db.Integer, nullable=False, default=0)
+    distance_km = db.Column(db.Float, nullable=False, default=0.0)
+    max_speed = db.Column(db.Float)
+    min_fuel = db.Column(db.Float)
+    max_fuel = db.Column(db.Float)
+    ignition_on_seconds = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Fleet-wide charts read one time range across devices
+    __table_args__ = (
+        Index('ix_tracking_rollup_hourly_bucket', 'bucket_start'),
+    )
+
+class TrackingRollupDaily(db.Model):
+    """Per-device aggregates of TrackingData for one UTC day, summed from the hourly rollup"""
+    __tablename__ = 'tracking_rollup_daily'
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    point_count = db.Column(db.Integer, nullable=False, default=0)
+    distance_km = db.Column(db.Float, nullable=False, default=0.0)
+    max_speed = db.Column(db.Float)
+    min_fuel = db.Column(db.Float)
+    max_fuel = db.Column(db.Float)
+    ignition_on_seconds = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_tracking_rollup_daily_bucket', 'bucket_start'),
+    )
+
+class RollupWatermark(db.Model):
+    """Highest TrackingData id folded into the rollups by a rollup job"""
+    name = db.Column(db.String(64), primary_key=True)
+    last_tracking_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArchivedPartition(db.Model):
+    """One month of TrackingData exported by retention.py, and how far its deletion got"""
+    month = db.Column(db.DateTime, primary_key=True)  # First instant of the month (UTC)
+    path = db.Column(db.String(512), nullable=False)
+    format = db.Column(db.String(16), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    max_tracking_id = db.Column(db.Integer)  # Rows above this id were not archived and are kept
+    deleted_count = db.Column(db.Integer, nullable=False, default=0)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime)  # Set once the archived rows are deleted
+
+class Geofence(db.Model):
+    """Polygon or circle zone that incoming points are checked against (see geofences.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(128), nullable=False)
+    kind = db.Column(db.String(16), nullable=False)  # 'polygon' or 'circle'
+    geometry = db.Column(db.Text, nullable=False)  # GeoJSON Polygon, or Point for the centre of a circle
+    radius_m = db.Column(db.Float)  # Circles only
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class GeofenceMembership(db.Model):
+    """Zones a device was inside at its newest evaluated point"""
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), primary_key=True)
+    geofence_ids = db.Column(db.Text, nullable=False, default='')  # Comma-separated Geofence ids
+    timestamp = db.Column(db.DateTime, nullable=False)  # Point timestamp, only ever moves forward
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class GeofenceEvent(db.Model):
+    """A device entering or leaving a zone, at the time of the point that crossed it"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), nullable=False)
+    geofence_id = db.Column(db.Integer, db.ForeignKey('geofence.id', ondelete='CASCADE'), nullable=False)
+    tracking_id = db.Column(db.Integer, db.ForeignKey('tracking_data.id', ondelete='SET NULL'))
+    event = db.Column(db.String(8), nullable=False)  # 'enter' or 'exit'
+    timestamp = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_geofence_event_device_timestamp', 'device_id', 'timestamp'),
+        Index('ix_geofence_event_geofence_timestamp', 'geofence_id', 'timestamp'),
+    )
+
+class Trip(db.Model):
+    """A device moving from one stop to the next, segmented on ingest (see trips.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    start_latitude = db.Column(db.Float)
+    start_longitude = db.Column(db.Float)
+    end_latitude = db.Column(db.Float)
+    end_longitude = db.Column(db.Float)
+    distance_km = db.Column(db.Float, nullable=False, default=0.0)
+    max_speed = db.Column(db.Float)
+    avg_speed = db.Column(db.Float)  # distance over duration, km/h
+    start_fuel = db.Column(db.Float)
+    end_fuel = db.Column(db.Float)
+    fuel_delta = db.Column(db.Float)  # end_fuel - start_fuel
+    point_count = db.Column(db.Integer, nullable=False, default=0)
+    start_tracking_id = db.Column(db.Integer)
+    end_tracking_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_trip_device_start', 'device_id', 'start_time'),
+    )
+
+class Stop(db.Model):
+    """A device standing still between two trips"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    duration_seconds = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_stop_device_start', 'device_id', 'start_time'),
+    )
+
+class TripSegmenterState(db.Model):
+    """Open trip or stop and reorder buffer of a device's trip segmenter, as JSON"""
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), primary_key=True)
+    state = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AlertRule(db.Model):
+    """Declarative condition on a point field or sensor, e.g. 'engine_temperature > 110 for 60s' (see alerts.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(128), nullable=False)
+    expression = db.Column(db.String(255), nullable=False)
+    severity = db.Column(db.String(16), nullable=False, default='warning')  # 'info', 'warning' or 'critical'
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class Alert(db.Model):
+    """A rule that became true for a device"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), nullable=False)
+    rule_id = db.Column(db.Integer, db.ForeignKey('alert_rule.id', ondelete='CASCADE'), nullable=False)
+    tracking_id = db.Column(db.Integer, db.ForeignKey('tracking_data.id', ondelete='SET NULL'))
+    timestamp = db.Column(db.DateTime, nullable=False)  # Point at which the condition had held long enough
+    since = db.Column(db.DateTime, nullable=False)  # First point of the condition
+    value = db.Column(db.Float)
+    severity = db.Column(db.String(16), nullable=False)
+    message = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_alert_device_timestamp', 'device_id', 'timestamp'),
+        Index('ix_alert_timestamp', 'timestamp'),
+    )
+
+class AlertState(db.Model):
+    """Rules currently true for a device and since when, as JSON"""
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), primary_key=True)
+    state = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)  # Newest evaluated point, only ever moves forward
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,313 @@
+"""
+Token-bucket rate limiting for the webhook endpoint
+
+Every client key (the client IP, or a presented API token that has its own
+RATE_LIMITS entry) has a bucket of RATE_LIMIT_PER_MINUTE tokens that refills continuously at that rate per
+minute; a request takes one token and is rejected when the bucket is empty.
+A bucket is two numbers (tokens left, last update), so a check is O(1) and
+buckets that have refilled completely are equivalent to missing ones and are
+expired lazily.
+
+Backends (RATE_LIMIT_BACKEND):
+- memory: per process, LRU-bounded dict
+- sqlite: shared by all workers on one host through RATE_LIMIT_SQLITE_PATH
+- redis: shared across hosts, any server speaking the Redis protocol at
+  RATE_LIMIT_REDIS_URL (no client library needed)
+
+Per-key limits are set with RATE_LIMITS, e.g. "ip:10.0.0.5=600,token:3f9a...=1200",
+where token keys are token_key(token) so the config holds no secrets. Backend
+errors let requests through rather than rejecting webhook traffic.
+"""
+
+import hashlib
+import logging
+import math
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlsplit
+
+RateLimitResult = namedtuple('RateLimitResult', ['allowed', 'retry_after'])
+
+def token_key(credential):
+    """Bucket key of an API token; the token itself is never stored"""
+    return 'token:' + hashlib.sha256(credential.encode('utf-8')).hexdigest()[:16]
+
+def ip_key(remote_addr):
+    return f'ip:{remote_addr}'
+
+def parse_limits(value):
+    """Parse "key=limit,key=limit" into {key: limit per minute}"""
+    limits = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        key, _, limit = item.strip().rpartition('=')
+        limits[key] = int(limit)
+    return limits
+
+def refill(tokens, updated, now, capacity, rate):
+    """Tokens in a bucket at now, given its state at updated"""
+    if tokens is None:
+        return capacity
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+def take_token(available):
+    """(tokens to store, tokens left after the request); the latter is negative when rejected"""
+    if available >= 1:
+        return available - 1, available - 1
+    return available, available - 1
+
+class MemoryBackend:
+    """Buckets in a per-process LRU dict"""
+    name = 'memory'
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        """Take one token, returns the tokens left (negative when none was available)"""
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (None, now))
+            stored, tokens = take_token(refill(tokens, updated, now, capacity, rate))
+            self._buckets[key] = (stored, now)
+            if len(self._buckets) > self.max_keys:
+                # Least recently used buckets are the likeliest to be full already
+                self._buckets.popitem(last=False)
+            return tokens
+
+    def size(self):
+        return len(self._buckets)
+
+class SqliteBackend:
+    """Buckets in a SQLite file shared by the worker processes of one host"""
+    name = 'sqlite'
+
+    # Fully refilled buckets are deleted every this many checks
+    EXPIRE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._checks = 0
+        self._connect().execute('''
+            CREATE TABLE IF NOT EXISTS rate_limit_bucket (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                full_at REAL NOT NULL
+            )
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate, now):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM rate_limit_bucket WHERE key = ?', (key,)).fetchone()
+            stored, tokens = take_token(refill(row[0] if row else None, row[1] if row else now, now, capacity, rate))
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_limit_bucket (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)',
+                (key, stored, now, now + (capacity - stored) / rate)
+            )
+            self._checks += 1
+            if self._checks % self.EXPIRE_EVERY == 0:
+                conn.execute('DELETE FROM rate_limit_bucket WHERE full_at < ?', (now,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return tokens
+
+    def size(self):
+        return self._connect().execute('SELECT COUNT(*) FROM rate_limit_bucket').fetchone()[0]
+
+class RespError(Exception):
+    """Error reply from a Redis protocol server"""
+
+class RespClient:
+    """Minimal Redis protocol (RESP2) client, one connection per thread"""
+
+    def __init__(self, url, timeout=0.5):
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.strip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn = self._local.conn = (sock, sock.makefile('rb'))
+            if self.password:
+                self.execute('AUTH', self.password)
+            if self.db:
+                self.execute('SELECT', self.db)
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def execute(self, *args):
+        """Send one command and return its reply; error replies raise RespError"""
+        sock, reader = self._connection()
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        try:
+            sock.sendall(b''.join(parts))
+            return self._read_reply(reader)
+        except (OSError, ValueError):
+            self.close()
+            raise
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by server")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode('utf-8')
+        if prefix == b'-':
+            raise RespError(payload.decode('utf-8'))
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise ValueError(f"Unexpected reply: {line!r}")
+
+class RedisBackend:
+    """Buckets in a Redis-protocol server, updated atomically by a Lua script"""
+    name = 'redis'
+
+    # KEYS[1] bucket; ARGV capacity, rate per second, now. Returns tokens left after taking one.
+    SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = capacity
+if state[1] then
+    tokens = math.min(capacity, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate)
+end
+local left = tokens - 1
+if tokens >= 1 then
+    tokens = left
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return tostring(left)
+'''
+
+    def __init__(self, url, prefix='wialon:ratelimit:'):
+        self.client = RespClient(url)
+        self.prefix = prefix
+        self._sha = hashlib.sha1(self.SCRIPT.encode('utf-8')).hexdigest()
+
+    def take(self, key, capacity, rate, now):
+        args = (1, self.prefix + key, capacity, repr(rate), repr(now))
+        try:
+            reply = self.client.execute('EVALSHA', self._sha, *args)
+        except RespError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+            reply = self.client.execute('EVAL', self.SCRIPT, *args)
+        return float(reply)
+
+    def size(self):
+        return None
+
+class RateLimiter:
+    """Token-bucket checks against a backend with per-key limits"""
+
+    def __init__(self, backend, default_limit, limits=None):
+        self.backend = backend
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.allowed = 0
+        self.rejected = 0
+        self.backend_errors = 0
+
+    def check(self, key):
+        """Take a token for key, returns RateLimitResult(allowed, retry_after seconds)"""
+        per_minute = self.limits.get(key, self.default_limit)
+        if per_minute <= 0:
+            return RateLimitResult(True, 0)
+        rate = per_minute / 60.0
+        try:
+            tokens = self.backend.take(key, per_minute, rate, time.time())
+        except Exception as e:
+            self.backend_errors += 1
+            logging.warning(f"Rate limit backend {self.backend.name} failed, allowing request: {e}")
+            return RateLimitResult(True, 0)
+
+        if tokens >= 0:
+            self.allowed += 1
+            return RateLimitResult(True, 0)
+        self.rejected += 1
+        return RateLimitResult(False, math.ceil(-tokens / rate))
+
+    def stats(self):
+        return {
+            'backend': self.backend.name,
+            'default_per_minute': self.default_limit,
+            'overrides': len(self.limits),
+            'buckets': self.backend.size(),
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'backend_errors': self.backend_errors,
+        }
+
+def create_backend(config):
+    backend = config["RATE_LIMIT_BACKEND"]
+    if backend == 'sqlite':
+        return SqliteBackend(config["RATE_LIMIT_SQLITE_PATH"])
+    if backend == 'redis':
+        return RedisBackend(config["RATE_LIMIT_REDIS_URL"])
+    if backend != 'memory':
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+    return MemoryBackend()
+
+# Process-wide limiter, built from the app config on first use
+_rate_limiter = None
+
+def get_rate_limiter():
+    """Return the process-wide rate limiter"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        from app import app
+        _rate_limiter = RateLimiter(
+            create_backend(app.config),
+            default_limit=app.config["RATE_LIMIT_PER_MINUTE"],
+            limits=parse_limits(app.config["RATE_LIMITS"]),
+        )
+    return _rate_limiter
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Retention and archival of old TrackingData by calendar month
+
+Points are kept for TRACKING_RETENTION_DAYS (0 keeps them forever). Once a
+whole month of point time is past that, its points and their telemetry are
+exported to ARCHIVE_DIR as tracking_data-YYYY-MM.csv.gz (or .parquet with
+ARCHIVE_FORMAT=parquet and pyarrow installed), the archive is recorded in
+archived_partition and the archived rows are deleted in short batches. The
+rollups are brought up to date first so the dashboard history survives, and
+each device's latest position is kept for the map. An interrupted run picks
+up where it stopped.
+
+TrackingData is not natively partitioned: TelemetryValue and
+DeviceLatestState reference tracking_data.id, which PostgreSQL can't enforce
+against a partitioned table without making the timestamp part of the key.
+Months are read and deleted as ranges of ix_tracking_data_timestamp instead.
+
+Like the rollup job, only the process holding RETENTION_LOCK_PATH (an
+advisory lock on PostgreSQL) runs it, so workers don't export the same month
+and delete the same rows at once.
+
+Usage: python retention.py [--dry-run] [--retention-days 365]
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+
+from app import app, db
+from models import TrackingData, TelemetryValue, DeviceLatestState, ArchivedPartition
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Archived TrackingData columns, followed by the telemetry as JSON
+ARCHIVE_COLUMNS = [column for column in TrackingData.__table__.columns if column.name != 'telemetry_data']
+
+def month_start(timestamp):
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+def expired_months(retention_days, now=None):
+    """Months whose every point is older than the retention period, oldest first"""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    oldest = db.session.execute(select(func.min(TrackingData.timestamp))).scalar()
+    if oldest is None:
+        return []
+
+    months = []
+    month = month_start(oldest)
+    while next_month(month) <= cutoff:
+        has_points = db.session.query(TrackingData.id)\
+            .filter(TrackingData.timestamp >= month, TrackingData.timestamp < next_month(month))\
+            .first() is not None
+        if has_points:
+            months.append(month)
+        month = next_month(month)
+    return months
+
+def _archive_record(tracking):
+    record = {column.name: getattr(tracking, column.name) for column in ARCHIVE_COLUMNS}
+    telemetry = tracking.telemetry
+    record['telemetry'] = json.dumps(telemetry, separators=(',', ':')) if telemetry else None
+    return record
+
+class CsvArchive:
+    """Gzipped CSV archive writer"""
+    format = 'csv'
+    extension = 'csv.gz'
+
+    def __init__(self, path):
+        self._file = gzip.open(path, 'wt', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([column.name for column in ARCHIVE_COLUMNS] + ['telemetry'])
+
+    def write(self, records):
+        for record in records:
+            self._writer.writerow([
+                value.isoformat() if isinstance(value, datetime) else ('' if value is None else value)
+                for value in record.values()
+            ])
+
+    def close(self):
+        self._file.close()
+
+class ParquetArchive:
+    """Parquet archive writer, requires pyarrow"""
+    format = 'parquet'
+    extension = 'parquet'
+
+    def __init__(self, path):
+        fields = []
+        for column in ARCHIVE_COLUMNS:
+            python_type = column.type.python_type
+            if python_type is bool:
+                arrow_type = pa.bool_()
+            elif python_type is int:
+                arrow_type = pa.int64()
+            elif python_type is float:
+                arrow_type = pa.float64()
+            elif python_type is datetime:
+                arrow_type = pa.timestamp('us')
+            else:
+                arrow_type = pa.string()
+            fields.append(pa.field(column.name, arrow_type))
+        fields.append(pa.field('telemetry', pa.string()))
+        self._schema = pa.schema(fields)
+        self._writer = pq.ParquetWriter(path, self._schema, compression='zstd')
+
+    def write(self, records):
+        self._writer.write_table(pa.Table.from_pylist(records, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+def archive_writer_class(archive_format):
+    if archive_format == 'parquet':
+        if pa is not None:
+            return ParquetArchive
+        logging.warning("ARCHIVE_FORMAT=parquet needs pyarrow (pip install .[archive]), writing CSV")
+    return CsvArchive
+
+def export_month(month, archive_dir, archive_format, batch_size):
+    """Write one month of points to an archive file, returns (path, format, row_count, max_tracking_id)"""
+    writer_class = archive_writer_class(archive_format)
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"tracking_data-{month:%Y-%m}.{writer_class.extension}")
+    partial_path = f"{path}.{os.getpid()}.partial"
+
+    writer = writer_class(partial_path)
+    row_count = 0
+    last_id = 0
+    try:
+        while True:
+            batch = TrackingData.query\
+                .filter(TrackingData.timestamp >= month, TrackingData.timestamp < next_month(month),
+                        TrackingData.id > last_id)\
+                .order_by(TrackingData.id)\
+                .limit(batch_size)\
+                .all()
+            if not batch:
+                break
+            writer.write([_archive_record(tracking) for tracking in batch])
+            row_count += len(batch)
+            last_id = batch[-1].id
+            db.session.expunge_all()
+    finally:
+        writer.close()
+
+    # Only a complete archive replaces an earlier attempt
+    os.replace(partial_path, path)
+    return path, writer_class.format, row_count, last_id
+
+def delete_archived(partition, batch_size):
+    """Delete a partition's archived rows in batches, keeping devices' latest positions"""
+    latest_ids = select(DeviceLatestState.tracking_id)
+    while True:
+        ids = db.session.execute(
+            select(TrackingData.id)
+            .where(TrackingData.timestamp >= partition.month,
+                   TrackingData.timestamp < next_month(partition.month),
+                   TrackingData.id <= partition.max_tracking_id,
+                   TrackingData.id.not_in(latest_ids))
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        db.session.execute(TelemetryValue.__table__.delete().where(TelemetryValue.tracking_id.in_(ids)))
+        db.session.execute(TrackingData.__table__.delete().where(TrackingData.id.in_(ids)))
+        partition.deleted_count += len(ids)
+        db.session.commit()
+
+    partition.completed_at = datetime.utcnow()
+    db.session.commit()
+
+def apply_retention(retention_days=None, dry_run=False):
+    """Archive and delete every expired month, returns [(month, archived rows, deleted rows)]"""
+    retention_days = retention_days if retention_days is not None else app.config["TRACKING_RETENTION_DAYS"]
+    if retention_days <= 0:
+        return []
+
+    months = expired_months(retention_days)
+    if dry_run:
+        return [
+            (month, db.session.query(func.count(TrackingData.id))
+                .filter(TrackingData.timestamp >= month, TrackingData.timestamp < next_month(month))
+                .scalar(), 0)
+            for month in months
+        ]
+
+    if app.config["ROLLUP_INTERVAL_SECONDS"] > 0:
+        from rollups import run_rollups
+        run_rollups()
+
+    results = []
+    for month in months:
+        partition = db.session.get(ArchivedPartition, month)
+        if partition is not None and partition.completed_at is not None:
+            continue
+        if partition is None:
+            path, archive_format, row_count, max_tracking_id = export_month(
+                month, app.config["ARCHIVE_DIR"], app.config["ARCHIVE_FORMAT"],
+                app.config["RETENTION_BATCH_SIZE"],
+            )
+            partition = ArchivedPartition(
+                month=month, path=path, format=archive_format,
+                row_count=row_count, max_tracking_id=max_tracking_id, deleted_count=0,
+            )
+            db.session.add(partition)
+            db.session.commit()
+            logging.info(f"Archived {row_count} points of {month:%Y-%m} to {path}")
+
+        delete_archived(partition, app.config["RETENTION_BATCH_SIZE"])
+        logging.info(f"Deleted {partition.deleted_count} archived points of {month:%Y-%m}")
+        results.append((month, partition.row_count, partition.deleted_count))
+    return results
+
+def retention_stats():
+    last = ArchivedPartition.query.order_by(ArchivedPartition.month.desc()).first()
+    return {
+        'retention_days': app.config["TRACKING_RETENTION_DAYS"],
+        'archived_months': ArchivedPartition.query.count(),
+        'last_archived_month': f"{last.month:%Y-%m}" if last else None,
+    }
+
+class RetentionWorker:
+    """Daemon thread applying the retention policy every interval seconds"""
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='tracking-retention', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    apply_retention()
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Retention job failed: {e}")
+
+# pg_try_advisory_lock key of the retention job
+ADVISORY_LOCK_KEY = 0x72657465
+
+_retention_worker = None
+_retention_lock = None
+
+def init_retention(app):
+    """Start the retention job when TRACKING_RETENTION_DAYS is set, unless another process runs it"""
+    global _retention_worker, _retention_lock
+    if app.config["TRACKING_RETENTION_DAYS"] <= 0:
+        return
+    from rollups import acquire_job_lock
+    _retention_lock = acquire_job_lock(app.config["RETENTION_LOCK_PATH"], ADVISORY_LOCK_KEY)
+    if _retention_lock is None:
+        logging.info("Retention job runs in another process")
+        return
+    _retention_worker = RetentionWorker(app, app.config["RETENTION_CHECK_HOURS"] * 3600)
+    _retention_worker.start()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--retention-days', type=int, help="override TRACKING_RETENTION_DAYS")
+    parser.add_argument('--dry-run', action='store_true', help="list expired months without archiving")
+    args = parser.parse_args()
+
+    with app.app_context():
+        results = apply_retention(args.retention_days, dry_run=args.dry_run)
+        for month, archived, deleted in results:
+            if args.dry_run:
+                print(f"{month:%Y-%m}: would archive {archived} points")
+            else:
+                print(f"{month:%Y-%m}: archived {archived} points, deleted {deleted}")
+        if not results:
+            print("Nothing to archive")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Hourly and daily per-device rollups of TrackingData
+
+A background job folds new TrackingData rows into tracking_rollup_hourly and
+tracking_rollup_daily: point count, distance, max speed, min/max fuel level and
+ignition-on time per device, per hour and per UTC day of point time. New rows
+are found from a high-water mark on TrackingData.id and every hour they touch
+is recomputed from its points, so late and out-of-order points are folded in
+correctly and re-running a batch gives the same result. Days are summed from
+their hours.
+
+Distance and ignition-on time between two consecutive points are credited to
+the hour of the later point. Gaps longer than ROLLUP_MAX_GAP_SECONDS don't
+count as ignition-on time.
+
+Only one process runs the job: the first to take ROLLUP_LOCK_PATH (or, on
+PostgreSQL, an advisory lock, which also covers several hosts). The other
+workers don't start the thread.
+
+The first run after upgrading works through the existing history in batches.
+Usage: python rollups.py [--rebuild] [--batch-size 5000]
+"""
+
+import argparse
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, text
+from sqlalchemy.orm import aliased
+
+from app import app, db
+from models import (Device, TrackingData, TelemetryValue, TrackingRollupHourly,
+                    TrackingRollupDaily, RollupWatermark)
+from geo import haversine_km
+from telemetry_mapping import XIRGO_SENSOR_MAP
+
+WATERMARK_NAME = 'tracking_rollup'
+
+# pg_try_advisory_lock key of the rollup job
+ADVISORY_LOCK_KEY = 0x726f6c6c
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+AGGREGATE_COLUMNS = ('point_count', 'distance_km', 'max_speed', 'min_fuel', 'max_fuel', 'ignition_on_seconds')
+
+def _sensor_id(name):
+    return next(sensor_id for sensor_id, sensor in XIRGO_SENSOR_MAP.items() if sensor['name'] == name)
+
+# Telemetry fallbacks for points without fuel_level / ignition_status columns
+FUEL_SENSOR_ID = _sensor_id('SENSOR_FUEL_LEVEL_1')
+IGNITION_SENSOR_ID = _sensor_id('SENSOR_IGNITION')
+
+def hour_floor(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def day_floor(timestamp):
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _points_select():
+    """(timestamp, latitude, longitude, speed, fuel, ignition) with telemetry fallbacks joined"""
+    fuel = aliased(TelemetryValue)
+    ignition = aliased(TelemetryValue)
+    return select(
+        TrackingData.timestamp, TrackingData.latitude, TrackingData.longitude, TrackingData.speed,
+        TrackingData.fuel_level, fuel.value, TrackingData.ignition_status, ignition.value,
+    ).outerjoin(fuel, db.and_(fuel.tracking_id == TrackingData.id, fuel.sensor_id == FUEL_SENSOR_ID))\
+     .outerjoin(ignition, db.and_(ignition.tracking_id == TrackingData.id, ignition.sensor_id == IGNITION_SENSOR_ID))
+
+def _point(row):
+    timestamp, latitude, longitude, speed, fuel_level, fuel_reading, ignition_status, ignition_reading = row
+    fuel = fuel_level if fuel_level is not None else fuel_reading
+    if ignition_status is None and ignition_reading is not None:
+        ignition_status = ignition_reading != 0
+    return timestamp, latitude, longitude, speed, fuel, bool(ignition_status)
+
+def _device_points(device_id, start, end):
+    rows = db.session.execute(
+        _points_select()
+        .where(TrackingData.device_id == device_id,
+               TrackingData.timestamp >= start, TrackingData.timestamp < end)
+        .order_by(TrackingData.timestamp, TrackingData.id)
+    ).all()
+    return [_point(row) for row in rows]
+
+def _previous_point(device_id, before):
+    row = db.session.execute(
+        _points_select()
+        .where(TrackingData.device_id == device_id, TrackingData.timestamp < before)
+        .order_by(TrackingData.timestamp.desc(), TrackingData.id.desc())
+        .limit(1)
+    ).first()
+    return _point(row) if row else None
+
+def _next_timestamp(device_id, after):
+    return db.session.execute(
+        select(func.min(TrackingData.timestamp))
+        .where(TrackingData.device_id == device_id, TrackingData.timestamp >= after)
+    ).scalar()
+
+def aggregate_hours(points, previous, max_gap_seconds):
+    """Hourly aggregates of time-ordered points, previous being the point before the first one"""
+    buckets = {}
+    for point in points:
+        timestamp, latitude, longitude, speed, fuel, _ = point
+        bucket = buckets.get(hour_floor(timestamp))
+        if bucket is None:
+            bucket = buckets[hour_floor(timestamp)] = {
+                'point_count': 0, 'distance_km': 0.0, 'max_speed': None,
+                'min_fuel': None, 'max_fuel': None, 'ignition_on_seconds': 0.0,
+            }
+
+        bucket['point_count'] += 1
+        if speed is not None:
+            bucket['max_speed'] = speed if bucket['max_speed'] is None else max(bucket['max_speed'], speed)
+        if fuel is not None:
+            bucket['min_fuel'] = fuel if bucket['min_fuel'] is None else min(bucket['min_fuel'], fuel)
+            bucket['max_fuel'] = fuel if bucket['max_fuel'] is None else max(bucket['max_fuel'], fuel)
+
+        if previous is not None:
+            prev_timestamp, prev_latitude, prev_longitude, _, _, prev_ignition = previous
+            if None not in (latitude, longitude, prev_latitude, prev_longitude):
+                bucket['distance_km'] += haversine_km(prev_latitude, prev_longitude, latitude, longitude)
+            gap = (timestamp - prev_timestamp).total_seconds()
+            if prev_ignition and 0 < gap <= max_gap_seconds:
+                bucket['ignition_on_seconds'] += gap
+        previous = point
+
+    for bucket in buckets.values():
+        bucket['ignition_on_seconds'] = int(round(bucket['ignition_on_seconds']))
+    return buckets
+
+def _hour_spans(hours):
+    """Merge hour starts into contiguous [start, end) spans"""
+    spans = []
+    for hour in sorted(hours):
+        if spans and spans[-1][1] == hour:
+            spans[-1][1] = hour + HOUR
+        else:
+            spans.append([hour, hour + HOUR])
+    return spans
+
+def refresh_hours(device_id, hours, max_gap_seconds):
+    """Recompute a device's hourly rollups for the given hours, returns the hours written"""
+    written = {}
+    for start, end in _hour_spans(hours):
+        # The first point after the span may now follow a different point
+        next_timestamp = _next_timestamp(device_id, end)
+        if next_timestamp is not None:
+            end = hour_floor(next_timestamp) + HOUR
+        buckets = aggregate_hours(
+            _device_points(device_id, start, end),
+            _previous_point(device_id, start),
+            max_gap_seconds,
+        )
+        written.update(buckets)
+
+    if written:
+        now = datetime.utcnow()
+        _upsert(TrackingRollupHourly, [
+            {'device_id': device_id, 'bucket_start': bucket_start, 'updated_at': now, **bucket}
+            for bucket_start, bucket in written.items()
+        ])
+    return written.keys()
+
+def refresh_days(device_id, days):
+    """Recompute a device's daily rollups from its hourly rollups"""
+    now = datetime.utcnow()
+    values = []
+    for day in days:
+        totals = db.session.execute(
+            select(
+                func.sum(TrackingRollupHourly.point_count),
+                func.sum(TrackingRollupHourly.distance_km),
+                func.max(TrackingRollupHourly.max_speed),
+                func.min(TrackingRollupHourly.min_fuel),
+                func.max(TrackingRollupHourly.max_fuel),
+                func.sum(TrackingRollupHourly.ignition_on_seconds),
+            ).where(TrackingRollupHourly.device_id == device_id,
+                    TrackingRollupHourly.bucket_start >= day,
+                    TrackingRollupHourly.bucket_start < day + DAY)
+        ).one()
+        if not totals[0]:
+            continue
+        values.append({
+            'device_id': device_id, 'bucket_start': day, 'updated_at': now,
+            **dict(zip(AGGREGATE_COLUMNS, totals)),
+        })
+    _upsert(TrackingRollupDaily, values)
+
+def _upsert(model, values):
+    if not values:
+        return
+    from ingest import dialect_insert
+    stmt = dialect_insert(model).values(values)
+    if hasattr(stmt, 'on_conflict_do_update'):
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['device_id', 'bucket_start'],
+            set_={column: stmt.excluded[column] for column in AGGREGATE_COLUMNS + ('updated_at',)},
+        ))
+        return
+
+    for value in values:
+        db.session.merge(model(**value))
+
+def rollup_batch(batch_size, max_gap_seconds, settle_seconds):
+    """Fold the next batch of TrackingData rows past the high-water mark into the rollups, returns rows folded"""
+    watermark = db.session.get(RollupWatermark, WATERMARK_NAME)
+    if watermark is None:
+        watermark = RollupWatermark(name=WATERMARK_NAME, last_tracking_id=0)
+        db.session.add(watermark)
+
+    rows = db.session.execute(
+        select(TrackingData.id, TrackingData.device_id, TrackingData.timestamp, TrackingData.server_timestamp)
+        .where(TrackingData.id > watermark.last_tracking_id)
+        .order_by(TrackingData.id)
+        .limit(batch_size)
+    ).all()
+
+    # Stop at the first recent row, a transaction with a lower id may not have committed yet
+    cutoff = datetime.utcnow() - timedelta(seconds=settle_seconds)
+    settled = []
+    for row in rows:
+        if row.server_timestamp is not None and row.server_timestamp > cutoff:
+            break
+        settled.append(row)
+    if not settled:
+        db.session.rollback()
+        return 0
+
+    hours_by_device = defaultdict(set)
+    for row in settled:
+        hours_by_device[row.device_id].add(hour_floor(row.timestamp))
+
+    for device_id, hours in hours_by_device.items():
+        written = refresh_hours(device_id, hours, max_gap_seconds)
+        refresh_days(device_id, {day_floor(hour) for hour in written})
+
+    watermark.last_tracking_id = settled[-1].id
+    watermark.updated_at = datetime.utcnow()
+    db.session.commit()
+    return len(settled)
+
+def run_rollups(batch_size=None, max_gap_seconds=None, settle_seconds=None):
+    """Fold all settled TrackingData rows into the rollups, returns rows folded"""
+    batch_size = batch_size or app.config["ROLLUP_BATCH_SIZE"]
+    max_gap_seconds = max_gap_seconds if max_gap_seconds is not None else app.config["ROLLUP_MAX_GAP_SECONDS"]
+    settle_seconds = settle_seconds if settle_seconds is not None else app.config["ROLLUP_SETTLE_SECONDS"]
+
+    total = 0
+    while True:
+        folded = rollup_batch(batch_size, max_gap_seconds, settle_seconds)
+        total += folded
+        if folded < batch_size:
+            return total
+
+def reset_rollups():
+    """Drop all rollup rows and the high-water mark so the next run rebuilds them"""
+    db.session.execute(TrackingRollupHourly.__table__.delete())
+    db.session.execute(TrackingRollupDaily.__table__.delete())
+    db.session.execute(RollupWatermark.__table__.delete().where(RollupWatermark.name == WATERMARK_NAME))
+    db.session.commit()
+
+def rollup_stats():
+    watermark = db.session.get(RollupWatermark, WATERMARK_NAME)
+    return {
+        'last_tracking_id': watermark.last_tracking_id if watermark else 0,
+        'updated_at': watermark.updated_at.isoformat() if watermark and watermark.updated_at else None,
+    }
+
+def hourly_point_counts(hours=24):
+    """Fleet-wide points per hour of point time for the last hours, as [(hour_start, points)]"""
+    since = hour_floor(datetime.utcnow()) - (hours - 1) * HOUR
+    return db.session.execute(
+        select(TrackingRollupHourly.bucket_start, func.sum(TrackingRollupHourly.point_count))
+        .where(TrackingRollupHourly.bucket_start >= since)
+        .group_by(TrackingRollupHourly.bucket_start)
+        .order_by(TrackingRollupHourly.bucket_start)
+    ).all()
+
+def top_devices(days=7, limit=10):
+    """Devices with the most points over the last days, as [(unit_id, points)]"""
+    since = day_floor(datetime.utcnow()) - (days - 1) * DAY
+    points = func.sum(TrackingRollupDaily.point_count)
+    return db.session.execute(
+        select(Device.unit_id, points)
+        .join(TrackingRollupDaily, TrackingRollupDaily.device_id == Device.id)
+        .where(TrackingRollupDaily.bucket_start >= since)
+        .group_by(Device.unit_id)
+        .order_by(points.desc())
+        .limit(limit)
+    ).all()
+
+class RollupWorker:
+    """Daemon thread folding new points into the rollups every interval seconds"""
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='tracking-rollup', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    folded = run_rollups()
+                    if folded:
+                        logging.debug(f"Folded {folded} points into the rollups")
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Rollup job failed: {e}")
+
+def acquire_job_lock(lock_path, advisory_key=ADVISORY_LOCK_KEY):
+    """Lock held for the life of the process by the one running a background job, None if taken
+
+    Used by the rollup and retention jobs, each with its own file and key. The
+    lock is released when the returned object is closed or the process exits.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        connection = db.engine.connect()
+        acquired = connection.execute(text("SELECT pg_try_advisory_lock(:key)"),
+                                      {"key": advisory_key}).scalar()
+        # The session-level lock outlives the transaction; don't sit idle in one
+        connection.commit()
+        if acquired:
+            return connection
+        connection.close()
+        return None
+
+    import fcntl
+
+    lock_file = open(lock_path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+_rollup_worker = None
+_rollup_lock = None
+
+def init_rollups(app):
+    """Start the background rollup job unless ROLLUP_INTERVAL_SECONDS is 0 or another process runs it"""
+    global _rollup_worker, _rollup_lock
+    if app.config["ROLLUP_INTERVAL_SECONDS"] <= 0:
+        return
+    _rollup_lock = acquire_job_lock(app.config["ROLLUP_LOCK_PATH"])
+    if _rollup_lock is None:
+        logging.info("Rollup job runs in another process")
+        return
+    _rollup_worker = RollupWorker(app, app.config["ROLLUP_INTERVAL_SECONDS"])
+    _rollup_worker.start()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--rebuild', action='store_true', help="drop the rollups and rebuild them from all points")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.rebuild:
+            reset_rollups()
+        folded = run_rollups(batch_size=args.batch_size)
+        print(f"Done: folded {folded} points, high-water mark {rollup_stats()['last_tracking_id']}")
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,63 @@
-from flask import render_template, request, jsonify, redirect, url_for, flash
+from flask import render_template, request, jsonify, redirect, url_for, flash, Response
 from flask_login import login_required, current_user
 from app import app, db
-from models import Device, TrackingData, WebhookLog, ApiKey
-from webhook_parser import parse_wialon_data
+from models import Device, TrackingData, WebhookLog, ApiKey, Geofence, GeofenceEvent, Trip, Stop, AlertRule, Alert
+from webhook_parser import parse_wialon_data, has_tracking_record, WebhookPayload
+from ingest import store_tracking_entries, on_commit
+from ingest_queue import get_ingest_queue, QueueFullError
+from device_cache import get_device_cache
+from latest_state import latest_state_snapshot
+from live_feed import get_live_feed, message_event, LiveFeedFull
+from webhook_log_buffer import get_webhook_log_buffer, sample_request_data, cap_error_message
+from rate_limit import get_rate_limiter, token_key, ip_key
+from dedup import get_dedup_filter
+from spatial_index import get_spatial_index
+from geofences import get_geofence_engine, zone_from_request, geofence_dict, GeofenceError
+from alerts import (get_alert_engine, get_alert_dispatcher, rule_from_request, rule_dict, alert_dict,
+                    AlertRuleError)
+import timestamps
+import metrics
+import rollups
+import retention
+import track
+import trips
 from datetime import datetime, timedelta
+from sqlalchemy.orm import joinedload
 import time
 import logging
 import hashlib
 import json
 
-# Rate limiting storage (in production, use Redis)
-rate_limit_storage = {}
+# Parsed points shown under each request on the logs page
+LOG_POINTS_PER_REQUEST = 20
 
-def check_rate_limit(ip_address):
-    """Simple rate limiting implementation"""
-    current_time = time.time()
-    minute_key = f"{ip_address}:{int(current_time // 60)}"
-    
-    if minute_key not in rate_limit_storage:
-        rate_limit_storage[minute_key] = 0
-    
-    rate_limit_storage[minute_key] += 1
-    
-    # Clean old entries
-    for key in list(rate_limit_storage.keys()):
-        if int(key.split(':')[1]) < int(current_time // 60) - 5:
-            del rate_limit_storage[key]
-    
-    return rate_limit_storage[minute_key] <= app.config["RATE_LIMIT_PER_MINUTE"]
+def rate_limit_key(auth_header, api_key):
+    """Rate limit bucket of a request: its token when RATE_LIMITS sets a limit for it, else its client IP
 
-def log_webhook_request(endpoint, method, status_code, processing_time_ms, error_message=None, request_data_sample=None):
-    """Log webhook request for monitoring"""
-    log_entry = WebhookLog(
+    All retranslators share WEBHOOK_AUTH_TOKEN, so a token bucket by default
+    would make every client draw from one limit.
+    """
+    credential = api_key or auth_header
+    if credential:
+        for scheme in ('Bearer ', 'Token '):
+            if credential.startswith(scheme):
+                credential = credential[len(scheme):]
+                break
+        key = token_key(credential)
+        if key in get_rate_limiter().limits:
+            return key
+    return ip_key(request.remote_addr)
+
+def rate_limited_response(retry_after, processing_time_ms):
+    log_webhook_request('/webhook/wialon', 'POST', 429, processing_time_ms, "Rate limit exceeded")
+    response = jsonify({"error": "Rate limit exceeded"})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def build_webhook_log(endpoint, method, status_code, processing_time_ms, error_message=None, request_data_sample=None):
+    """WebhookLog for the current request with its body sampled, not yet added to the session"""
+    return WebhookLog(
+        timestamp=datetime.utcnow(),
         endpoint=endpoint,
         method=method,
         content_type=request.content_type,
@@ -40,39 +66,45 @@ def log_webhook_request(endpoint, method, status_code, processing_time_ms, error
         user_agent=request.headers.get('User-Agent', ''),
         status_code=status_code,
         processing_time_ms=processing_time_ms,
-        error_message=error_message,
-        request_data_sample=request_data_sample
+        error_message=cap_error_message(error_message),
+        request_data_sample=sample_request_data(status_code, request_data_sample)
     )
+
+def publish_webhook_log(log_entry):
+    """Count a log entry and send it to live clients once the current transaction commits"""
+    status_code = log_entry.status_code
+    on_commit(lambda: metrics.counters.record_request(status_code))
+    
+    live_feed = get_live_feed()
+    if live_feed.active:
+        db.session.flush()
+        message = message_event(log_entry)
+        on_commit(lambda: live_feed.publish('message', message))
+
+def log_webhook_request(endpoint, method, status_code, processing_time_ms, error_message=None, request_data_sample=None):
+    """Log webhook request for monitoring, through the write-behind buffer when enabled"""
+    log_entry = build_webhook_log(endpoint, method, status_code, processing_time_ms,
+                                  error_message, request_data_sample)
+    log_buffer = get_webhook_log_buffer()
+    if log_buffer is not None:
+        metrics.counters.record_request(status_code)
+        log_buffer.add(log_entry)
+        return
+    
     db.session.add(log_entry)
     try:
+        publish_webhook_log(log_entry)
         db.session.commit()
     except Exception as e:
         logging.error(f"Failed to log webhook request: {e}")
 
-def authenticate_webhook(auth_header, api_key_param, soap_xml_data=None):
+def authenticate_webhook(auth_header, api_key_param, soap_username=None):
     """Authenticate webhook request"""
     webhook_token = app.config["WEBHOOK_AUTH_TOKEN"]
     
-    # Check SOAP WS-Security authentication first
-    if soap_xml_data:
-        try:
-            import xml.etree.ElementTree as ET
-            
-            # Parse the SOAP XML
-            root = ET.fromstring(soap_xml_data)
-            
-            # Look for wsse:Username in the SOAP header
-            namespaces = {
-                'wsse': 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd',
-                'soapenv': 'http://schemas.xmlsoap.org/soap/envelope/'
-            }
-            
-            username_elem = root.find('.//wsse:Username', namespaces)
-            if username_elem is not None and username_elem.text == webhook_token:
-                return True
-                
-        except Exception as e:
-            logging.debug(f"SOAP authentication parsing error: {e}")
+    # Check SOAP WS-Security authentication first (username read by SoapStream)
+    if soap_username is not None and soap_username == webhook_token:
+        return True
     
     # Check Authorization header
     if auth_header:
@@ -124,21 +156,14 @@ def dashboard():
     total_devices = Device.query.count()
     active_devices = Device.query.filter_by(is_active=True).count()
     
-    # Recent tracking data (last 24 hours)
-    yesterday = datetime.utcnow() - timedelta(days=1)
-    recent_data_count = TrackingData.query.filter(TrackingData.timestamp >= yesterday).count()
+    # Points received in the last 24 hours from the rolling counters
+    recent_data_count = metrics.window('24h')['points']
     
     # Recent webhook requests
     recent_webhooks = WebhookLog.query.order_by(WebhookLog.timestamp.desc()).limit(10).all()
     
-    # Device activity (last 7 days)
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    device_activity = db.session.query(Device.unit_id, db.func.count(TrackingData.id).label('count'))\
-        .join(TrackingData)\
-        .filter(TrackingData.timestamp >= week_ago)\
-        .group_by(Device.unit_id)\
-        .order_by(db.func.count(TrackingData.id).desc())\
-        .limit(10).all()
+    # Device activity (last 7 days) from the daily rollups
+    device_activity = rollups.top_devices(days=7, limit=10)
     
     return render_template('dashboard.html',
                          total_devices=total_devices,
@@ -171,7 +196,10 @@ def edit_device(device_id):
         return redirect(url_for('devices'))
     
     device.name = new_name
+    device.updated_at = datetime.utcnow()
     db.session.commit()
+    get_device_cache().invalidate(device.unit_id)
+    get_spatial_index().rename(device.id, new_name)
     
     flash(f'Device name updated to "{new_name}"', 'success')
     return redirect(url_for('devices'))
@@ -186,26 +214,37 @@ def logs():
     logs = WebhookLog.query.order_by(WebhookLog.timestamp.desc())\
         .paginate(page=page, per_page=per_page, error_out=False)
     
-    # Get associated tracking data for each successful log entry
-    logs_with_data = []
-    for log in logs.items:
-        # Find tracking data created around the same time as this webhook
-        from datetime import timedelta
-        time_window = timedelta(seconds=30)  # 30-second window
+    # Points delivered by the logs on this page, capped per log, in one query
+    log_ids = [log.id for log in logs.items]
+    tracking_by_log = {log_id: [] for log_id in log_ids}
+    point_counts = {}
+    if log_ids:
+        point_counts = dict(db.session.query(TrackingData.webhook_log_id, db.func.count(TrackingData.id))
+                            .filter(TrackingData.webhook_log_id.in_(log_ids))
+                            .group_by(TrackingData.webhook_log_id).all())
         
-        tracking_data = TrackingData.query.filter(
-            TrackingData.timestamp >= log.timestamp - time_window,
-            TrackingData.timestamp <= log.timestamp + time_window
-        ).all()
+        numbered = db.session.query(
+            TrackingData.id,
+            db.func.row_number().over(
+                partition_by=TrackingData.webhook_log_id,
+                order_by=TrackingData.id
+            ).label('position')
+        ).filter(TrackingData.webhook_log_id.in_(log_ids)).subquery()
         
-        # Parse telemetry data for each tracking entry
+        # Telemetry readings are loaded with one more IN query and decoded only when rendered
+        tracking_data = TrackingData.query\
+            .join(numbered, numbered.c.id == TrackingData.id)\
+            .filter(numbered.c.position <= LOG_POINTS_PER_REQUEST)\
+            .options(joinedload(TrackingData.device))\
+            .order_by(TrackingData.id).all()
         for td in tracking_data:
-            td.parsed_telemetry = td.telemetry  # Use the property to get parsed telemetry
-        
-        logs_with_data.append({
-            'log': log,
-            'tracking_data': tracking_data
-        })
+            tracking_by_log[td.webhook_log_id].append(td)
+    
+    logs_with_data = [{
+        'log': log,
+        'tracking_data': tracking_by_log[log.id],
+        'point_count': point_counts.get(log.id, 0)
+    } for log in logs.items]
     
     # Create pagination-like object with the enhanced data
     class EnhancedPagination:
@@ -232,85 +271,275 @@ def logs():
 @app.route('/map')
 @login_required
 def map_view():
-    """Display interactive map with device locations"""
-    # Get latest location for each device
-    subquery = db.session.query(
-        TrackingData.device_id,
-        db.func.max(TrackingData.timestamp).label('max_timestamp')
-    ).filter(
-        TrackingData.latitude.isnot(None),
-        TrackingData.longitude.isnot(None)
-    ).group_by(TrackingData.device_id).subquery()
-    
-    latest_locations = db.session.query(TrackingData)\
-        .join(Device)\
-        .join(subquery, 
-              db.and_(TrackingData.device_id == subquery.c.device_id,
-                     TrackingData.timestamp == subquery.c.max_timestamp))\
+    """Display interactive map; markers are loaded per viewport"""
+    spatial_index = get_spatial_index()
+    spatial_index.ensure_synced()
+    return render_template('map.html', fleet=spatial_index.fleet(), fleet_bounds=spatial_index.bounds())
+
+@app.route('/api/map/latest')
+@login_required
+def map_latest():
+    """Latest position of every device, polled by the map page"""
+    return jsonify({
+        'devices': latest_state_snapshot(),
+        'generated_at': datetime.utcnow().isoformat()
+    })
+
+@app.route('/api/geofences', methods=['GET'])
+@login_required
+def list_geofences():
+    """Active zones, or all with ?all=true"""
+    query = Geofence.query
+    if request.args.get('all', '').lower() != 'true':
+        query = query.filter(Geofence.is_active.isnot(False))
+    return jsonify({'geofences': [geofence_dict(zone) for zone in query.order_by(Geofence.id).all()]})
+
+@app.route('/api/geofences', methods=['POST'])
+@login_required
+def create_geofence():
+    """Create a zone from {name, kind: polygon, geometry} or {name, kind: circle, latitude, longitude, radius_m}"""
+    try:
+        name, kind, geometry, radius_m = zone_from_request(request.get_json(silent=True) or {})
+    except GeofenceError as e:
+        return jsonify({"error": str(e)}), 400
+    zone = Geofence(name=name, kind=kind, geometry=geometry, radius_m=radius_m)
+    db.session.add(zone)
+    db.session.commit()
+    get_geofence_engine().invalidate()
+    return jsonify(geofence_dict(zone)), 201
+
+@app.route('/api/geofences/<int:geofence_id>', methods=['DELETE'])
+@login_required
+def deactivate_geofence(geofence_id):
+    """Stop evaluating a zone; its events are kept"""
+    zone = Geofence.query.get_or_404(geofence_id)
+    zone.is_active = False
+    db.session.commit()
+    get_geofence_engine().invalidate()
+    return jsonify(geofence_dict(zone))
+
+@app.route('/api/devices/<int:device_id>/geofence_events')
+@login_required
+def device_geofence_events(device_id):
+    """Most recent zone transitions of a device"""
+    device = Device.query.get_or_404(device_id)
+    limit = min(max(request.args.get('limit', default=100, type=int), 1), 1000)
+    events = db.session.query(GeofenceEvent, Geofence.name)\
+        .join(Geofence, Geofence.id == GeofenceEvent.geofence_id)\
+        .filter(GeofenceEvent.device_id == device.id)\
+        .order_by(GeofenceEvent.timestamp.desc(), GeofenceEvent.id.desc())\
+        .limit(limit)\
         .all()
-    
-    # Prepare data for map
-    map_data = []
-    for tracking in latest_locations:
-        # Parse telemetry data
-        telemetry_info = {}
-        if tracking.telemetry:
-            for sensor_name, sensor_data in tracking.telemetry.items():
-                if sensor_data.get('category') in ['gps', 'engine', 'fuel', 'power']:
-                    telemetry_info[sensor_name] = sensor_data
-        
-        map_data.append({
-            'device_id': tracking.device.id,
-            'unit_id': tracking.device.unit_id,
-            'device_name': tracking.device.name or tracking.device.unit_id,
-            'latitude': float(tracking.latitude),
-            'longitude': float(tracking.longitude),
-            'speed': tracking.speed or 0,
-            'heading': tracking.heading or 0,
-            'timestamp': tracking.timestamp.isoformat(),
-            'is_active': tracking.device.is_active,
-            'telemetry': telemetry_info
-        })
-    
-    return render_template('map.html', map_data=map_data)
+    return jsonify({'events': [
+        {
+            'geofence_id': event.geofence_id,
+            'geofence_name': name,
+            'event': event.event,
+            'timestamp': event.timestamp.isoformat(),
+            'tracking_id': event.tracking_id,
+        }
+        for event, name in events
+    ]})
 
-@app.route('/live-messages')
+@app.route('/api/alert_rules', methods=['GET'])
 @login_required
-def live_messages():
-    """Live webhook message viewer"""
-    from datetime import datetime, timedelta
-    
-    # Statistics for last 5 minutes
-    five_minutes_ago = datetime.utcnow() - timedelta(minutes=5)
-    
-    total_recent = WebhookLog.query.filter(WebhookLog.timestamp >= five_minutes_ago).count()
-    successful = WebhookLog.query.filter(
-        WebhookLog.timestamp >= five_minutes_ago, 
-        WebhookLog.status_code == 200
-    ).count()
-    failed = total_recent - successful
+def list_alert_rules():
+    """Active alert rules, or all with ?all=true"""
+    query = AlertRule.query
+    if request.args.get('all', '').lower() != 'true':
+        query = query.filter(AlertRule.is_active.isnot(False))
+    return jsonify({'rules': [rule_dict(rule) for rule in query.order_by(AlertRule.id).all()]})
+
+@app.route('/api/alert_rules', methods=['POST'])
+@login_required
+def create_alert_rule():
+    """Create a rule from {name, expression, severity}, e.g. 'engine_temperature > 110 for 60s'"""
+    try:
+        name, expression, severity = rule_from_request(request.get_json(silent=True) or {})
+    except AlertRuleError as e:
+        return jsonify({"error": str(e)}), 400
+    rule = AlertRule(name=name, expression=expression, severity=severity)
+    db.session.add(rule)
+    db.session.commit()
+    get_alert_engine().invalidate()
+    return jsonify(rule_dict(rule)), 201
+
+@app.route('/api/alert_rules/<int:rule_id>', methods=['DELETE'])
+@login_required
+def deactivate_alert_rule(rule_id):
+    """Stop evaluating a rule; its alerts are kept"""
+    rule = AlertRule.query.get_or_404(rule_id)
+    rule.is_active = False
+    db.session.commit()
+    get_alert_engine().invalidate()
+    return jsonify(rule_dict(rule))
+
+@app.route('/api/alerts')
+@login_required
+def list_alerts():
+    """Most recent alerts, of one device with ?device_id="""
+    limit = min(max(request.args.get('limit', default=100, type=int), 1), 1000)
+    query = db.session.query(Alert, AlertRule.name, Device.unit_id)\
+        .join(AlertRule, AlertRule.id == Alert.rule_id)\
+        .join(Device, Device.id == Alert.device_id)
+    device_id = request.args.get('device_id', type=int)
+    if device_id is not None:
+        query = query.filter(Alert.device_id == device_id)
+    alerts = query.order_by(Alert.timestamp.desc(), Alert.id.desc()).limit(limit).all()
+    return jsonify({'alerts': [alert_dict(alert, rule_name, unit_id) for alert, rule_name, unit_id in alerts]})
+
+@app.route('/api/devices/<int:device_id>/trips')
+@login_required
+def device_trips(device_id):
+    """Trips and stops of a device starting in [from, to), newest first, and whether it is on a trip now"""
+    device = Device.query.get_or_404(device_id)
+    end = track.parse_time(request.args.get('to')) or datetime.utcnow()
+    start = track.parse_time(request.args.get('from')) or end - timedelta(days=7)
+    limit = min(max(request.args.get('limit', default=100, type=int), 1), 1000)
+    
+    trip_rows = Trip.query\
+        .filter(Trip.device_id == device.id, Trip.start_time >= start, Trip.start_time < end)\
+        .order_by(Trip.start_time.desc())\
+        .limit(limit)\
+        .all()
+    stop_rows = Stop.query\
+        .filter(Stop.device_id == device.id, Stop.start_time >= start, Stop.start_time < end)\
+        .order_by(Stop.start_time.desc())\
+        .limit(limit)\
+        .all()
+    return jsonify({
+        'device_id': device.id,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'trips': [trips.trip_dict(trip) for trip in trip_rows],
+        'stops': [trips.stop_dict(stop) for stop in stop_rows],
+        'current': trips.device_phase(device.id),
+    })
+
+@app.route('/api/map/viewport')
+@login_required
+def map_viewport():
+    """Devices inside bbox=west,south,east,north, clustered when there are more than MAP_MAX_MARKERS"""
+    try:
+        west, south, east, north = (float(value) for value in request.args.get('bbox', '').split(','))
+    except ValueError:
+        return jsonify({"error": "bbox must be west,south,east,north"}), 400
+    zoom = request.args.get('zoom', default=10, type=int)
+
+    spatial_index = get_spatial_index()
+    spatial_index.ensure_synced()
+    result = spatial_index.viewport(west, south, east, north, zoom)
+    result['generated_at'] = datetime.utcnow().isoformat()
+    return jsonify(result)
+
+@app.route('/api/map/nearest')
+@login_required
+def map_nearest():
+    """The k devices closest to lat/lon"""
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    if latitude is None or longitude is None:
+        return jsonify({"error": "lat and lon are required"}), 400
+    k = min(max(request.args.get('k', default=5, type=int), 1), 100)
+
+    spatial_index = get_spatial_index()
+    spatial_index.ensure_synced()
+    return jsonify({'devices': spatial_index.nearest(latitude, longitude, k)})
+
+@app.route('/api/devices/<int:device_id>/track')
+@login_required
+def device_track(device_id):
+    """Simplified track of a device as an encoded polyline, paged with next_cursor"""
+    device = Device.query.get_or_404(device_id)
+    end = track.parse_time(request.args.get('to')) or datetime.utcnow()
+    start = track.parse_time(request.args.get('from')) or end - timedelta(days=1)
+    try:
+        result = track.simplified_track(
+            device.id, start, end,
+            tolerance=request.args.get('tolerance', type=float),
+            zoom=request.args.get('zoom', type=int),
+            pixels=app.config["TRACK_PIXEL_TOLERANCE"],
+            cursor=request.args.get('cursor'),
+            max_points=app.config["TRACK_MAX_POINTS"],
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result)
+
+@app.route('/api/live/stream')
+@login_required
+def live_stream():
+    """Server-Sent Events stream of committed positions and webhook messages"""
+    if not app.config["LIVE_FEED_ENABLED"]:
+        return jsonify({"error": "Live feed is disabled"}), 404
+    live_feed = get_live_feed()
+    try:
+        subscription = live_feed.subscribe()
+    except LiveFeedFull:
+        return jsonify({"error": "Too many live clients"}), 503, {'Retry-After': '30'}
     
-    # Recent tracking data points
-    data_points = TrackingData.query.filter(TrackingData.timestamp >= five_minutes_ago).count()
+    heartbeat = app.config["LIVE_FEED_HEARTBEAT_SECONDS"]
+    stream_seconds = app.config["LIVE_FEED_STREAM_SECONDS"]
     
+    def generate():
+        # Streams are closed periodically so workers are recycled; EventSource reconnects
+        deadline = time.monotonic() + stream_seconds
+        try:
+            yield "retry: 5000\n\n"
+            while time.monotonic() < deadline:
+                message = subscription.get(timeout=heartbeat)
+                if message is None:
+                    break
+                yield message or ": keepalive\n\n"
+        finally:
+            live_feed.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def live_messages_snapshot():
+    """Counters of the last 5 minutes, the last 20 webhook requests and the last 10 points"""
+    recent = metrics.window('5m')
     stats = {
-        'total_recent': total_recent,
-        'successful': successful,
-        'failed': failed,
-        'data_points': data_points
+        'total_recent': recent['received'],
+        'successful': recent['succeeded'],
+        'failed': recent['failed'],
+        'data_points': recent['points']
     }
-    
-    # Recent messages (last 20)
     recent_messages = WebhookLog.query.order_by(WebhookLog.timestamp.desc()).limit(20).all()
-    
-    # Recent tracking data (last 10)
     recent_tracking = TrackingData.query.order_by(TrackingData.timestamp.desc()).limit(10).all()
-    
+    return stats, recent_messages, recent_tracking
+
+@app.route('/live-messages')
+@login_required
+def live_messages():
+    """Live webhook message viewer"""
+    stats, recent_messages, recent_tracking = live_messages_snapshot()
     return render_template('live_messages.html', 
                          stats=stats,
                          recent_messages=recent_messages,
                          recent_tracking=recent_tracking)
 
+@app.route('/api/live/messages')
+@login_required
+def live_messages_data():
+    """The live message viewer's snapshot, reloaded in place on resync or polled without the live feed"""
+    stats, recent_messages, recent_tracking = live_messages_snapshot()
+    return jsonify({
+        'stats': stats,
+        'messages': [message_event(msg) for msg in recent_messages],
+        'tracking': [{
+            'device_id': data.device_id,
+            'latitude': data.latitude,
+            'longitude': data.longitude,
+            'speed': data.speed,
+            'heading': data.heading,
+            'timestamp': data.timestamp.isoformat() if data.timestamp else None,
+        } for data in recent_tracking],
+    })
+
 @app.route('/webhook-data/<int:log_id>')
 @login_required
 def webhook_data(log_id):
@@ -323,39 +552,54 @@ def webhook_data(log_id):
 def wialon_webhook():
     start_time = time.time()
     
-    # Rate limiting
-    if not check_rate_limit(request.remote_addr):
-        log_webhook_request('/webhook/wialon', 'POST', 429, 0, "Rate limit exceeded")
-        return jsonify({"error": "Rate limit exceeded"}), 429
-    
-    # Authentication with detailed logging
     auth_header = request.headers.get('Authorization')
+    # Buffer the raw body first: reading request.form consumes the stream of urlencoded bodies
+    request.get_data(cache=True)
     api_key = request.args.get('api_key') or request.form.get('api_key')
     
+    # Token-bucket rate limiting per client IP, or per token with its own RATE_LIMITS entry
+    rate_limiter = get_rate_limiter()
+    limit_key = rate_limit_key(auth_header, api_key)
+    limit = rate_limiter.check(limit_key)
+    if not limit.allowed:
+        return rate_limited_response(limit.retry_after, 0)
+    
     # Log authentication details for debugging
     auth_debug = f"Auth header: {auth_header}, API key: {api_key}, All headers: {dict(request.headers)}"
     
-    # Get SOAP XML data for authentication
-    soap_xml_data = None
-    if request.content_type and 'soap+xml' in request.content_type:
-        soap_xml_data = request.get_data(as_text=True)
+    # Decode the body once; auth, log sampling and extraction all share this payload
+    payload = WebhookPayload.from_request(request)
+    
+    # Read the SOAP WS-Security header incrementally; the same pass continues into extraction
+    soap_username = None
+    if payload.is_soap:
+        try:
+            soap_username = payload.soap_stream.read_header()
+        except Exception as e:
+            logging.debug(f"SOAP authentication parsing error: {e}")
     
     # Check authentication including SOAP WS-Security
-    if not authenticate_webhook(auth_header, api_key, soap_xml_data):
+    if not authenticate_webhook(auth_header, api_key, soap_username):
         processing_time = int((time.time() - start_time) * 1000)
+        # Rejected tokens also count against the client IP, so rotating them doesn't bypass the limit
+        if limit_key != ip_key(request.remote_addr):
+            limit = rate_limiter.check(ip_key(request.remote_addr))
+            if not limit.allowed:
+                return rate_limited_response(limit.retry_after, processing_time)
         log_webhook_request('/webhook/wialon', 'POST', 401, processing_time, f"Authentication failed. {auth_debug}")
         return jsonify({"error": "Authentication required"}), 401
     
+    # Queued ingest: persist the raw body and answer before touching the database
+    if app.config["INGEST_MODE"] == "queued":
+        return enqueue_webhook_request(payload, start_time)
+    
+    request_data_sample = None
     try:
-        # Get request data sample for logging (increased limit for SOAP XML)
-        request_data_sample = ""
-        if request.data:
-            request_data_sample = request.data.decode('utf-8', errors='ignore')[:5000]  # Increased to 5000 chars
-        elif request.form:
-            request_data_sample = str(dict(request.form))[:5000]
+        # Get request data sample for logging (stored for failures and sampled successes)
+        request_data_sample = payload.sample(app.config["WEBHOOK_LOG_SAMPLE_CHARS"])
         
         # Parse the incoming data
-        parsed_data = parse_wialon_data(request)
+        parsed_data = parse_wialon_data(payload)
         
         if not parsed_data:
             processing_time = int((time.time() - start_time) * 1000)
@@ -363,62 +607,20 @@ def wialon_webhook():
                               "No valid data found in request", request_data_sample)
             return jsonify({"error": "No valid data found"}), 400
         
-        # Process each data entry
-        processed_count = 0
+        # The log row is written first so the points can reference it; both commit together
+        log_entry = build_webhook_log('/webhook/wialon', 'POST', 200, None, None, request_data_sample)
+        db.session.add(log_entry)
+        db.session.flush()
         for data_entry in parsed_data:
-            try:
-                # Get or create device
-                device = Device.query.filter_by(unit_id=data_entry['unit_id']).first()
-                if not device:
-                    device = Device(
-                        unit_id=data_entry['unit_id'],
-                        name=f"Device {data_entry['unit_id']}",
-                        device_type='Xirgo/Sensata XG3780'
-                    )
-                    db.session.add(device)
-                    db.session.flush()  # Get the ID
-                
-                # Update device last seen
-                device.last_seen = datetime.utcnow()
-                device.is_active = True
-                
-                # Create tracking data entry
-                tracking_data = TrackingData(
-                    device_id=device.id,
-                    latitude=data_entry.get('latitude'),
-                    longitude=data_entry.get('longitude'),
-                    altitude=data_entry.get('altitude'),
-                    speed=data_entry.get('speed'),
-                    heading=data_entry.get('heading'),
-                    timestamp=data_entry.get('timestamp', datetime.utcnow()),
-                    odometer=data_entry.get('odometer'),
-                    fuel_level=data_entry.get('fuel_level'),
-                    engine_hours=data_entry.get('engine_hours'),
-                    battery_voltage=data_entry.get('battery_voltage'),
-                    external_voltage=data_entry.get('external_voltage'),
-                    ignition_status=data_entry.get('ignition_status'),
-                    gps_valid=data_entry.get('gps_valid', True),
-                    panic_button=data_entry.get('panic_button', False),
-                    raw_data=data_entry.get('raw_data'),
-                    data_format=data_entry.get('data_format')
-                )
-                
-                # Save structured telemetry data if present
-                if 'telemetry' in data_entry:
-                    tracking_data.telemetry_data = json.dumps(data_entry['telemetry'])
-                
-                db.session.add(tracking_data)
-                processed_count += 1
-                
-            except Exception as e:
-                logging.error(f"Error processing data entry: {e}")
-                continue
+            data_entry['webhook_log_id'] = log_entry.id
         
-        db.session.commit()
+        # Process each data entry
+        processed_count = store_tracking_entries(parsed_data)
         
         processing_time = int((time.time() - start_time) * 1000)
-        log_webhook_request('/webhook/wialon', 'POST', 200, processing_time, 
-                          None, request_data_sample)
+        log_entry.processing_time_ms = processing_time
+        publish_webhook_log(log_entry)
+        db.session.commit()
         
         return jsonify({
             "status": "success",
@@ -437,6 +639,37 @@ def wialon_webhook():
         
         return jsonify({"error": "Internal server error"}), 500
 
+def enqueue_webhook_request(payload, start_time):
+    """Append the authenticated request body to the durable ingest queue"""
+    # Bodies without a first record naming a unit are refused; the rest is parsed by the queue worker
+    if not has_tracking_record(payload):
+        processing_time = int((time.time() - start_time) * 1000)
+        log_webhook_request('/webhook/wialon', 'POST', 400, processing_time, "No valid data found in request",
+                            payload.sample(app.config["WEBHOOK_LOG_SAMPLE_CHARS"]))
+        return jsonify({"error": "No valid data found"}), 400
+    
+    body, content_type = payload.serialized()
+    try:
+        queue_id = get_ingest_queue().enqueue(
+            body,
+            content_type=content_type,
+            remote_addr=request.remote_addr,
+            user_agent=request.headers.get('User-Agent', '')
+        )
+    except QueueFullError as e:
+        processing_time = int((time.time() - start_time) * 1000)
+        log_webhook_request('/webhook/wialon', 'POST', 503, processing_time, str(e))
+        response = jsonify({"error": "Ingest queue full, retry later"})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    processing_time = int((time.time() - start_time) * 1000)
+    return jsonify({
+        "status": "queued",
+        "queue_id": queue_id,
+        "processing_time_ms": processing_time
+    }), 200
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring"""
@@ -445,16 +678,20 @@ def health_check():
         db.session.execute(db.text('SELECT 1'))
         
         # Check recent activity
-        recent_webhooks = WebhookLog.query.filter(
-            WebhookLog.timestamp >= datetime.utcnow() - timedelta(minutes=5)
-        ).count()
+        recent_webhooks = metrics.window('5m')['received']
         
-        return jsonify({
+        health = {
             "status": "healthy",
             "timestamp": datetime.utcnow().isoformat(),
             "database": "connected",
             "recent_webhooks": recent_webhooks
-        }), 200
+        }
+        
+        queue = get_ingest_queue()
+        if queue is not None:
+            health["ingest_queue_depth"] = queue.depth()
+        
+        return jsonify(health), 200
         
     except Exception as e:
         return jsonify({
@@ -510,21 +747,52 @@ def wialon_webhook_test():
 def dashboard_stats():
     """Get real-time dashboard statistics"""
     try:
-        # Get stats for the last hour
-        hour_ago = datetime.utcnow() - timedelta(hours=1)
-        
-        hourly_data = db.session.query(
-            db.func.strftime('%H', TrackingData.timestamp).label('hour'),
-            db.func.count(TrackingData.id).label('count')
-        ).filter(
-            TrackingData.timestamp >= hour_ago
-        ).group_by(
-            db.func.strftime('%H', TrackingData.timestamp)
-        ).all()
+        # Points per hour over the last 24 hours from the hourly rollups
+        hourly_data = [
+            {"hour": hour_start.strftime('%H'), "count": count}
+            for hour_start, count in rollups.hourly_point_counts(24)
+        ]
         
         return jsonify({
-            "hourly_data": [{"hour": row.hour, "count": row.count} for row in hourly_data]
+            "hourly_data": hourly_data,
+            "windows": {window: metrics.window(window) for window in metrics.WINDOWS}
         })
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+@app.route('/api/ingest/stats')
+@login_required
+def ingest_stats():
+    """Ingest metrics: queue backpressure and device cache efficiency"""
+    stats = {
+        "mode": app.config["INGEST_MODE"],
+        "device_cache": get_device_cache().stats(),
+        "live_feed": get_live_feed().stats(),
+        "timestamps": timestamps.default_decoder.stats(),
+        "rollups": rollups.rollup_stats(),
+        "retention": retention.retention_stats(),
+        "rate_limit": get_rate_limiter().stats(),
+        "spatial_index": get_spatial_index().stats(),
+        "geofences": get_geofence_engine().stats(),
+        "trips": trips.trip_stats(),
+        "alerts": get_alert_engine().stats()
+    }
+    
+    dispatcher = get_alert_dispatcher()
+    if dispatcher is not None:
+        stats["alerts"]["delivery"] = dispatcher.stats()
+    
+    log_buffer = get_webhook_log_buffer()
+    if log_buffer is not None:
+        stats["webhook_log"] = log_buffer.stats()
+    
+    dedup_filter = get_dedup_filter()
+    if dedup_filter is not None:
+        stats["dedup"] = dedup_filter.stats()
+    
+    queue = get_ingest_queue()
+    if queue is not None:
+        stats["queue"] = queue.stats()
+    
+    return jsonify(stats)
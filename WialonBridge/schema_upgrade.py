@@ -0,0 +1,36 @@
+"""
+In-place upgrades for databases created by older versions
+
+db.create_all() creates missing tables but never alters existing ones, so
+columns added to existing models are listed here and added at startup when
+missing, together with their indexes.
+"""
+
+import logging
+from sqlalchemy import inspect, text
+from app import db
+
+# (table, column, column DDL, index name or None)
+ADDED_COLUMNS = [
+    ('tracking_data', 'webhook_log_id',
+     'INTEGER REFERENCES webhook_log (id) ON DELETE SET NULL',
+     'ix_tracking_data_webhook_log_id'),
+    ('device', 'updated_at', 'TIMESTAMP', None),
+]
+
+def upgrade_schema():
+    """Add columns missing from existing tables"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+
+    with db.engine.begin() as conn:
+        for table, column, ddl, index_name in ADDED_COLUMNS:
+            if table not in tables:
+                continue
+            existing = {col['name'] for col in inspector.get_columns(table)}
+            if column in existing:
+                continue
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+            if index_name:
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({column})'))
+            logging.info(f"Added column {table}.{column}")
@@ -0,0 +1,319 @@
+"""
+In-memory spatial index over devices' latest positions for the map
+
+Positions are bucketed into Web Mercator tiles at every zoom level from 0 to
+MAX_LEVEL, so a cell at level z + 2 is 64 screen pixels wide at zoom z. A
+viewport query looks only at the cells it covers: when they hold at most
+max_markers devices the devices are returned, otherwise one cluster per
+occupied cell. Nearest-device queries walk the tile pyramid best first. Both
+are bounded by what is on screen rather than by the fleet size.
+
+The index is loaded from DeviceLatestState on first use and kept current by
+the ingest path after each commit. Positions stored by other processes are
+picked up from DeviceLatestState every sync_seconds.
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from geo import haversine_km
+
+# Finest tile level; a level-16 tile is about 600 m wide at the equator
+MAX_LEVEL = 16
+
+# Web Mercator latitude limit
+MAX_LATITUDE = 85.0511287798
+
+# Clusters are tiles this many levels below the map zoom, i.e. 64 px wide
+CLUSTER_LEVEL_OFFSET = 2
+
+# Speed in km/h from which a device counts as moving, as on the map page
+MOVING_SPEED = 5
+
+# Rows updated this long before the last sync are read again, for late commits
+SYNC_OVERLAP = timedelta(seconds=60)
+
+def tile_xy(latitude, longitude, level):
+    """Web Mercator tile (x, y) containing a position at a level"""
+    n = 1 << level
+    latitude = min(max(latitude, -MAX_LATITUDE), MAX_LATITUDE)
+    x = int((longitude + 180.0) / 360.0 * n)
+    phi = math.radians(latitude)
+    y = int((1.0 - math.log(math.tan(phi) + 1.0 / math.cos(phi)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_bounds(x, y, level):
+    """(south, west, north, east) of a tile"""
+    n = 1 << level
+
+    def latitude(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return latitude(y + 1), x / n * 360.0 - 180.0, latitude(y), (x + 1) / n * 360.0 - 180.0
+
+def _distance_to_tile(latitude, longitude, bounds):
+    """Distance in km from a position to the closest point of a tile"""
+    south, west, north, east = bounds
+    closest_latitude = min(max(latitude, south), north)
+    if west <= longitude <= east:
+        closest_longitude = longitude
+    else:
+        to_west = (west - longitude) % 360.0
+        to_east = (longitude - east) % 360.0
+        closest_longitude = west if to_west < to_east else east
+    return haversine_km(latitude, longitude, closest_latitude, closest_longitude)
+
+class Cell:
+    """Devices in one tile and the sums of their coordinates for the cluster centre"""
+
+    __slots__ = ('devices', 'latitude_sum', 'longitude_sum')
+
+    def __init__(self):
+        self.devices = set()
+        self.latitude_sum = 0.0
+        self.longitude_sum = 0.0
+
+class SpatialIndex:
+    """Tile pyramid over the latest position of every device"""
+
+    def __init__(self, max_markers=500, sync_seconds=10):
+        self.max_markers = max_markers
+        self.sync_seconds = sync_seconds
+        self._devices = {}
+        self._levels = [{} for _ in range(MAX_LEVEL + 1)]
+        self._lock = threading.RLock()
+        self._synced_at = None
+        self._sync_time = 0
+        self.loaded = False
+        self.active = 0
+        self.moving = 0
+        self.updates = 0
+        self.syncs = 0
+
+    def _flags(self, device):
+        return (1 if device.get('is_active') else 0, 1 if (device.get('speed') or 0) > MOVING_SPEED else 0)
+
+    def _insert(self, device):
+        device_id = device['device_id']
+        latitude, longitude = device['latitude'], device['longitude']
+        x, y = tile_xy(latitude, longitude, MAX_LEVEL)
+        for level in range(MAX_LEVEL, -1, -1):
+            shift = MAX_LEVEL - level
+            key = (x >> shift, y >> shift)
+            cells = self._levels[level]
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = Cell()
+            cell.devices.add(device_id)
+            cell.latitude_sum += latitude
+            cell.longitude_sum += longitude
+        self._devices[device_id] = device
+        active, moving = self._flags(device)
+        self.active += active
+        self.moving += moving
+
+    def _remove(self, device_id):
+        device = self._devices.pop(device_id, None)
+        if device is None:
+            return None
+        x, y = tile_xy(device['latitude'], device['longitude'], MAX_LEVEL)
+        for level in range(MAX_LEVEL, -1, -1):
+            shift = MAX_LEVEL - level
+            key = (x >> shift, y >> shift)
+            cells = self._levels[level]
+            cell = cells[key]
+            cell.devices.discard(device_id)
+            if cell.devices:
+                cell.latitude_sum -= device['latitude']
+                cell.longitude_sum -= device['longitude']
+            else:
+                del cells[key]
+        active, moving = self._flags(device)
+        self.active -= active
+        self.moving -= moving
+        return device
+
+    def upsert(self, devices):
+        """Apply map position dicts; older positions than the indexed ones are ignored"""
+        with self._lock:
+            for device in devices:
+                if device.get('latitude') is None or device.get('longitude') is None:
+                    continue
+                current = self._devices.get(device['device_id'])
+                if current is not None:
+                    if device['timestamp'] < current['timestamp']:
+                        continue
+                    # Live position events don't carry the device name
+                    if 'device_name' not in device:
+                        device = dict(device, device_name=current.get('device_name'))
+                    self._remove(device['device_id'])
+                elif 'device_name' not in device:
+                    device = dict(device, device_name=device.get('unit_id'))
+                self._insert(device)
+                self.updates += 1
+
+    def rename(self, device_id, name):
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is not None:
+                self._devices[device_id] = dict(device, device_name=name)
+
+    def sync(self):
+        """Read positions updated in DeviceLatestState since the last sync (all on the first)"""
+        from latest_state import latest_state_snapshot
+
+        started = datetime.utcnow()
+        since = self._synced_at - SYNC_OVERLAP if self._synced_at is not None else None
+        devices = latest_state_snapshot(updated_since=since)
+        with self._lock:
+            self.upsert(devices)
+            self._synced_at = started
+            self._sync_time = time.monotonic()
+            self.loaded = True
+            self.syncs += 1
+
+    def ensure_synced(self):
+        if not self.loaded or time.monotonic() - self._sync_time >= self.sync_seconds:
+            self.sync()
+
+    def _cells_in(self, level, west, south, east, north):
+        """Occupied cells of a level overlapping a bounding box"""
+        cells = self._levels[level]
+        x0, y0 = tile_xy(north, west, level)
+        x1, y1 = tile_xy(south, east, level)
+        if x0 <= x1:
+            x_ranges = [(x0, x1)]
+        else:
+            # Box crossing the antimeridian
+            x_ranges = [(x0, (1 << level) - 1), (0, x1)]
+
+        covered = sum(end - start + 1 for start, end in x_ranges) * (y1 - y0 + 1)
+        if covered > len(cells):
+            return [
+                cell for (x, y), cell in cells.items()
+                if y0 <= y <= y1 and any(start <= x <= end for start, end in x_ranges)
+            ]
+        return [
+            cells[key] for start, end in x_ranges for x in range(start, end + 1) for y in range(y0, y1 + 1)
+            if (key := (x, y)) in cells
+        ]
+
+    def viewport(self, west, south, east, north, zoom):
+        """
+        Devices in a bounding box, or clusters of them when there are more than max_markers
+        Clustered counts include devices of edge cells just outside the box
+        """
+        span = east - west
+        if span >= 360.0:
+            west, east = -180.0, 180.0
+        else:
+            # Leaflet reports longitudes past +-180 once the map is panned around the world
+            west = (west + 180.0) % 360.0 - 180.0
+            east = west + span
+            if east > 180.0:
+                east -= 360.0
+        crosses = west > east
+        level = min(max(zoom + CLUSTER_LEVEL_OFFSET, 0), MAX_LEVEL)
+
+        with self._lock:
+            cells = self._cells_in(level, west, south, east, north)
+            count = sum(len(cell.devices) for cell in cells)
+            devices = []
+            clusters = []
+            if count <= self.max_markers:
+                for cell in cells:
+                    for device_id in cell.devices:
+                        device = self._devices[device_id]
+                        longitude = device['longitude']
+                        in_longitude = (west <= longitude or longitude <= east) if crosses else west <= longitude <= east
+                        if in_longitude and south <= device['latitude'] <= north:
+                            devices.append(device)
+                count = len(devices)
+            else:
+                for cell in cells:
+                    size = len(cell.devices)
+                    if size == 1:
+                        devices.append(self._devices[next(iter(cell.devices))])
+                        continue
+                    clusters.append({
+                        'latitude': cell.latitude_sum / size,
+                        'longitude': cell.longitude_sum / size,
+                        'count': size,
+                        'active': sum(1 for device_id in cell.devices if self._devices[device_id].get('is_active')),
+                    })
+            return {
+                'zoom': zoom,
+                'count': count,
+                'devices': devices,
+                'clusters': clusters,
+                'fleet': self.fleet(),
+            }
+
+    def nearest(self, latitude, longitude, k=5):
+        """The k devices closest to a position, nearest first, with distance_km"""
+        counter = itertools.count()
+        with self._lock:
+            heap = [
+                (_distance_to_tile(latitude, longitude, tile_bounds(x, y, 0)), next(counter), 0, (x, y))
+                for (x, y) in self._levels[0]
+            ]
+            heapq.heapify(heap)
+            result = []
+            while heap and len(result) < k:
+                distance, _, level, item = heapq.heappop(heap)
+                if level is None:
+                    result.append(dict(self._devices[item], distance_km=round(distance, 3)))
+                elif level == MAX_LEVEL:
+                    for device_id in self._levels[level][item].devices:
+                        device = self._devices[device_id]
+                        exact = haversine_km(latitude, longitude, device['latitude'], device['longitude'])
+                        heapq.heappush(heap, (exact, next(counter), None, device_id))
+                else:
+                    x, y = item
+                    children = self._levels[level + 1]
+                    for child in ((2 * x, 2 * y), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)):
+                        if child in children:
+                            bound = _distance_to_tile(latitude, longitude, tile_bounds(*child, level + 1))
+                            heapq.heappush(heap, (bound, next(counter), level + 1, child))
+            return result
+
+    def fleet(self):
+        with self._lock:
+            return {'total': len(self._devices), 'active': self.active, 'moving': self.moving}
+
+    def bounds(self):
+        """(south, west, north, east) around every device, None when empty"""
+        with self._lock:
+            if not self._devices:
+                return None
+            latitudes = [device['latitude'] for device in self._devices.values()]
+            longitudes = [device['longitude'] for device in self._devices.values()]
+            return min(latitudes), min(longitudes), max(latitudes), max(longitudes)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.fleet(),
+                loaded=self.loaded,
+                occupied_cells=len(self._levels[MAX_LEVEL]),
+                updates=self.updates,
+                syncs=self.syncs,
+            )
+
+# Process-wide index, built from the app config on first use
+_spatial_index = None
+
+def get_spatial_index():
+    """Return the process-wide spatial index"""
+    global _spatial_index
+    if _spatial_index is None:
+        from app import app
+        _spatial_index = SpatialIndex(
+            max_markers=app.config["MAP_MAX_MARKERS"],
+            sync_seconds=app.config["SPATIAL_INDEX_SYNC_SECONDS"],
+        )
+    return _spatial_index
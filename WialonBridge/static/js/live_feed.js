@@ -0,0 +1,55 @@
+// Live feed client shared by the dashboard, map, live message and log views
+//
+// Subscribes to /api/live/stream (Server-Sent Events) and calls handlers[eventName]
+// with the parsed JSON payload. Events: 'positions' ({points, devices: [...]}),
+// 'message' (one webhook log) and 'resync' (the server dropped this client
+// because it fell behind; reload any snapshot). EventSource reconnects by itself.
+//
+// The feed is off unless LIVE_FEED_ENABLED is set (body data-live-feed="on"); pages
+// then call fallback.poll every fallback.seconds instead, if they pass a fallback.
+
+function connectLiveFeed(handlers, fallback) {
+    if (document.body.dataset.liveFeed !== 'on' || !window.EventSource) {
+        if (fallback) {
+            setInterval(fallback.poll, fallback.seconds * 1000);
+        }
+        return null;
+    }
+
+    const source = new EventSource('/api/live/stream');
+    Object.keys(handlers).forEach(function(eventName) {
+        source.addEventListener(eventName, function(event) {
+            handlers[eventName](JSON.parse(event.data));
+        });
+    });
+    return source;
+}
+
+// Escape text before inserting it into HTML built from feed data
+function escapeHtml(value) {
+    return String(value === null || value === undefined ? '' : value)
+        .replace(/&/g, '&amp;')
+        .replace(/</g, '&lt;')
+        .replace(/>/g, '&gt;')
+        .replace(/"/g, '&quot;')
+        .replace(/'/g, '&#39;');
+}
+
+// HH:MM:SS of an ISO timestamp stored as naive UTC
+function formatFeedTime(isoTimestamp) {
+    if (!isoTimestamp) {
+        return '';
+    }
+    return isoTimestamp.substring(11, 19);
+}
+
+// Status code badge matching the server-rendered tables
+function statusBadge(statusCode) {
+    let badgeClass = 'bg-secondary';
+    if (statusCode === 200) {
+        badgeClass = 'bg-success';
+    } else if (statusCode >= 400) {
+        badgeClass = 'bg-danger';
+    }
+    return '<span class="badge ' + badgeClass + '">' + escapeHtml(statusCode) + '</span>';
+}
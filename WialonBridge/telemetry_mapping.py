@@ -3,6 +3,23 @@ Xirgo/Sensata XG3780 Telemetry Sensor Mapping
 Based on Xirgo Global documentation: https://docs.xirgoglobal.com/space/SD/27149650/Sensor+properties
 """
 
+from collections import namedtuple
+from functools import lru_cache
+from operator import attrgetter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Requests carrying at least this many telemetry values are calibrated as one NumPy batch
+BATCH_CALIBRATION_THRESHOLD = 2000
+
+def configure_batch_calibration(threshold):
+    """Set the telemetry value count from which batch calibration is used (0 disables it)"""
+    global BATCH_CALIBRATION_THRESHOLD
+    BATCH_CALIBRATION_THRESHOLD = threshold
+
 # Sensor mapping from Xirgo documentation
 XIRGO_SENSOR_MAP = {
     # Digital/Boolean Sensors (0-172)
@@ -127,6 +144,38 @@ SENSOR_CATEGORIES = {
     'comfort': ['SENSOR_AIR_CONDITIONING', 'SENSOR_WEBASTO', 'SENSOR_KEY_INSERTED'],
 }
 
+# Immutable per-sensor descriptor with everything needed to map one telemetry detail
+SensorDescriptor = namedtuple(
+    'SensorDescriptor',
+    ['sensor_id', 'name', 'unit', 'type', 'category', 'multiplier', 'offset']
+)
+
+# Sensor name -> category, built once from SENSOR_CATEGORIES (first category wins)
+SENSOR_CATEGORY_BY_NAME = {}
+for _category, _names in SENSOR_CATEGORIES.items():
+    for _name in _names:
+        SENSOR_CATEGORY_BY_NAME.setdefault(_name, _category)
+
+def _build_descriptor(sensor_id, sensor_info):
+    return SensorDescriptor(
+        sensor_id=sensor_id,
+        name=sensor_info['name'],
+        unit=sensor_info['unit'],
+        type=sensor_info['type'],
+        category=SENSOR_CATEGORY_BY_NAME.get(sensor_info['name'], 'other'),
+        multiplier=float(sensor_info['multiplier']),
+        offset=float(sensor_info['offset']),
+    )
+
+_get_multiplier = attrgetter('multiplier')
+_get_offset = attrgetter('offset')
+
+# Raw sensorCode string ('sensor8192') -> descriptor for every documented sensor
+SENSOR_DESCRIPTORS = {
+    f'sensor{sensor_id}': _build_descriptor(sensor_id, sensor_info)
+    for sensor_id, sensor_info in XIRGO_SENSOR_MAP.items()
+}
+
 def get_sensor_info(sensor_id):
     """Get sensor information by ID"""
     return XIRGO_SENSOR_MAP.get(sensor_id, {
@@ -137,22 +186,122 @@ def get_sensor_info(sensor_id):
         'offset': 0
     })
 
-def apply_sensor_calibration(sensor_id, raw_value):
-    """Apply multiplier and offset calibration to raw sensor value"""
-    sensor_info = get_sensor_info(sensor_id)
+@lru_cache(maxsize=4096)
+def _resolve_uncommon_code(sensor_code):
+    """Descriptor for codes missing from the table (undocumented ids, leading zeros)"""
+    sensor_id = parse_sensor_code(sensor_code)
+    if not sensor_id:
+        return None
+    return _build_descriptor(sensor_id, get_sensor_info(sensor_id))
+
+def get_sensor_descriptor(sensor_code):
+    """Get the descriptor for a raw sensorCode string, None if it isn't a sensor code"""
+    descriptor = SENSOR_DESCRIPTORS.get(sensor_code)
+    if descriptor is None and isinstance(sensor_code, str):
+        descriptor = _resolve_uncommon_code(sensor_code)
+    return descriptor
+
+def calibrate(descriptor, raw_value):
+    """Apply a descriptor's multiplier and offset, non-numeric values are returned unchanged"""
     try:
-        raw_val = float(raw_value)
-        calibrated = (raw_val * sensor_info['multiplier']) + sensor_info['offset']
-        return calibrated
+        return float(raw_value) * descriptor.multiplier + descriptor.offset
     except (ValueError, TypeError):
         return raw_value
 
+def calibrate_batch(descriptors, raw_values):
+    """
+    Calibrate columns of (descriptor, raw value) for a whole request with NumPy
+    Results match calibrate() value for value; non-numeric values are returned unchanged
+    """
+    count = len(raw_values)
+    if np is None or not count:
+        return [calibrate(descriptor, raw_value) for descriptor, raw_value in zip(descriptors, raw_values)]
+
+    # float() keeps the exact parsing rules of the per-value path
+    non_numeric = []
+    try:
+        values = np.fromiter(map(float, raw_values), dtype=np.float64, count=count)
+    except (ValueError, TypeError):
+        values = np.empty(count, dtype=np.float64)
+        for position, raw_value in enumerate(raw_values):
+            try:
+                values[position] = float(raw_value)
+            except (ValueError, TypeError):
+                values[position] = 0.0
+                non_numeric.append(position)
+
+    multipliers = np.fromiter(map(_get_multiplier, descriptors), dtype=np.float64, count=count)
+    offsets = np.fromiter(map(_get_offset, descriptors), dtype=np.float64, count=count)
+    calibrated = (values * multipliers + offsets).tolist()
+    for position in non_numeric:
+        calibrated[position] = raw_values[position]
+    return calibrated
+
+def apply_sensor_calibration(sensor_id, raw_value):
+    """Apply multiplier and offset calibration to raw sensor value, unchanged for ids that aren't sensors"""
+    descriptor = get_sensor_descriptor(f'sensor{sensor_id}')
+    if descriptor is None:
+        return raw_value
+    return calibrate(descriptor, raw_value)
+
+def uncalibrate(descriptor, value):
+    """Raw value recomputed from a calibrated one; rounding hides the float error of the round trip"""
+    if descriptor.multiplier == 1.0 and descriptor.offset == 0.0:
+        return value
+    return round((value - descriptor.offset) / descriptor.multiplier, 9)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def pack_telemetry(telemetry):
+    """
+    Reduce mapped telemetry ({name: {...}}) to (sensor_id, value, text_value) readings
+    Descriptor fields are not stored; non-numeric readings keep their text in text_value,
+    numeric ones keep their raw text there when it can't be recomputed exactly (e.g. '0125')
+    """
+    readings = []
+    for sensor_data in telemetry.values():
+        value = sensor_data.get('value')
+        if _is_number(value):
+            value = float(value)
+            raw_value = sensor_data.get('raw_value')
+            raw_text = None
+            descriptor = get_sensor_descriptor(f"sensor{sensor_data['sensor_id']}")
+            if raw_value is not None and descriptor is not None and not (
+                    _is_number(raw_value) and uncalibrate(descriptor, value) == raw_value):
+                raw_text = str(raw_value)[:255]
+            readings.append((sensor_data['sensor_id'], value, raw_text))
+        elif value is not None:
+            readings.append((sensor_data['sensor_id'], None, str(value)[:255]))
+    return readings
+
+def unpack_telemetry(readings):
+    """Rebuild mapped telemetry from (sensor_id, value, text_value) readings and the sensor table"""
+    telemetry = {}
+    for sensor_id, value, text_value in readings:
+        descriptor = get_sensor_descriptor(f'sensor{sensor_id}')
+        if descriptor is None:
+            continue
+        if value is None:
+            value = raw_value = text_value
+        elif text_value is not None:
+            # Raw text as received, kept because recomputing it wouldn't give it back
+            raw_value = text_value
+        else:
+            raw_value = uncalibrate(descriptor, value)
+        telemetry[descriptor.name] = {
+            'value': value,
+            'raw_value': raw_value,
+            'unit': descriptor.unit,
+            'type': descriptor.type,
+            'category': descriptor.category,
+            'sensor_id': sensor_id
+        }
+    return telemetry
+
 def get_sensor_category(sensor_name):
     """Get the category for a sensor name"""
-    for category, sensors in SENSOR_CATEGORIES.items():
-        if sensor_name in sensors:
-            return category
-    return 'other'
+    return SENSOR_CATEGORY_BY_NAME.get(sensor_name, 'other')
 
 def parse_sensor_code(sensor_code):
     """Parse sensor code from XML to extract sensor ID"""
@@ -163,4 +312,4 @@ def parse_sensor_code(sensor_code):
                 return sensor_id
             except ValueError:
                 pass
-    return None
\ No newline at end of file
+    return None
@@ -0,0 +1,59 @@
+"""
+Shared fixtures: the app running on a throwaway SQLite database
+
+app.py reads its configuration from the environment and creates its tables
+on import, so the environment is set up before the first import.
+"""
+
+import os
+import tempfile
+import uuid
+
+import pytest
+
+_data_dir = tempfile.mkdtemp(prefix='wialon-tests-')
+os.environ["DATABASE_URL"] = f"sqlite:///{_data_dir}/test.db"
+os.environ["INGEST_QUEUE_PATH"] = os.path.join(_data_dir, 'ingest_queue.db')
+os.environ["RATE_LIMIT_SQLITE_PATH"] = os.path.join(_data_dir, 'rate_limit.db')
+os.environ["ARCHIVE_DIR"] = os.path.join(_data_dir, 'archive')
+os.environ["ROLLUP_LOCK_PATH"] = os.path.join(_data_dir, 'rollup.lock')
+os.environ["RETENTION_LOCK_PATH"] = os.path.join(_data_dir, 'retention.lock')
+os.environ["WEBHOOK_AUTH_TOKEN"] = "test-webhook-token"
+os.environ["RATE_LIMIT_PER_MINUTE"] = "100000"
+
+from app import app as flask_app, db  # noqa: E402
+
+TOKEN = os.environ["WEBHOOK_AUTH_TOKEN"]
+
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        yield flask_app
+        db.session.remove()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def admin_client(app):
+    from models import User
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(User.query.filter_by(username='admin').first().id)
+        session['_fresh'] = True
+    return client
+
+@pytest.fixture
+def unit_id():
+    """Unit id no other test uses, so tests don't see each other's points"""
+    return f"T-{uuid.uuid4().hex[:12]}"
+
+def stored_points(unit_id):
+    """TrackingData rows of a unit in time order"""
+    from models import Device, TrackingData
+
+    db.session.expire_all()
+    return TrackingData.query.join(Device).filter(Device.unit_id == unit_id)\
+        .order_by(TrackingData.timestamp, TrackingData.id).all()
@@ -0,0 +1,170 @@
+"""Rule durations and re-arming, and alert delivery in batches to a local HTTP stub"""
+
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import alerts
+from alerts import AlertEngine, AlertDispatcher, WebhookNotifier, Rule, evaluate_alerts
+from conftest import db
+
+class AlertHookHandler(BaseHTTPRequestHandler):
+    """Records the posted batches; answers 500 while the server is told to fail"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = 500 if self.server.failing else 200
+        if status == 200:
+            self.server.batches.append(json.loads(body)['alerts'])
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def hook_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), AlertHookHandler)
+    server.daemon_threads = True
+    server.batches = []
+    server.failing = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def hook_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/alerts"
+
+def test_webhook_notifier_posts_json(hook_server):
+    WebhookNotifier(hook_url(hook_server)).send([{'rule_id': 1}])
+    assert hook_server.batches == [[{'rule_id': 1}]]
+
+    hook_server.failing = True
+    with pytest.raises(Exception):
+        WebhookNotifier(hook_url(hook_server)).send([{'rule_id': 2}])
+
+def test_dispatcher_sends_in_batches(hook_server):
+    dispatcher = AlertDispatcher(WebhookNotifier(hook_url(hook_server)), batch_size=2)
+    dispatcher.add([{'n': n} for n in range(5)])
+    assert dispatcher.flush() == 5
+    assert [[alert['n'] for alert in batch] for batch in hook_server.batches] == [[0, 1], [2, 3], [4]]
+    assert dispatcher.stats()['batches'] == 3 and dispatcher.pending() == 0
+
+def test_failed_batches_are_retried_oldest_first(hook_server):
+    dispatcher = AlertDispatcher(WebhookNotifier(hook_url(hook_server)), batch_size=2)
+    hook_server.failing = True
+    dispatcher.add([{'n': n} for n in range(3)])
+    assert dispatcher.flush() == 0
+    assert dispatcher.pending() == 3 and dispatcher.failures == 1
+
+    hook_server.failing = False
+    dispatcher.add([{'n': 3}])
+    assert dispatcher.flush() == 4
+    assert [alert['n'] for batch in hook_server.batches for alert in batch] == [0, 1, 2, 3]
+
+def test_pending_alerts_are_capped(hook_server, monkeypatch):
+    monkeypatch.setattr(alerts, 'MAX_PENDING_FACTOR', 2)
+    dispatcher = AlertDispatcher(WebhookNotifier(hook_url(hook_server)), batch_size=2)
+    hook_server.failing = True
+    dispatcher.add([{'n': n} for n in range(3)])
+    dispatcher.flush()
+    dispatcher.add([{'n': n} for n in range(3, 6)])
+    # The oldest alerts go first once more than batch_size * MAX_PENDING_FACTOR are waiting
+    assert dispatcher.pending() == 4 and dispatcher.dropped == 2
+
+    hook_server.failing = False
+    dispatcher.flush()
+    assert [alert['n'] for batch in hook_server.batches for alert in batch] == [2, 3, 4, 5]
+
+def test_background_thread_delivers_full_batches(hook_server):
+    dispatcher = AlertDispatcher(WebhookNotifier(hook_url(hook_server)), batch_size=2, flush_ms=60000)
+    dispatcher.start()
+    try:
+        dispatcher.add([{'n': 0}, {'n': 1}])
+        deadline = time.monotonic() + 5
+        while not hook_server.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert hook_server.batches == [[{'n': 0}, {'n': 1}]]
+    finally:
+        dispatcher.stop()
+
+@pytest.fixture
+def speeding(app, unit_id, hook_server, monkeypatch):
+    """A 'speed > 100 for 60s' rule on its own engine and a dispatcher posting to the stub"""
+    from models import AlertRule, Device
+
+    # Inactive, so the app's own engine leaves other tests alone
+    rule_row = AlertRule(name='speeding', expression='speed > 100 for 60s', is_active=False)
+    device = Device(unit_id=unit_id)
+    db.session.add_all([rule_row, device])
+    db.session.commit()
+
+    engine = AlertEngine(reload_seconds=3600)
+    engine.build([Rule(rule_row.id, rule_row.name, rule_row.expression)])
+    engine._checked = time.monotonic()
+    monkeypatch.setattr(alerts, '_alert_engine', engine)
+    dispatcher = AlertDispatcher(WebhookNotifier(hook_url(hook_server)))
+    monkeypatch.setattr(alerts, '_alert_dispatcher', dispatcher)
+    yield device.id, rule_row.id, dispatcher
+
+def evaluate(device_id, start, speeds):
+    """Evaluate one point per (seconds, speed) and commit, returns the number of alerts"""
+    rows = [{'device_id': device_id, 'timestamp': start + timedelta(seconds=seconds), 'speed': speed}
+            for seconds, speed in speeds]
+    count = evaluate_alerts(rows, [None] * len(rows), [[] for _ in rows])
+    db.session.commit()
+    return count
+
+def test_rule_fires_once_its_condition_held_for_the_duration(speeding, hook_server, unit_id):
+    from models import Alert
+
+    device_id, rule_id, dispatcher = speeding
+    start = datetime(2024, 5, 1, 12, 0)
+    assert evaluate(device_id, start, [(0, 120), (30, 130), (59, 125)]) == 0
+    assert evaluate(device_id, start, [(60, 121)]) == 1
+    # Still true: no second alert
+    assert evaluate(device_id, start, [(90, 140), (300, 150)]) == 0
+
+    alert = Alert.query.filter_by(device_id=device_id).one()
+    assert (alert.rule_id, alert.since, alert.timestamp, alert.value) == \
+        (rule_id, start, start + timedelta(seconds=60), 121)
+
+    dispatcher.flush()
+    [[notification]] = hook_server.batches
+    assert notification['unit_id'] == unit_id
+    assert notification['since'] == start.isoformat()
+    assert notification['severity'] == 'warning'
+
+def test_condition_going_false_resets_the_duration(speeding):
+    device_id, _, _ = speeding
+    start = datetime(2024, 5, 1, 12, 0)
+    assert evaluate(device_id, start, [(0, 120), (50, 90), (60, 120), (100, 120)]) == 0
+    assert evaluate(device_id, start, [(120, 120)]) == 1
+
+def test_rule_rearms_after_the_condition_went_false(speeding):
+    from models import Alert
+
+    device_id, _, _ = speeding
+    start = datetime(2024, 5, 1, 12, 0)
+    assert evaluate(device_id, start, [(0, 120), (60, 120)]) == 1
+    assert evaluate(device_id, start, [(70, 80)]) == 0
+    assert evaluate(device_id, start, [(80, 120), (139, 120)]) == 0
+    assert evaluate(device_id, start, [(140, 120)]) == 1
+    assert Alert.query.filter_by(device_id=device_id).count() == 2
+
+def test_late_and_unrelated_points_leave_the_state_alone(speeding):
+    device_id, _, _ = speeding
+    start = datetime(2024, 5, 1, 12, 0)
+    assert evaluate(device_id, start, [(0, 120), (30, 120)]) == 0
+    # Older than the newest evaluated point: ignored, so the condition isn't reset
+    assert evaluate(device_id, start, [(10, 50)]) == 0
+    # No speed on the point: the rule isn't evaluated
+    assert evaluate(device_id, start, [(40, None)]) == 0
+    assert evaluate(device_id, start, [(60, 120)]) == 1
@@ -0,0 +1,168 @@
+"""Idempotent ingest: pre-filter, conflict-free inserts and the cleanup of stored duplicates"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import inspect, text
+
+import dedup
+import ingest
+from conftest import db, stored_points
+
+def test_remove_existing_duplicates_repoints_references(app, unit_id):
+    from models import (Device, TrackingData, TelemetryValue, DeviceLatestState, Geofence, GeofenceEvent,
+                        AlertRule, Alert, Trip, TripSegmenterState)
+    from trips import new_state, make_point, dump_state, load_state
+
+    device = Device(unit_id=unit_id)
+    db.session.add(device)
+    db.session.flush()
+    timestamp = datetime(2024, 3, 1, 8, 0)
+    kept, copy = [TrackingData(device_id=device.id, latitude=1, longitude=2, timestamp=timestamp)
+                  for _ in range(2)]
+    db.session.add_all([kept, copy])
+    db.session.flush()
+
+    geofence = Geofence(name='inactive', kind='circle', geometry='{}', radius_m=1, is_active=False)
+    rule = AlertRule(name='inactive', expression='speed > 1', is_active=False)
+    db.session.add_all([geofence, rule])
+    db.session.flush()
+    state = new_state()
+    state['buffer'] = [make_point(copy.id, timestamp, 1, 2, 0, True, None)]
+    state['last'] = make_point(copy.id, timestamp, 1, 2, 0, True, None)
+    db.session.add_all([
+        TelemetryValue(tracking_id=copy.id, sensor_id=8200, value=1.0),
+        DeviceLatestState(device_id=device.id, tracking_id=copy.id, timestamp=timestamp),
+        GeofenceEvent(device_id=device.id, geofence_id=geofence.id, tracking_id=copy.id, event='enter',
+                      timestamp=timestamp),
+        Alert(device_id=device.id, rule_id=rule.id, tracking_id=copy.id, timestamp=timestamp, since=timestamp,
+              severity='warning'),
+        Trip(device_id=device.id, start_time=timestamp, end_time=timestamp + timedelta(minutes=5),
+             start_tracking_id=copy.id, end_tracking_id=copy.id),
+        TripSegmenterState(device_id=device.id, state=dump_state(state)),
+    ])
+    db.session.commit()
+    kept_id, copy_id = kept.id, copy.id
+
+    assert dedup.remove_existing_duplicates() == 1
+    db.session.expire_all()
+    assert db.session.get(TrackingData, copy_id) is None
+    assert TelemetryValue.query.filter_by(tracking_id=copy_id).count() == 0
+    assert db.session.get(DeviceLatestState, device.id).tracking_id == kept_id
+    assert GeofenceEvent.query.filter_by(device_id=device.id).one().tracking_id == kept_id
+    assert Alert.query.filter_by(device_id=device.id).one().tracking_id == kept_id
+    trip = Trip.query.filter_by(device_id=device.id).one()
+    assert (trip.start_tracking_id, trip.end_tracking_id) == (kept_id, kept_id)
+    state = load_state(db.session.get(TripSegmenterState, device.id).state)
+    assert state['buffer'][0]['id'] == kept_id and state['last']['id'] == kept_id
+
+def test_bloom_filter_finds_what_was_added():
+    bloom = dedup.BloomFilter(1000, 1e-3)
+    for value in range(0, 2000, 2):
+        bloom.add(value)
+    assert all(value in bloom for value in range(0, 2000, 2))
+    false_positives = sum(value in bloom for value in range(1, 20001, 2))
+    assert false_positives < 50
+
+START = datetime(2024, 3, 1, 8, 0)
+
+def minutes(*values):
+    return [START + timedelta(minutes=value) for value in values]
+
+def test_prefilter_skips_remembered_points_up_to_the_high_water_mark():
+    dedup_filter = dedup.DedupFilter()
+    assert not dedup_filter.seen(1, START)
+    dedup_filter.remember([(1, timestamp) for timestamp in minutes(0, 2, 4)])
+
+    assert [dedup_filter.seen(1, timestamp) for timestamp in minutes(0, 2, 4)] == [True, True, True]
+    # Late points never stored, newer points and other devices go through
+    assert [dedup_filter.seen(1, timestamp) for timestamp in minutes(1, 3, 5)] == [False, False, False]
+    assert not dedup_filter.seen(2, START)
+    assert (dedup_filter.checked, dedup_filter.skipped) == (8, 3)
+
+def test_prefilter_forgets_old_generations_and_devices():
+    dedup_filter = dedup.DedupFilter(max_devices=2, window=2)
+    dedup_filter.remember([(1, timestamp) for timestamp in minutes(0, 1, 2, 3, 4)])
+    # Two generations of two points are kept
+    assert [dedup_filter.seen(1, timestamp) for timestamp in minutes(0, 1, 2, 3, 4)] == \
+        [False, False, True, True, True]
+
+    dedup_filter.remember([(2, START), (1, START), (3, START)])
+    assert not dedup_filter.seen(2, START)
+    assert dedup_filter.seen(1, START) and dedup_filter.seen(3, START)
+    assert dedup_filter.stats()['devices'] == 2
+
+def test_filter_follows_the_setting(app, monkeypatch):
+    monkeypatch.setattr(dedup, '_dedup_filter', None)
+    assert dedup.get_dedup_filter() is None
+    monkeypatch.setitem(app.config, 'INGEST_DEDUP', True)
+    monkeypatch.setitem(app.config, 'DEDUP_WINDOW', 8)
+    dedup_filter = dedup.get_dedup_filter()
+    assert dedup_filter.window == 8 and dedup.get_dedup_filter() is dedup_filter
+
+@pytest.fixture
+def dedup_on(app, monkeypatch):
+    """INGEST_DEDUP on with a fresh filter"""
+    monkeypatch.setitem(app.config, 'INGEST_DEDUP', True)
+    monkeypatch.setattr(dedup, '_dedup_filter', None)
+    return dedup.get_dedup_filter
+
+@pytest.fixture
+def restore_indexes(app, monkeypatch):
+    """Puts the plain (device_id, timestamp) index back after a test that creates the unique one"""
+    monkeypatch.setattr(dedup, 'unique_index', False)
+    yield
+    db.session.rollback()
+    with db.engine.begin() as conn:
+        conn.execute(text(f'DROP INDEX IF EXISTS {dedup.UNIQUE_INDEX}'))
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {dedup.REPLACED_INDEX} ON tracking_data (device_id, timestamp)'))
+
+def store(unit_id, *values):
+    stored = ingest.store_tracking_entries([{'unit_id': unit_id, 'latitude': 1, 'longitude': 2, 'speed': value,
+                                             'timestamp': timestamp}
+                                            for value, timestamp in zip(values, minutes(*values))])
+    db.session.commit()
+    return stored
+
+def test_resent_points_are_stored_once(dedup_on, restore_indexes, unit_id, monkeypatch):
+    assert dedup.ensure_unique_index() and dedup.unique_index
+    assert store(unit_id, 0, 1, 1) == 2
+    assert dedup_on().stats()['skipped_before_db'] == 1
+
+    # Points this process stored are skipped before the database
+    assert store(unit_id, 0, 1) == 0
+    assert dedup_on().stats()['skipped_before_db'] == 3
+
+    # After a restart the filter is empty and the index catches them
+    monkeypatch.setattr(dedup, '_dedup_filter', None)
+    assert store(unit_id, 1, 2) == 1
+    stats = dedup_on().stats()
+    assert (stats['inserted'], stats['db_conflicts'], stats['skipped_before_db']) == (1, 1, 0)
+    assert [point.speed for point in stored_points(unit_id)] == [0, 1, 2]
+
+    # Late points that were never stored go through both
+    assert store(unit_id, 0.5) == 1
+
+def test_prefilter_applies_without_the_index(dedup_on, unit_id):
+    assert not dedup.unique_index
+    assert store(unit_id, 0, 1) == 2
+    assert store(unit_id, 1) == 0
+    assert len(stored_points(unit_id)) == 2
+
+def test_unique_index_needs_the_duplicates_removed(app, restore_indexes, unit_id):
+    from models import Device, TrackingData
+
+    device = Device(unit_id=unit_id)
+    db.session.add(device)
+    db.session.flush()
+    db.session.add_all([TrackingData(device_id=device.id, latitude=1, longitude=2, timestamp=START)
+                        for _ in range(2)])
+    db.session.commit()
+
+    assert not dedup.ensure_unique_index() and not dedup.unique_index
+    assert dedup.remove_existing_duplicates() >= 1
+    assert dedup.ensure_unique_index() and dedup.unique_index
+    indexes = {index['name'] for index in inspect(db.engine).get_indexes('tracking_data')}
+    assert dedup.UNIQUE_INDEX in indexes and dedup.REPLACED_INDEX not in indexes
+    # Creating it again is a no-op
+    assert dedup.ensure_unique_index()
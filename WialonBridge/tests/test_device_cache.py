@@ -0,0 +1,54 @@
+"""Device cache: LRU/TTL entries and clearing on changes made by other processes"""
+
+from datetime import datetime, timedelta
+
+import device_cache
+from device_cache import DeviceCache
+from conftest import db, TOKEN
+
+def test_lru_eviction_and_invalidation():
+    cache = DeviceCache(max_size=2)
+    for unit_id in ('a', 'b', 'c'):
+        cache.put(unit_id, ord(unit_id))
+    found, missing = cache.get_many({'a', 'b', 'c'})
+    assert set(found) == {'b', 'c'} and missing == {'a'}
+    cache.invalidate('b')
+    assert cache.get_many({'b'})[1] == {'b'}
+    assert cache.stats()['evictions'] == 1 and cache.stats()['invalidations'] == 1
+
+def post_point(client, unit_id):
+    response = client.post('/webhook/wialon', json={'unit_id': unit_id, 'lat': 1, 'lon': 2},
+                           headers={'Authorization': f'Bearer {TOKEN}'})
+    assert response.status_code == 200
+
+def test_cache_is_cleared_when_another_process_edits_a_device(client, unit_id, monkeypatch):
+    from models import Device
+
+    cache = DeviceCache(reload_seconds=0)
+    monkeypatch.setattr(device_cache, '_device_cache', cache)
+    for _ in range(3):
+        post_point(client, unit_id)
+    # The new device clears the cache once; ingest's last_seen updates don't count as edits
+    assert cache.stats()['hits'] == 1
+
+    # Edited by another worker: that worker's invalidate() doesn't reach this cache
+    db.session.execute(Device.__table__.update().where(Device.unit_id == unit_id)
+                       .values(updated_at=datetime.utcnow() + timedelta(seconds=1)))
+    db.session.commit()
+    post_point(client, unit_id)
+    assert cache.stats()['hits'] == 1 and cache.stats()['invalidations'] >= 1
+
+def test_version_is_checked_every_reload_seconds(app, unit_id):
+    from models import Device
+
+    cache = DeviceCache(reload_seconds=3600)
+    cache.ensure_fresh()
+    cache.put(unit_id, 1)
+    db.session.add(Device(unit_id=unit_id))
+    db.session.commit()
+    cache.ensure_fresh()
+    assert cache.get_many({unit_id})[0]
+
+    cache._checked -= 3600
+    cache.ensure_fresh()
+    assert cache.get_many({unit_id})[1] == {unit_id}
@@ -0,0 +1,46 @@
+"""Alias resolution per key set: priority order, present values and configured vendor aliases"""
+
+import json
+
+import pytest
+
+import field_aliases
+from field_aliases import configure_aliases, load_alias_file, resolve_fields
+
+@pytest.fixture
+def aliases():
+    yield
+    configure_aliases()
+
+def test_first_present_alias_wins():
+    assert resolve_fields({'latitude': 2, 'lat': 1, 'lon': '', 'lng': 3}) == {'latitude': 1, 'longitude': 3}
+
+def test_zero_and_false_are_real_values():
+    assert resolve_fields({'unit_id': 0, 'speed': 0, 'ignition': False, 'lat': None}) == \
+        {'unit_id': 0, 'speed': 0, 'ignition_status': False}
+
+def test_resolver_is_compiled_once_per_key_set():
+    keys = {'unitId': 'U1', 'coordY': 1, 'coordX': 2, 'resolver_probe': True}
+    before = field_aliases.resolver_cache_info()
+    resolve_fields(keys)
+    resolve_fields(dict(keys, unitId='U2'))
+    after = field_aliases.resolver_cache_info()
+    assert (after.misses - before.misses, after.hits - before.hits) == (1, 1)
+
+def test_vendor_aliases_are_appended_after_the_defaults(aliases):
+    configure_aliases({'unit_id': ['terminalId'], 'latitude': 'gps_lat', 'bogus': ['x1']})
+    assert resolve_fields({'terminalId': 'T1', 'gps_lat': 5}) == {'unit_id': 'T1', 'latitude': 5}
+    assert resolve_fields({'terminalId': 'T1', 'imei': 'I1'})['unit_id'] == 'I1'
+    assert 'bogus' not in field_aliases.FIELD_ALIASES
+
+    configure_aliases()
+    assert resolve_fields({'terminalId': 'T1'}) == {}
+
+def test_alias_file_must_map_fields(tmp_path):
+    path = tmp_path / 'aliases.json'
+    path.write_text(json.dumps({'speed': ['velocity']}))
+    assert load_alias_file(str(path)) == {'speed': ['velocity']}
+
+    path.write_text(json.dumps(['velocity']))
+    with pytest.raises(ValueError):
+        load_alias_file(str(path))
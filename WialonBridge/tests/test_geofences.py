@@ -0,0 +1,181 @@
+"""Zone shapes, the R-tree over them, and enter/exit events recorded on ingest"""
+
+import math
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import geofences
+import ingest
+from conftest import db
+from geofences import GeofenceEngine, GeofenceError, PreparedPolygon, STRTree, compile_zone, zone_from_request
+
+def ray_cast(ring, x, y):
+    """Even-odd test against every edge, the reference for the banded one"""
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 <= y < y2 or y2 <= y < y1) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+def test_banded_polygon_matches_plain_ray_casting():
+    rng = random.Random(3)
+    # A star-shaped ring with many edges, so points fall in many different bands
+    ring = [(math.cos(angle) * radius, math.sin(angle) * radius)
+            for angle, radius in ((n * 2 * math.pi / 200, rng.uniform(0.3, 1.0)) for n in range(200))]
+    polygon = PreparedPolygon([ring])
+    for _ in range(2000):
+        x, y = rng.uniform(-1.1, 1.1), rng.uniform(-1.1, 1.1)
+        assert polygon.contains(x, y) == ray_cast(ring, x, y)
+
+def test_polygon_holes_and_circles():
+    square = {'type': 'Polygon', 'coordinates': [
+        [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+        [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]],
+    ]}
+    polygon = compile_zone('polygon', square)
+    assert polygon.bbox == (0, 0, 10, 10)
+    assert polygon.contains(2, 2) and not polygon.contains(5, 5) and not polygon.contains(11, 5)
+
+    circle = compile_zone('circle', '{"type": "Point", "coordinates": [21.0, 52.0]}', 1000)
+    assert circle.contains(21.0, 52.008) and not circle.contains(21.0, 52.01)
+    west, south, east, north = circle.bbox
+    assert west < 21.0 < east and south < 52.0 < north
+
+@pytest.mark.parametrize('kind, geometry, radius_m', [
+    ('circle', {'type': 'Point', 'coordinates': [21.0, 52.0]}, 0),
+    ('circle', {'type': 'Point'}, 100),
+    ('polygon', {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 1], [0, 0]]]}, None),
+    ('polygon', {'type': 'Polygon', 'coordinates': []}, None),
+    ('line', {}, None),
+])
+def test_invalid_zones_are_rejected(kind, geometry, radius_m):
+    with pytest.raises(GeofenceError):
+        compile_zone(kind, geometry, radius_m)
+
+def test_zone_from_request():
+    assert zone_from_request({'name': ' Depot ', 'kind': 'circle', 'latitude': 52, 'longitude': 21, 'radius_m': 50}) \
+        == ('Depot', 'circle', '{"type":"Point","coordinates":[21,52]}', 50)
+    for data in ({'kind': 'circle'}, {'name': 'x', 'kind': 'polygon', 'geometry': {'type': 'Point'}},
+                 {'name': 'x', 'kind': 'square'}):
+        with pytest.raises(GeofenceError):
+            zone_from_request(data)
+
+def test_str_tree_finds_every_box_containing_a_point():
+    rng = random.Random(5)
+    boxes = []
+    for n in range(500):
+        x, y = rng.uniform(-180, 180), rng.uniform(-80, 80)
+        boxes.append(((x, y, x + rng.uniform(0, 5), y + rng.uniform(0, 5)), n))
+    tree = STRTree(boxes)
+    assert tree.size == 500
+    for _ in range(200):
+        x, y = rng.uniform(-180, 180), rng.uniform(-80, 80)
+        expected = {n for (min_x, min_y, max_x, max_y), n in boxes if min_x <= x <= max_x and min_y <= y <= max_y}
+        assert set(tree.query_point(x, y)) == expected
+    assert STRTree([]).query_point(0, 0) == []
+
+# Zones in Antarctica, where no other test stores points
+SQUARE = {'name': 'Square', 'kind': 'polygon', 'geometry': {'type': 'Polygon', 'coordinates': [
+    [[100, -71], [101, -71], [101, -70], [100, -70], [100, -71]],
+    [[100.4, -70.6], [100.6, -70.6], [100.6, -70.4], [100.4, -70.4], [100.4, -70.6]],
+]}}
+CIRCLE = {'name': 'Circle', 'kind': 'circle', 'latitude': -70.5, 'longitude': 101.0, 'radius_m': 10000}
+
+@pytest.fixture
+def engine(app, monkeypatch):
+    """A process engine that checks the zones on every batch"""
+    engine = GeofenceEngine(reload_seconds=0)
+    monkeypatch.setattr(geofences, '_geofence_engine', engine)
+    return engine
+
+@pytest.fixture
+def zones(admin_client, engine):
+    """Ids of the square and the circle, created through the API and deactivated afterwards"""
+    from models import Geofence
+
+    ids = []
+    for zone in (SQUARE, CIRCLE):
+        response = admin_client.post('/api/geofences', json=zone)
+        assert response.status_code == 201
+        ids.append(response.get_json()['id'])
+    yield ids
+
+    db.session.rollback()
+    Geofence.query.filter(Geofence.id.in_(ids)).update({'is_active': False}, synchronize_session=False)
+    db.session.commit()
+
+START = datetime(2024, 7, 1, 12, 0)
+
+def store(unit_id, minute, longitude, latitude=-70.5):
+    ingest.store_tracking_entries([{'unit_id': unit_id, 'latitude': latitude, 'longitude': longitude,
+                                    'timestamp': START + timedelta(minutes=minute)}])
+    db.session.commit()
+
+def test_points_record_zone_transitions(admin_client, zones, engine, unit_id):
+    from models import Device, GeofenceMembership
+
+    square_id, circle_id = zones
+    store(unit_id, 0, 99.5)
+    store(unit_id, 1, 100.2)
+    store(unit_id, 2, 100.5)
+    store(unit_id, 3, 100.95)
+    # A late point doesn't change what the device is in
+    store(unit_id, 2.5, 99.0)
+    store(unit_id, 4, 102.0)
+
+    device = Device.query.filter_by(unit_id=unit_id).one()
+    events = admin_client.get(f'/api/devices/{device.id}/geofence_events').get_json()['events']
+    transitions = sorted((event['timestamp'], event['geofence_name'], event['event']) for event in events)
+    assert transitions == [
+        ((START + timedelta(minutes=1)).isoformat(), 'Square', 'enter'),
+        # The hole is outside the zone
+        ((START + timedelta(minutes=2)).isoformat(), 'Square', 'exit'),
+        ((START + timedelta(minutes=3)).isoformat(), 'Circle', 'enter'),
+        ((START + timedelta(minutes=3)).isoformat(), 'Square', 'enter'),
+        ((START + timedelta(minutes=4)).isoformat(), 'Circle', 'exit'),
+        ((START + timedelta(minutes=4)).isoformat(), 'Square', 'exit'),
+    ]
+    membership = db.session.get(GeofenceMembership, device.id)
+    assert (membership.geofence_ids, membership.timestamp) == ('', START + timedelta(minutes=4))
+    assert engine.stats()['events'] == 6
+
+def test_deactivated_zones_are_left_silently(admin_client, zones, engine, unit_id):
+    from models import Device, GeofenceEvent
+
+    square_id, circle_id = zones
+    store(unit_id, 0, 100.95)
+    assert engine.zones_at(-70.5, 100.95) == {square_id, circle_id}
+
+    assert admin_client.delete(f'/api/geofences/{circle_id}').status_code == 200
+    store(unit_id, 1, 102.0)
+    assert engine.zone_ids >= {square_id} and circle_id not in engine.zone_ids
+    events = GeofenceEvent.query.join(Device).filter(Device.unit_id == unit_id).all()
+    assert sorted((event.geofence_id, event.event) for event in events) == \
+        sorted([(square_id, 'enter'), (circle_id, 'enter'), (square_id, 'exit')])
+    listed = {zone['id'] for zone in admin_client.get('/api/geofences').get_json()['geofences']}
+    assert square_id in listed and circle_id not in listed
+
+def test_zones_are_reloaded_when_the_rows_change(app, engine):
+    from models import Geofence
+
+    engine.reload_seconds = 3600
+    engine.ensure_loaded()
+    before = engine.zone_ids
+    zone = Geofence(name='Unchecked', kind='circle', geometry='{"type": "Point", "coordinates": [0, 0]}',
+                    radius_m=10)
+    broken = Geofence(name='Broken', kind='circle', geometry='{"type": "Point"}', radius_m=10)
+    db.session.add_all([zone, broken])
+    db.session.commit()
+    try:
+        # Rows are only checked every reload_seconds, or after invalidate
+        engine.ensure_loaded()
+        assert engine.zone_ids == before
+        engine.invalidate()
+        engine.ensure_loaded()
+        assert engine.zone_ids == before | {zone.id}
+        assert engine.compile_errors >= 1
+    finally:
+        zone.is_active = broken.is_active = False
+        db.session.commit()
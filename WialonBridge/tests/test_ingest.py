@@ -0,0 +1,82 @@
+"""Bulk insert of parsed entries: one-query device resolution, row order and per-device updates"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import device_cache
+import ingest
+from device_cache import DeviceCache
+from conftest import db, stored_points
+
+@pytest.fixture
+def cache(app, monkeypatch):
+    cache = DeviceCache()
+    monkeypatch.setattr(device_cache, '_device_cache', cache)
+    return cache
+
+def entry(unit_id, minute, **fields):
+    return dict({'unit_id': unit_id, 'latitude': 1.0 + minute, 'longitude': 2.0,
+                 'timestamp': datetime(2024, 6, 1, 9, minute)}, **fields)
+
+def test_resolve_devices_creates_missing_devices_in_one_lookup(cache, unit_id):
+    from models import Device
+
+    existing = Device(unit_id=unit_id + '-a')
+    db.session.add(existing)
+    db.session.commit()
+
+    device_ids = ingest.resolve_devices([unit_id + '-a', unit_id + '-b', unit_id + '-b'])
+    db.session.commit()
+    assert device_ids[unit_id + '-a'] == existing.id
+    assert device_ids[unit_id + '-b'] == Device.query.filter_by(unit_id=unit_id + '-b').one().id
+    assert cache.db_lookups == 1
+
+    # Only the device that was already committed is cached; the new one is picked up next time
+    assert ingest.resolve_devices([unit_id + '-a', unit_id + '-b']) == device_ids
+    assert cache.db_lookups == 2
+    assert ingest.resolve_devices([unit_id + '-a', unit_id + '-b']) == device_ids
+    assert cache.db_lookups == 2
+
+def test_entries_of_several_units_are_stored_in_one_batch(cache, unit_id):
+    from models import Device, TelemetryValue
+
+    entries = [
+        entry(unit_id + '-a', 0, speed=10, telemetry={'temp': {'sensor_id': 8200, 'value': 85.5}}),
+        entry(unit_id + '-b', 1, telemetry={'vin': {'sensor_id': 8200, 'value': 'ABC'}}),
+        entry(unit_id + '-a', 2),
+        {'latitude': 1, 'longitude': 2},  # no unit: skipped
+    ]
+    assert ingest.store_tracking_entries(entries) == 3
+    db.session.commit()
+
+    points = stored_points(unit_id + '-a')
+    assert [(point.latitude, point.speed) for point in points] == [(1.0, 10), (3.0, None)]
+    assert [point.latitude for point in stored_points(unit_id + '-b')] == [2.0]
+    readings = TelemetryValue.query.filter(TelemetryValue.tracking_id.in_(
+        [points[0].id, stored_points(unit_id + '-b')[0].id])).order_by(TelemetryValue.tracking_id).all()
+    assert [(reading.value, reading.text_value) for reading in readings] == [(85.5, None), (None, 'ABC')]
+
+    devices = Device.query.filter(Device.unit_id.like(unit_id + '%')).all()
+    assert len(devices) == 2
+    assert all(device.last_seen is not None and device.is_active for device in devices)
+
+def test_rows_keep_their_order_without_returning(cache, unit_id, monkeypatch):
+    from models import TrackingData
+
+    monkeypatch.setattr(db.engine.dialect, 'insert_executemany_returning_sort_by_parameter_order', False)
+    rows = [ingest.build_tracking_row(entry(unit_id, minute), ingest.resolve_devices([unit_id])[unit_id])
+            for minute in (3, 1, 2)]
+    tracking_ids = ingest.insert_tracking_rows(rows)
+    db.session.commit()
+    assert [db.session.get(TrackingData, tracking_id).latitude for tracking_id in tracking_ids] == [4.0, 2.0, 3.0]
+
+def test_empty_batch_stores_nothing(cache):
+    assert ingest.store_tracking_entries([]) == 0
+    assert cache.db_lookups == 0
+
+def test_missing_timestamp_defaults_to_now(cache, unit_id):
+    before = datetime.utcnow() - timedelta(seconds=1)
+    assert ingest.store_tracking_entries([{'unit_id': unit_id, 'latitude': 1, 'longitude': 2}]) == 1
+    db.session.commit()
+    assert stored_points(unit_id)[0].timestamp >= before
@@ -0,0 +1,75 @@
+"""Typed msgspec decoding agrees with the generic path and hands unknown shapes to it"""
+
+import json
+
+import pytest
+
+import json_fastpath
+from webhook_parser import WebhookPayload, parse_wialon_data
+
+pytest.importorskip('msgspec')
+
+BODIES = [
+    {'unitId': 'U1', 'lat': 1.5, 'lon': 2.5, 'speed': '12.5', 'time': 1700000000, 'ignition': 1},
+    [{'imei': 123456, 'coordY': '50.1', 'coordX': '30.2', 'timestamp': '2024-01-02T03:04:05Z', 'sos': 'true'},
+     {'unit_id': 'U2', 'latitude': 3, 'longitude': 4, 't': 1700000060, 'telemetryDetails': {'sensorCode': 'sensor8200',
+                                                                           'value': '85.5'}}],
+    {'unit_id': 'U3', 'lat': 1, 'lon': 2, 'time': '2024-01-02 03:04:05',
+     'telemetryDetails': [{'sensorCode': 'sensor8200', 'value': 70}, {'sensorCode': 'sensor8201', 'value': '3'}]},
+    {'unit_id': 'U4', 'lat': 1, 'lon': 2, 'dt': 1700000000000, 'sensors': {'sensor8200': 40}},
+    # Unknown key and a nested value the schema doesn't cover: generic path for this record only
+    [{'unit_id': 'U5', 'lat': 1, 'lon': 2, 'time': 1700000000, 'vendor_extra': {'a': 1}},
+     {'unit_id': 'U6', 'lat': 5, 'lon': 6, 'time': 1700000000}],
+]
+
+def parse(body):
+    data = json.dumps(body).encode()
+    return parse_wialon_data(WebhookPayload(data, 'application/json'))
+
+def comparable(entries):
+    return [dict(entry, raw_data=bytes(entry['raw_data'])) for entry in entries]
+
+@pytest.fixture
+def fast_path():
+    json_fastpath.configure(True)
+    yield
+    json_fastpath.configure(True)
+
+@pytest.mark.parametrize('body', BODIES)
+def test_fast_path_matches_the_generic_path(fast_path, body):
+    fast = parse(body)
+    assert fast
+
+    json_fastpath.configure(False)
+    assert comparable(parse(body)) == comparable(fast)
+
+def test_records_outside_the_schema_fall_back_per_record(fast_path, monkeypatch):
+    import webhook_parser
+
+    fallback = []
+    extract = webhook_parser.extract_tracking_data
+    monkeypatch.setattr(webhook_parser, 'extract_tracking_data',
+                        lambda entry, *args: fallback.append(entry['unit_id']) or extract(entry, *args))
+    entries = parse(BODIES[-1])
+    assert [entry['unit_id'] for entry in entries] == ['U5', 'U6']
+    assert fallback == ['U5']
+    # raw_data is each record's own slice of the body
+    assert json.loads(bytes(entries[1]['raw_data'])) == BODIES[-1][1]
+
+def test_disabled_or_malformed_bodies_use_the_generic_path(fast_path):
+    payload = WebhookPayload(b'{"unit_id": "U1", "lat": 1, "lon": 2}', 'application/json')
+    assert json_fastpath.parse_json_fast(payload) is not None
+    assert json_fastpath.parse_json_fast(WebhookPayload(b'{"unit_id": ', 'application/json')) is None
+
+    json_fastpath.configure(False)
+    assert json_fastpath.parse_json_fast(payload) is None
+
+def test_schema_follows_configured_aliases(fast_path):
+    from field_aliases import configure_aliases
+
+    try:
+        configure_aliases({'unit_id': ['terminalId']})
+        payload = WebhookPayload(b'{"terminalId": "U7", "lat": 1, "lon": 2}', 'application/json')
+        assert [entry['unit_id'] for entry in json_fastpath.parse_json_fast(payload)] == ['U7']
+    finally:
+        configure_aliases()
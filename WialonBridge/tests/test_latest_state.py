@@ -0,0 +1,86 @@
+"""Latest position per device: forward-only upserts, rebuild and the map snapshot"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert
+
+import ingest
+import latest_state
+from conftest import db
+
+START = datetime(2024, 7, 1, 12, 0)
+
+def test_latest_points_takes_the_newest_positioned_point():
+    rows = [
+        {'device_id': 1, 'timestamp': START, 'latitude': 1, 'longitude': 2},
+        {'device_id': 1, 'timestamp': START + timedelta(minutes=2), 'latitude': None, 'longitude': 2},
+        {'device_id': 1, 'timestamp': START + timedelta(minutes=1), 'latitude': 1, 'longitude': 2},
+        {'device_id': 1, 'timestamp': START + timedelta(minutes=1), 'latitude': 1, 'longitude': 2},
+        {'device_id': 2, 'timestamp': START, 'latitude': 3, 'longitude': None},
+    ]
+    assert latest_state.latest_points(rows, [10, 11, 13, 12, 14]) == {1: (START + timedelta(minutes=1), 13)}
+
+def store(unit_id, minute, latitude=50.0, longitude=20.0):
+    ingest.store_tracking_entries([{'unit_id': unit_id, 'latitude': latitude, 'longitude': longitude,
+                                    'speed': minute, 'timestamp': START + timedelta(minutes=minute)}])
+    db.session.commit()
+
+def latest(unit_id):
+    from models import Device, DeviceLatestState, TrackingData
+
+    db.session.expire_all()
+    device = Device.query.filter_by(unit_id=unit_id).one()
+    state = db.session.get(DeviceLatestState, device.id)
+    return state.timestamp, db.session.get(TrackingData, state.tracking_id).speed
+
+@pytest.fixture(params=['upsert', 'fallback'])
+def dialect(request, app, monkeypatch):
+    if request.param == 'fallback':
+        # Dialects without ON CONFLICT update the row through the session
+        monkeypatch.setattr(ingest, 'dialect_insert', insert)
+    return request.param
+
+def test_position_only_moves_forward(dialect, unit_id):
+    store(unit_id, 5)
+    assert latest(unit_id) == (START + timedelta(minutes=5), 5)
+    # Late and unpositioned points leave it alone
+    store(unit_id, 3)
+    store(unit_id, 9, latitude=None)
+    assert latest(unit_id) == (START + timedelta(minutes=5), 5)
+    store(unit_id, 7)
+    assert latest(unit_id) == (START + timedelta(minutes=7), 7)
+
+def test_rebuild_matches_the_history(app, unit_id):
+    from models import Device, DeviceLatestState
+
+    for minute in (1, 4, 2):
+        store(unit_id, minute)
+    device_id = Device.query.filter_by(unit_id=unit_id).one().id
+    db.session.get(DeviceLatestState, device_id).timestamp = START
+    db.session.commit()
+
+    assert latest_state.rebuild_latest_state() >= 1
+    assert latest(unit_id) == (START + timedelta(minutes=4), 4)
+
+def test_map_snapshot_and_api(admin_client, unit_id):
+    before = datetime.utcnow() - timedelta(seconds=1)
+    ingest.store_tracking_entries([{'unit_id': unit_id, 'latitude': 50.5, 'longitude': 20.5, 'speed': 12,
+                                    'timestamp': START, 'telemetry': {
+                                        'SENSOR_ENGINE_TEMPERATURE': {'sensor_id': 8200, 'value': 85.0},
+                                        'SENSOR_MODEM_ON': {'sensor_id': 1, 'value': 'true'},
+                                    }}])
+    db.session.commit()
+
+    [device] = [device for device in latest_state.latest_state_snapshot(updated_since=before)
+                if device['unit_id'] == unit_id]
+    assert (device['latitude'], device['longitude'], device['speed'], device['timestamp']) == \
+        (50.5, 20.5, 12, START.isoformat())
+    # Only the map's telemetry categories are included
+    assert list(device['telemetry']) == ['SENSOR_ENGINE_TEMPERATURE']
+    assert not [device for device in latest_state.latest_state_snapshot(updated_since=datetime.utcnow())
+                if device['unit_id'] == unit_id]
+
+    response = admin_client.get('/api/map/latest')
+    assert response.status_code == 200
+    assert unit_id in {device['unit_id'] for device in response.get_json()['devices']}
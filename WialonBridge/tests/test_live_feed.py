@@ -0,0 +1,35 @@
+from conftest import TOKEN
+
+def test_stream_is_off_by_default(admin_client):
+    response = admin_client.get('/api/live/stream')
+    assert response.status_code == 404
+
+def test_stream_starts_when_enabled(app, admin_client, monkeypatch):
+    monkeypatch.setitem(app.config, 'LIVE_FEED_ENABLED', True)
+    response = admin_client.get('/api/live/stream')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    response.close()
+
+def test_pages_are_told_whether_the_feed_is_on(app, admin_client, monkeypatch):
+    assert b'data-live-feed="off"' in admin_client.get('/live-messages').data
+    monkeypatch.setitem(app.config, 'LIVE_FEED_ENABLED', True)
+    assert b'data-live-feed="on"' in admin_client.get('/live-messages').data
+
+def test_live_messages_snapshot(admin_client, unit_id):
+    from webhook_log_buffer import get_webhook_log_buffer
+
+    headers = {'Authorization': f'Bearer {TOKEN}'}
+    assert admin_client.post('/webhook/wialon', json={'unit_id': unit_id, 'lat': 52.1, 'lon': 21.2},
+                             headers=headers).status_code == 200
+    # Failures are always logged, successes only sampled
+    assert admin_client.post('/webhook/wialon', data='lat=1&lon=2', headers=headers,
+                             content_type='application/x-www-form-urlencoded').status_code == 400
+    log_buffer = get_webhook_log_buffer()
+    if log_buffer is not None:
+        log_buffer.flush()
+
+    snapshot = admin_client.get('/api/live/messages').get_json()
+    assert set(snapshot['stats']) == {'total_recent', 'successful', 'failed', 'data_points'}
+    assert any(msg['status_code'] == 400 for msg in snapshot['messages'])
+    assert any(point['latitude'] == 52.1 for point in snapshot['tracking'])
@@ -0,0 +1,65 @@
+"""Points linked to the request that delivered them, and the /logs page's fixed query count"""
+
+import json
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, event, inspect, text
+
+import routes
+import schema_upgrade
+from conftest import db, TOKEN, stored_points
+
+def post_points(client, unit_id, count):
+    body = [{'unit_id': unit_id, 'lat': 1, 'lon': 2, 'time': 1700000000 + n} for n in range(count)]
+    response = client.post('/webhook/wialon', data=json.dumps(body), content_type='application/json',
+                           headers={'Authorization': f'Bearer {TOKEN}'})
+    assert response.status_code == 200
+
+def test_points_reference_their_request(client, unit_id):
+    from models import WebhookLog
+
+    post_points(client, unit_id, 2)
+    post_points(client, unit_id, 1)
+    log_ids = [point.webhook_log_id for point in sorted(stored_points(unit_id), key=lambda point: point.id)]
+    assert log_ids[0] == log_ids[1] != log_ids[2]
+    assert all(db.session.get(WebhookLog, log_id).status_code == 200 for log_id in log_ids)
+
+def count_selects(client):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        response = client.get('/logs')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return len(statements), response.get_data(as_text=True)
+
+def test_logs_page_query_count_doesnt_grow_with_the_rows(app, client, admin_client, unit_id, monkeypatch):
+    monkeypatch.setattr(routes, 'LOG_POINTS_PER_REQUEST', 3)
+    post_points(client, unit_id, 5)
+    few, page = count_selects(admin_client)
+    assert '5 points, first 3 shown' in page
+
+    for _ in range(4):
+        post_points(client, unit_id + '-b', 2)
+    many, _ = count_selects(admin_client)
+    assert many == few
+
+def test_upgrade_adds_missing_columns_once(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE webhook_log (id INTEGER PRIMARY KEY)'))
+        conn.execute(text('CREATE TABLE tracking_data (id INTEGER PRIMARY KEY)'))
+    monkeypatch.setattr(schema_upgrade, 'db', SimpleNamespace(engine=engine))
+
+    schema_upgrade.upgrade_schema()
+    schema_upgrade.upgrade_schema()
+    inspector = inspect(engine)
+    assert 'webhook_log_id' in {column['name'] for column in inspector.get_columns('tracking_data')}
+    assert 'ix_tracking_data_webhook_log_id' in {index['name'] for index in inspector.get_indexes('tracking_data')}
+    # Tables that don't exist yet are left to create_all
+    assert 'device' not in inspector.get_table_names()
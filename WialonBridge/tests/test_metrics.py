@@ -0,0 +1,85 @@
+import json
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+import metrics
+from conftest import db
+
+def snapshot_data(requests=0, points=0):
+    counters = metrics.RollingCounters()
+    for _ in range(requests):
+        counters.record_request(200)
+    if points:
+        counters.record_points({'UNIT': points})
+    return json.dumps(counters.to_dict())
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+@pytest.fixture
+def snapshots(app):
+    from models import MetricsSnapshot
+
+    added = []
+
+    def add(name, saved_at=None, **counts):
+        db.session.add(MetricsSnapshot(name=name, data=snapshot_data(**counts),
+                                       saved_at=saved_at or datetime.utcnow()))
+        db.session.commit()
+        added.append(name)
+        metrics._peers.invalidate()
+        return name
+
+    yield add
+    MetricsSnapshot.query.filter(MetricsSnapshot.name.in_(added)).delete()
+    db.session.commit()
+    metrics._peers.invalidate()
+
+def test_merge_dict_adds_counts():
+    counters = metrics.RollingCounters()
+    counters.record_request(200)
+    counters.merge_dict(json.loads(snapshot_data(requests=2, points=5)))
+    assert counters.window('5m')['received'] == 3
+    assert counters.window('7d')['points'] == 5
+    assert counters.top_devices() == [('UNIT', 5)]
+
+def test_window_sums_the_rows_of_other_workers(app, snapshots):
+    before = metrics.window('1h')
+    snapshots('rolling_counters:other-host:101', requests=3, points=7)
+    snapshots('rolling_counters:other-host:102', requests=2)
+    after = metrics.window('1h')
+    assert after['received'] - before['received'] == 5
+    assert after['points'] - before['points'] == 7
+
+def test_save_keeps_rows_of_running_workers(app, snapshots):
+    from models import MetricsSnapshot
+
+    name = snapshots('rolling_counters:other-host:103', requests=1)
+    metrics.save_snapshot()
+    assert db.session.get(MetricsSnapshot, name) is not None
+    assert db.session.get(MetricsSnapshot, metrics.snapshot_name()) is not None
+
+@pytest.mark.parametrize('row', ['dead pid', 'stale', 'legacy'])
+def test_save_takes_over_rows_of_exited_workers(app, snapshots, row):
+    from models import MetricsSnapshot
+
+    if row == 'dead pid':
+        name = snapshots(f'rolling_counters:{metrics._host()}:{dead_pid()}', requests=4)
+    elif row == 'stale':
+        name = snapshots('rolling_counters:other-host:104', requests=4,
+                         saved_at=datetime.utcnow() - timedelta(hours=1))
+    else:
+        name = snapshots(metrics.SNAPSHOT_PREFIX, requests=4)
+    total_before = metrics.window('1h')['received']
+    own_before = metrics.counters.window('1h')['received']
+
+    assert metrics.save_snapshot() == 1
+    assert db.session.get(MetricsSnapshot, name) is None
+    assert metrics.counters.window('1h')['received'] - own_before == 4
+    # Moved into this process's row, not counted twice
+    assert metrics.window('1h')['received'] == total_before
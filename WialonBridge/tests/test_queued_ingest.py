@@ -0,0 +1,117 @@
+"""Queued ingest: acknowledged requests are the ones the queue worker stores"""
+
+import pytest
+
+import ingest_queue
+from conftest import TOKEN, stored_points
+
+BEARER = {'Authorization': f'Bearer {TOKEN}'}
+
+@pytest.fixture
+def queue(app, tmp_path, monkeypatch):
+    """Queued mode with a fresh queue; the test drains it instead of the writer threads"""
+    queue = ingest_queue.IngestQueue(str(tmp_path / 'queue.db'))
+    monkeypatch.setitem(app.config, 'INGEST_MODE', 'queued')
+    monkeypatch.setattr(ingest_queue, '_ingest_queue', queue)
+    return queue
+
+def drain(app, queue):
+    pool = ingest_queue.IngestWorkerPool(app, queue, workers=1)
+    while pool.drain_once():
+        pass
+
+def test_json_request_is_queued_then_stored(app, client, queue, unit_id):
+    response = client.post('/webhook/wialon', data=f'[{{"unitId": "{unit_id}", "lat": 1, "lon": 2}}]',
+                           content_type='application/json', headers=BEARER)
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'queued'
+    assert stored_points(unit_id) == []
+    drain(app, queue)
+    assert [(point.latitude, point.longitude) for point in stored_points(unit_id)] == [(1, 2)]
+
+@pytest.mark.parametrize('api_key_in_body', [False, True])
+def test_form_request_is_queued_then_stored(app, client, queue, unit_id, api_key_in_body):
+    body = f'unit_id={unit_id}&lat=3&lon=4'
+    headers = BEARER
+    if api_key_in_body:
+        body += f'&api_key={TOKEN}'
+        headers = {}
+    response = client.post('/webhook/wialon', data=body, content_type='application/x-www-form-urlencoded',
+                           headers=headers)
+    assert response.status_code == 200
+    drain(app, queue)
+    assert [(point.latitude, point.longitude) for point in stored_points(unit_id)] == [(3, 4)]
+
+def test_multipart_request_is_queued_then_stored(app, client, queue, unit_id):
+    response = client.post('/webhook/wialon', data={'unit_id': unit_id, 'lat': '5', 'lon': '6'},
+                           content_type='multipart/form-data', headers=BEARER)
+    assert response.status_code == 200
+    drain(app, queue)
+    assert [(point.latitude, point.longitude) for point in stored_points(unit_id)] == [(5, 6)]
+
+@pytest.mark.parametrize('body, content_type', [
+    ('', 'application/x-www-form-urlencoded'),
+    ('lat=1&lon=2', 'application/x-www-form-urlencoded'),
+    ('{"not": "json"', 'application/json'),
+])
+def test_request_without_points_is_not_acknowledged(client, queue, body, content_type):
+    response = client.post('/webhook/wialon', data=body, content_type=content_type, headers=BEARER)
+    assert response.status_code == 400
+    assert queue.depth() == 0
+
+def test_entry_that_fails_to_parse_is_dead_lettered(app, client, queue, unit_id, monkeypatch):
+    for index in range(2):
+        response = client.post('/webhook/wialon', data=f'unit_id={unit_id}&lat={index}&lon=2',
+                               content_type='application/x-www-form-urlencoded', headers=BEARER)
+        assert response.status_code == 200
+
+    real_parse = ingest_queue.parse_queued_entry
+
+    def parse(entry):
+        if b'lat=0' in entry['body']:
+            raise RuntimeError("parser crashed")
+        return real_parse(entry)
+    monkeypatch.setattr(ingest_queue, 'parse_queued_entry', parse)
+
+    drain(app, queue)
+    # The good entry is stored; the bad one is retried up to max_attempts, then dead
+    assert [point.latitude for point in stored_points(unit_id)] == [1]
+    stats = queue.stats()
+    assert stats['depth'] == 0 and stats['dead'] == 1
+    assert stats['failed_attempts'] == queue.max_attempts
+
+def test_entry_whose_lease_keeps_expiring_is_dead_lettered(tmp_path, monkeypatch):
+    queue = ingest_queue.IngestQueue(str(tmp_path / 'queue.db'), lease_seconds=10, max_attempts=3)
+    now = [1000.0]
+    monkeypatch.setattr(ingest_queue.time, 'time', lambda: now[0])
+    queue.enqueue(b'unit_id=X&lat=1&lon=2', 'application/x-www-form-urlencoded')
+
+    # A worker that dies while holding the entry never acks or fails it
+    for attempt in range(1, 4):
+        assert [entry['attempts'] for entry in queue.claim(10)] == [attempt]
+        now[0] += 11
+
+    assert queue.claim(10) == []
+    stats = queue.stats()
+    assert stats['dead'] == 1 and stats['depth'] == 0 and stats['dead_lettered'] == 1
+
+def test_queued_request_is_not_parsed_on_the_request_path(client, queue, unit_id, monkeypatch):
+    import routes
+
+    def parse(payload):
+        raise AssertionError("the queue worker parses the body")
+    monkeypatch.setattr(routes, 'parse_wialon_data', parse)
+
+    points = ','.join(f'{{"unitId": "{unit_id}", "lat": {i}, "lon": 2}}' for i in range(100))
+    response = client.post('/webhook/wialon', data=f'[{points}]', content_type='application/json', headers=BEARER)
+    assert response.status_code == 200
+    assert queue.depth() == 1
+
+def test_soap_request_is_queued_then_stored(app, client, queue, unit_id):
+    from test_webhook_ingest import SOAP_TEMPLATE
+
+    response = client.post('/webhook/wialon', data=SOAP_TEMPLATE.format(token=TOKEN, unit_id=unit_id),
+                           content_type='application/soap+xml')
+    assert response.status_code == 200
+    drain(app, queue)
+    assert len(stored_points(unit_id)) == 1
@@ -0,0 +1,177 @@
+"""Token-bucket math of every backend, the RESP client and the webhook's bucket keys"""
+
+import hashlib
+import socketserver
+import threading
+
+import pytest
+
+import rate_limit
+from rate_limit import (RateLimiter, MemoryBackend, SqliteBackend, RedisBackend, RespClient, RespError,
+                        token_key, ip_key)
+from conftest import TOKEN
+
+class RespStubHandler(socketserver.StreamRequestHandler):
+    """Speaks enough RESP2 for RedisBackend; the Lua script is emulated in Python"""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line.startswith(b'*')
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode('utf-8'))
+        return args
+
+    def handle(self):
+        server = self.server
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            server.commands.append(args)
+            command = args[0].upper()
+            if command in ('AUTH', 'SELECT'):
+                self.wfile.write(b'+OK\r\n')
+            elif command == 'EVALSHA' and args[1] not in server.scripts:
+                self.wfile.write(b'-NOSCRIPT No matching script. Please use EVAL.\r\n')
+            elif command in ('EVAL', 'EVALSHA'):
+                if command == 'EVAL':
+                    server.scripts.add(hashlib.sha1(args[1].encode('utf-8')).hexdigest())
+                key, capacity, rate, now = args[3], float(args[4]), float(args[5]), float(args[6])
+                tokens, updated = server.buckets.get(key, (None, now))
+                stored, left = rate_limit.take_token(rate_limit.refill(tokens, updated, now, capacity, rate))
+                server.buckets[key] = (stored, now)
+                data = repr(left).encode()
+                self.wfile.write(b'$%d\r\n%s\r\n' % (len(data), data))
+            elif command == 'MGET':
+                self.wfile.write(b'*3\r\n$1\r\na\r\n$-1\r\n:7\r\n')
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+            self.wfile.flush()
+
+@pytest.fixture
+def resp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RespStubHandler)
+    server.daemon_threads = True
+    server.commands = []
+    server.scripts = set()
+    server.buckets = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBackend()
+    if request.param == 'sqlite':
+        return SqliteBackend(str(tmp_path / 'rate_limit.db'))
+    server = request.getfixturevalue('resp_server')
+    return RedisBackend(f"redis://127.0.0.1:{server.server_address[1]}/0")
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, 'time', lambda: now[0])
+    return now
+
+def test_bucket_empties_and_refills(backend, clock):
+    limiter = RateLimiter(backend, default_limit=3)  # 3 per minute: one token every 20 s
+    assert [limiter.check('ip:a').allowed for _ in range(4)] == [True, True, True, False]
+
+    clock[0] += 10
+    result = limiter.check('ip:a')
+    assert not result.allowed and result.retry_after == 10
+
+    clock[0] += 10
+    assert limiter.check('ip:a').allowed
+    assert not limiter.check('ip:a').allowed
+    # Other keys have their own bucket
+    assert limiter.check('ip:b').allowed
+
+def test_refill_is_capped_at_the_capacity(backend, clock):
+    limiter = RateLimiter(backend, default_limit=2)
+    limiter.check('ip:a')
+    clock[0] += 3600
+    assert [limiter.check('ip:a').allowed for _ in range(3)] == [True, True, False]
+
+def test_retry_after_rounds_up(backend, clock):
+    limiter = RateLimiter(backend, default_limit=60)  # one token per second
+    for _ in range(60):
+        assert limiter.check('ip:a').allowed
+    clock[0] += 0.25
+    result = limiter.check('ip:a')
+    assert not result.allowed and result.retry_after == 1
+
+def test_per_key_limits_and_unlimited_keys(clock):
+    limiter = RateLimiter(MemoryBackend(), default_limit=1, limits={'ip:vip': 3, 'ip:free': 0})
+    assert [limiter.check('ip:vip').allowed for _ in range(4)] == [True, True, True, False]
+    assert all(limiter.check('ip:free').allowed for _ in range(10))
+    assert limiter.stats()['overrides'] == 2
+
+def test_memory_backend_evicts_least_recently_used(clock):
+    backend = MemoryBackend(max_keys=2)
+    for key in ('a', 'b', 'a', 'c'):
+        backend.take(key, 5, 1.0, clock[0])
+    assert backend.size() == 2
+    assert backend.take('a', 5, 1.0, clock[0]) == 2
+
+def test_sqlite_backend_is_shared_between_connections(tmp_path, clock):
+    path = str(tmp_path / 'shared.db')
+    first, second = SqliteBackend(path), SqliteBackend(path)
+    assert first.take('ip:a', 2, 1 / 30, clock[0]) == 1
+    assert second.take('ip:a', 2, 1 / 30, clock[0]) == 0
+    assert first.take('ip:a', 2, 1 / 30, clock[0]) == -1
+
+def test_redis_backend_loads_the_script_once(resp_server, clock):
+    backend = RedisBackend(f"redis://:secret@127.0.0.1:{resp_server.server_address[1]}/2")
+    backend.take('ip:a', 5, 0.5, clock[0])
+    backend.take('ip:a', 5, 0.5, clock[0])
+
+    commands = [args[0] for args in resp_server.commands]
+    assert commands == ['AUTH', 'SELECT', 'EVALSHA', 'EVAL', 'EVALSHA']
+    assert resp_server.commands[0] == ['AUTH', 'secret']
+    assert resp_server.commands[1] == ['SELECT', '2']
+    evalsha = resp_server.commands[2]
+    assert evalsha[1] == hashlib.sha1(RedisBackend.SCRIPT.encode('utf-8')).hexdigest()
+    assert evalsha[2:] == ['1', 'wialon:ratelimit:ip:a', '5', '0.5', repr(clock[0])]
+    assert resp_server.commands[3][1] == RedisBackend.SCRIPT
+
+def test_resp_client_replies(resp_server):
+    client = RespClient(f"redis://127.0.0.1:{resp_server.server_address[1]}")
+    assert client.execute('MGET', 'x', 'y', 'z') == [b'a', None, 7]
+    with pytest.raises(RespError, match='unknown command'):
+        client.execute('FLUSHALL')
+    # Error replies leave the connection usable
+    assert client.execute('SELECT', 0) == 'OK'
+
+def test_unreachable_backend_lets_requests_through(clock):
+    with socketserver.TCPServer(('127.0.0.1', 0), socketserver.BaseRequestHandler) as unused:
+        port = unused.server_address[1]
+    limiter = RateLimiter(RedisBackend(f"redis://127.0.0.1:{port}"), default_limit=1)
+    assert limiter.check('ip:a').allowed and limiter.check('ip:a').allowed
+    assert limiter.stats()['backend_errors'] == 2
+
+def post_point(client, unit_id, remote_addr):
+    return client.post('/webhook/wialon', json={'unit_id': unit_id, 'lat': 1, 'lon': 2},
+                       headers={'Authorization': f'Bearer {TOKEN}'},
+                       environ_base={'REMOTE_ADDR': remote_addr})
+
+def test_clients_sharing_the_token_are_limited_per_ip(client, unit_id, monkeypatch):
+    monkeypatch.setattr(rate_limit, '_rate_limiter', RateLimiter(MemoryBackend(), default_limit=1))
+    assert post_point(client, unit_id, '10.0.0.1').status_code == 200
+    assert post_point(client, unit_id, '10.0.0.2').status_code == 200
+    assert post_point(client, unit_id, '10.0.0.1').status_code == 429
+
+def test_token_with_its_own_limit_uses_its_bucket(client, unit_id, monkeypatch):
+    limiter = RateLimiter(MemoryBackend(), default_limit=1, limits={token_key(TOKEN): 2})
+    monkeypatch.setattr(rate_limit, '_rate_limiter', limiter)
+    assert post_point(client, unit_id, '10.0.0.1').status_code == 200
+    assert post_point(client, unit_id, '10.0.0.1').status_code == 200
+    assert post_point(client, unit_id, '10.0.0.2').status_code == 429
+    assert limiter.backend.take(ip_key('10.0.0.1'), 1, 1.0, rate_limit.time.time()) == 0
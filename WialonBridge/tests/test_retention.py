@@ -0,0 +1,113 @@
+"""Monthly archive and delete of expired points, resumed after an interruption"""
+
+import csv
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+import retention
+from conftest import db, stored_points
+
+# Points far older than anything other tests store, so only theirs expire
+JANUARY, FEBRUARY, MARCH = datetime(1950, 1, 1), datetime(1950, 2, 1), datetime(1950, 3, 1)
+
+def retention_days():
+    """Retention that expires January and February 1950 only"""
+    return (datetime.utcnow() - datetime(1950, 3, 15)).days
+
+@pytest.fixture
+def history(app, unit_id, tmp_path, monkeypatch):
+    """(device id, point ids) of points in three months of 1950, removed afterwards with the archive records"""
+    from models import Device, TrackingData, TelemetryValue, DeviceLatestState, ArchivedPartition
+
+    monkeypatch.setitem(app.config, 'ARCHIVE_DIR', str(tmp_path))
+    monkeypatch.setitem(app.config, 'RETENTION_BATCH_SIZE', 2)
+    device = Device(unit_id=unit_id)
+    db.session.add(device)
+    db.session.flush()
+    points = [TrackingData(device_id=device.id, latitude=1, longitude=2, speed=day, timestamp=month.replace(day=day))
+              for month, day in ((JANUARY, 3), (JANUARY, 10), (JANUARY, 20), (FEBRUARY, 5), (MARCH, 2))]
+    db.session.add_all(points)
+    db.session.flush()
+    points[0].set_telemetry({'SENSOR_ENGINE_TEMPERATURE': {'sensor_id': 8200, 'value': 85.0}})
+    # The map's latest position is in an expired month
+    db.session.add(DeviceLatestState(device_id=device.id, tracking_id=points[3].id, timestamp=points[3].timestamp))
+    db.session.commit()
+    # Exports expunge the session, so tests get plain ids
+    device_id = device.id
+    yield device_id, [point.id for point in points]
+
+    db.session.rollback()
+    ids = select(TrackingData.id).where(TrackingData.device_id == device_id)
+    db.session.execute(TelemetryValue.__table__.delete().where(TelemetryValue.tracking_id.in_(ids)))
+    db.session.execute(DeviceLatestState.__table__.delete().where(DeviceLatestState.device_id == device_id))
+    db.session.execute(TrackingData.__table__.delete().where(TrackingData.device_id == device_id))
+    db.session.execute(ArchivedPartition.__table__.delete().where(ArchivedPartition.month < MARCH + timedelta(days=31)))
+    db.session.commit()
+
+def test_expired_months_skip_empty_months(history):
+    assert retention.expired_months(retention_days()) == [JANUARY, FEBRUARY]
+    assert retention.expired_months(retention_days() - 31) == [JANUARY, FEBRUARY, MARCH]
+
+def test_dry_run_only_counts(history, unit_id):
+    assert retention.apply_retention(retention_days(), dry_run=True) == [(JANUARY, 3, 0), (FEBRUARY, 1, 0)]
+    assert len(stored_points(unit_id)) == 5
+
+def test_months_are_archived_then_deleted(app, history, unit_id, tmp_path):
+    from models import ArchivedPartition, TelemetryValue
+
+    _, point_ids = history
+    assert retention.apply_retention(retention_days()) == [(JANUARY, 3, 3), (FEBRUARY, 1, 0)]
+    # The latest position and the unexpired month stay
+    assert [point.speed for point in stored_points(unit_id)] == [5, 2]
+    assert TelemetryValue.query.filter_by(tracking_id=point_ids[0]).count() == 0
+
+    partition = db.session.get(ArchivedPartition, JANUARY)
+    assert partition.path == str(tmp_path / 'tracking_data-1950-01.csv.gz')
+    assert (partition.format, partition.row_count, partition.max_tracking_id) == ('csv', 3, point_ids[2])
+    assert partition.completed_at is not None
+    with gzip.open(partition.path, 'rt', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [(row['speed'], row['timestamp']) for row in rows] == [
+        ('3.0', '1950-01-03T00:00:00'), ('10.0', '1950-01-10T00:00:00'), ('20.0', '1950-01-20T00:00:00')]
+    assert json.loads(rows[0]['telemetry'])['SENSOR_ENGINE_TEMPERATURE']['value'] == 85.0
+    assert rows[1]['telemetry'] == ''
+
+    # Completed months are not archived again
+    assert retention.apply_retention(retention_days()) == []
+    assert retention.retention_stats()['archived_months'] >= 2
+
+def test_interrupted_run_resumes_without_exporting_again(app, history, unit_id, monkeypatch):
+    from models import TrackingData
+
+    device_id, _ = history
+
+    def interrupted(partition, batch_size):
+        raise RuntimeError("stopped")
+    delete_archived = retention.delete_archived
+    monkeypatch.setattr(retention, 'delete_archived', interrupted)
+    with pytest.raises(RuntimeError):
+        retention.apply_retention(retention_days())
+    assert len(stored_points(unit_id)) == 5
+
+    # A point that arrived after the export isn't in the archive and is kept
+    late = TrackingData(device_id=device_id, latitude=1, longitude=2, speed=25,
+                        timestamp=datetime(1950, 1, 25))
+    db.session.add(late)
+    db.session.commit()
+
+    exported = []
+    export_month = retention.export_month
+    monkeypatch.setattr(retention, 'delete_archived', delete_archived)
+    monkeypatch.setattr(retention, 'export_month',
+                        lambda month, *args: exported.append(month) or export_month(month, *args))
+    assert retention.apply_retention(retention_days()) == [(JANUARY, 3, 3), (FEBRUARY, 1, 0)]
+    assert exported == [FEBRUARY]
+    assert [point.speed for point in stored_points(unit_id)] == [25, 5, 2]
+
+def test_parquet_falls_back_to_csv_without_pyarrow(monkeypatch):
+    monkeypatch.setattr(retention, 'pa', None)
+    assert retention.archive_writer_class('parquet') is retention.CsvArchive
@@ -0,0 +1,55 @@
+import subprocess
+import sys
+
+import rollups
+
+def test_only_one_process_gets_the_rollup_lock(app, tmp_path):
+    lock_path = str(tmp_path / 'rollup.lock')
+    lock = rollups.acquire_job_lock(lock_path)
+    assert lock is not None
+
+    # flock is per open file: another process (or open) can't take it while held
+    other_process = [sys.executable, '-c',
+                     'import fcntl, sys; f = open(sys.argv[1], "a")\n'
+                     'try:\n    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)\n'
+                     'except OSError:\n    sys.exit(1)', lock_path]
+    assert subprocess.run(other_process).returncode == 1
+    assert rollups.acquire_job_lock(lock_path) is None
+
+    lock.close()
+    assert subprocess.run(other_process).returncode == 0
+
+def test_worker_without_the_lock_skips_the_job(app, tmp_path, monkeypatch):
+    lock_path = str(tmp_path / 'rollup.lock')
+    owner = rollups.acquire_job_lock(lock_path)
+    monkeypatch.setitem(app.config, 'ROLLUP_LOCK_PATH', lock_path)
+    monkeypatch.setattr(rollups, '_rollup_worker', None)
+    monkeypatch.setattr(rollups, '_rollup_lock', None)
+
+    rollups.init_rollups(app)
+    assert rollups._rollup_worker is None
+
+    owner.close()
+    rollups.init_rollups(app)
+    assert rollups._rollup_worker is not None
+    rollups._rollup_worker.stop()
+    rollups._rollup_lock.close()
+
+def test_worker_without_the_lock_skips_retention(app, tmp_path, monkeypatch):
+    import retention
+
+    lock_path = str(tmp_path / 'retention.lock')
+    owner = rollups.acquire_job_lock(lock_path, retention.ADVISORY_LOCK_KEY)
+    monkeypatch.setitem(app.config, 'TRACKING_RETENTION_DAYS', 30)
+    monkeypatch.setitem(app.config, 'RETENTION_LOCK_PATH', lock_path)
+    monkeypatch.setattr(retention, '_retention_worker', None)
+    monkeypatch.setattr(retention, '_retention_lock', None)
+
+    retention.init_retention(app)
+    assert retention._retention_worker is None
+
+    owner.close()
+    retention.init_retention(app)
+    assert retention._retention_worker is not None
+    retention._retention_worker.stop()
+    retention._retention_lock.close()
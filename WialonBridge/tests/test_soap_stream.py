@@ -0,0 +1,75 @@
+"""Single-pass SOAP/XML reading: header, one record at a time, xmltodict-shaped dicts"""
+
+import xml.etree.ElementTree as ET
+
+from webhook_parser import SoapStream, WebhookPayload, element_to_dict, parse_wialon_data
+
+ENVELOPE = """<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:web="http://webservice.retranslator.wialon">
+    <soapenv:Header>
+        <wsse:Security xmlns:wsse="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd">
+            <wsse:UsernameToken><wsse:Username>secret</wsse:Username></wsse:UsernameToken>
+        </wsse:Security>
+    </soapenv:Header>
+    <soapenv:Body>
+        <web:submitBatch>{records}</web:submitBatch>
+    </soapenv:Body>
+</soapenv:Envelope>"""
+
+RECORD = """
+            <web:submitData>
+                <unitId>{unit_id}</unitId>
+                <latitude>{lat}</latitude>
+                <longitude>30.5</longitude>
+                <timestamp>2025-08-05T10:48:00Z</timestamp>
+                <telemetryDetails><sensorCode>sensor8200</sensorCode><value>85.5</value></telemetryDetails>
+                <telemetryDetails><sensorCode>sensor8201</sensorCode><value>12</value></telemetryDetails>
+            </web:submitData>"""
+
+def envelope(count):
+    return ENVELOPE.format(records=''.join(RECORD.format(unit_id=f'U{n}', lat=50 + n) for n in range(count)))
+
+def test_header_username_is_read_before_the_body():
+    stream = SoapStream(envelope(1))
+    assert stream.read_header() == 'secret'
+    # Reading it again doesn't advance the stream
+    assert stream.read_header() == 'secret'
+    assert [record['unitId'] for record in stream.records()] == ['U0']
+
+def test_records_are_yielded_and_detached_one_at_a_time():
+    stream = SoapStream(envelope(3).encode())
+    records = []
+    for record in stream.records():
+        records.append(record)
+        # The enclosing element only holds records read ahead, never converted ones
+        assert len(stream._stack[-1]) <= 3 - len(records)
+    assert [record['unitId'] for record in records] == ['U0', 'U1', 'U2']
+    assert records[0]['telemetryDetails'] == [
+        {'sensorCode': 'sensor8200', 'value': '85.5'},
+        {'sensorCode': 'sensor8201', 'value': '12'},
+    ]
+
+def test_plain_xml_without_envelope():
+    stream = SoapStream('<points><point><unitId>U9</unitId><lat>1</lat><lon>2</lon></point></points>')
+    assert stream.read_header() is None
+    assert list(stream.records()) == [{'unitId': 'U9', 'lat': '1', 'lon': '2'}]
+
+def test_element_to_dict_matches_xmltodict_shape():
+    elem = ET.fromstring('<r xmlns:x="urn:x" id="7"><x:a>1</x:a><a>2</a><b/><c k="v">text</c>tail</r>')
+    assert element_to_dict(elem) == {
+        '@id': '7',
+        'a': ['1', '2'],
+        'b': None,
+        'c': {'@k': 'v', '#text': 'text'},
+    }
+
+def test_every_record_of_a_soap_batch_is_parsed():
+    payload = WebhookPayload(envelope(2).encode(), 'application/soap+xml')
+    entries = parse_wialon_data(payload)
+    assert [(entry['unit_id'], entry['latitude'], entry['data_format']) for entry in entries] == \
+        [('U0', 50.0, 'xml'), ('U1', 51.0, 'xml')]
+    assert {sensor['sensor_id'] for sensor in entries[0]['telemetry'].values()} == {8200, 8201}
+
+def test_malformed_xml_yields_no_entries():
+    payload = WebhookPayload(envelope(1)[:-40].encode(), 'text/xml')
+    assert parse_wialon_data(payload) == []
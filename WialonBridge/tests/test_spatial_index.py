@@ -0,0 +1,117 @@
+"""Tile pyramid over the latest positions: viewport clustering, nearest devices and the map APIs"""
+
+import random
+from datetime import datetime
+
+import pytest
+
+import ingest
+import spatial_index
+from conftest import db
+from geo import haversine_km
+from spatial_index import SpatialIndex, tile_xy, tile_bounds, MAX_LEVEL
+
+def position(device_id, latitude, longitude, timestamp='2024-07-01T12:00:00', **fields):
+    return dict({'device_id': device_id, 'unit_id': f'U{device_id}', 'latitude': latitude, 'longitude': longitude,
+                 'speed': 0, 'timestamp': timestamp, 'is_active': True}, **fields)
+
+def test_tiles_contain_their_positions():
+    for latitude, longitude in ((0.5, 0.5), (52.23, 21.01), (-33.9, 151.2), (89.9, -179.9), (-89.9, 179.9)):
+        for level in (0, 5, MAX_LEVEL):
+            south, west, north, east = tile_bounds(*tile_xy(latitude, longitude, level), level)
+            assert west <= longitude <= east
+            assert south <= min(max(latitude, -spatial_index.MAX_LATITUDE), spatial_index.MAX_LATITUDE) <= north
+
+def test_viewport_returns_devices_inside_the_box():
+    index = SpatialIndex()
+    index.upsert([position(1, 52.2, 21.0), position(2, 52.3, 21.1), position(3, 50.0, 19.9)])
+    result = index.viewport(20.5, 52.0, 21.5, 52.5, zoom=10)
+    assert sorted(device['device_id'] for device in result['devices']) == [1, 2]
+    assert (result['count'], result['clusters']) == (2, [])
+    assert result['fleet'] == {'total': 3, 'active': 3, 'moving': 0}
+
+def test_viewport_clusters_past_max_markers():
+    index = SpatialIndex(max_markers=2)
+    index.upsert([position(1, 52.2, 21.0), position(2, 52.2001, 21.0001, is_active=False),
+                  position(3, 52.2002, 21.0002), position(4, 10.0, 10.0)])
+    result = index.viewport(-180, -80, 180, 80, zoom=3)
+    [cluster] = result['clusters']
+    assert (cluster['count'], cluster['active']) == (3, 2)
+    assert cluster['latitude'] == pytest.approx(52.2001)
+    # Lone devices stay markers
+    assert [device['device_id'] for device in result['devices']] == [4]
+
+def test_viewport_across_the_antimeridian():
+    index = SpatialIndex()
+    index.upsert([position(1, -17.0, 179.5), position(2, -17.0, -179.5), position(3, -17.0, 170.0)])
+    for west, east in ((179.0, -179.0), (179.0, 181.0), (-181.0, -179.0)):
+        devices = index.viewport(west, -18.0, east, -16.0, zoom=8)['devices']
+        assert sorted(device['device_id'] for device in devices) == [1, 2]
+    assert index.viewport(-200, -18.0, 200, -16.0, zoom=1)['count'] == 3
+
+def test_nearest_matches_a_full_scan():
+    rng = random.Random(7)
+    devices = [position(n, rng.uniform(-60, 60), rng.uniform(-180, 180)) for n in range(300)]
+    devices += [position(300, 51.5, -0.1), position(301, 51.5001, -0.1001)]
+    index = SpatialIndex()
+    index.upsert(devices)
+    for latitude, longitude in ((51.5, -0.1), (0.0, 179.9), (-45.0, -70.0)):
+        expected = sorted(devices, key=lambda device: haversine_km(latitude, longitude, device['latitude'],
+                                                                   device['longitude']))[:5]
+        result = index.nearest(latitude, longitude, k=5)
+        assert [device['device_id'] for device in result] == [device['device_id'] for device in expected]
+        assert [device['distance_km'] for device in result] == sorted(device['distance_km'] for device in result)
+    assert SpatialIndex().nearest(0, 0) == []
+
+def test_upsert_moves_devices_forward_only():
+    index = SpatialIndex()
+    index.upsert([position(1, 52.2, 21.0, device_name='Truck', speed=40)])
+    assert index.fleet() == {'total': 1, 'active': 1, 'moving': 1}
+
+    # Older and unpositioned updates are ignored
+    index.upsert([position(1, 10.0, 10.0, timestamp='2024-07-01T11:00:00'),
+                  position(1, None, 10.0, timestamp='2024-07-01T13:00:00')])
+    assert index.nearest(52.2, 21.0, k=1)[0]['distance_km'] == 0
+
+    # Live events don't carry the name, so the indexed one is kept
+    moved = position(1, 10.0, 10.0, timestamp='2024-07-01T13:00:00')
+    index.upsert([moved])
+    assert index.viewport(20.5, 52.0, 21.5, 52.5, zoom=10)['devices'] == []
+    [device] = index.viewport(9.5, 9.5, 10.5, 10.5, zoom=10)['devices']
+    assert device['device_name'] == 'Truck'
+    assert index.fleet() == {'total': 1, 'active': 1, 'moving': 0}
+    assert index.stats()['occupied_cells'] == 1
+
+    index.rename(1, 'Van')
+    assert index.nearest(10.0, 10.0, k=1)[0]['device_name'] == 'Van'
+    assert index.bounds() == (10.0, 10.0, 10.0, 10.0)
+
+@pytest.fixture
+def fresh_index(app, monkeypatch):
+    """A process index loaded from the database on first use"""
+    index = SpatialIndex(sync_seconds=0)
+    monkeypatch.setattr(spatial_index, '_spatial_index', index)
+    return index
+
+def store(unit_id, latitude, longitude, minute=0):
+    ingest.store_tracking_entries([{'unit_id': unit_id, 'latitude': latitude, 'longitude': longitude,
+                                    'speed': 0, 'timestamp': datetime(2024, 7, 1, 12, minute)}])
+    db.session.commit()
+
+def test_map_apis_read_the_stored_positions(admin_client, fresh_index, unit_id):
+    # Far from where other tests put their devices
+    store(unit_id, -62.5, 155.5)
+    response = admin_client.get('/api/map/viewport?bbox=155,-63,156,-62&zoom=9')
+    assert response.status_code == 200
+    assert [device['unit_id'] for device in response.get_json()['devices']] == [unit_id]
+    assert fresh_index.loaded
+
+    # Committed points reach the loaded index without a sync
+    fresh_index.sync_seconds = 3600
+    store(unit_id, -62.7, 155.7, minute=1)
+    [device] = admin_client.get('/api/map/nearest?lat=-62.7&lon=155.7&k=1').get_json()['devices']
+    assert (device['unit_id'], device['distance_km']) == (unit_id, 0)
+
+def test_map_apis_check_their_arguments(admin_client, fresh_index):
+    assert admin_client.get('/api/map/viewport?bbox=1,2,3').status_code == 400
+    assert admin_client.get('/api/map/nearest?lat=1').status_code == 400
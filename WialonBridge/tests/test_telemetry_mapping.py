@@ -0,0 +1,94 @@
+"""Sensor descriptor lookups and calibration, per value and as one NumPy batch"""
+
+import json
+
+import pytest
+
+import telemetry_mapping
+import webhook_parser
+from telemetry_mapping import (SENSOR_DESCRIPTORS, get_sensor_descriptor, calibrate, apply_sensor_calibration,
+                               get_sensor_category, parse_sensor_code, calibrate_batch)
+
+def test_documented_codes_come_from_the_table():
+    descriptor = get_sensor_descriptor('sensor8200')
+    assert descriptor is SENSOR_DESCRIPTORS['sensor8200']
+    assert (descriptor.sensor_id, descriptor.name, descriptor.unit, descriptor.category) == \
+        (8200, 'SENSOR_ENGINE_TEMPERATURE', '°C', 'engine')
+    assert (descriptor.multiplier, descriptor.offset) == (1.0, -40.0)
+
+def test_uncommon_codes_resolve_through_the_id():
+    # Leading zeros name the same sensor
+    assert get_sensor_descriptor('sensor08200') == SENSOR_DESCRIPTORS['sensor8200']
+    undocumented = get_sensor_descriptor('sensor99999')
+    assert (undocumented.sensor_id, undocumented.name, undocumented.type, undocumented.category) == \
+        (99999, 'SENSOR_UNKNOWN_99999', 'unknown', 'other')
+    assert get_sensor_descriptor('sensor99999') is undocumented
+
+@pytest.mark.parametrize('code', ['sensor', 'sensorX1', 'temp8200', 'sensor0', None, 8200])
+def test_non_sensor_codes_have_no_descriptor(code):
+    assert get_sensor_descriptor(code) is None
+
+def test_parse_sensor_code():
+    assert parse_sensor_code('sensor12') == 12
+    assert parse_sensor_code('sensor1.5') is None
+    assert parse_sensor_code(12) is None
+
+@pytest.mark.parametrize('raw_value, expected', [
+    (125, 85.0), ('125', 85.0), ('1e2', 60.0), ('hot', 'hot'), (None, None),
+])
+def test_calibrate(raw_value, expected):
+    assert calibrate(SENSOR_DESCRIPTORS['sensor8200'], raw_value) == expected
+
+def test_apply_sensor_calibration():
+    assert apply_sensor_calibration(8200, '125') == 85.0
+    assert apply_sensor_calibration(99999, '7') == 7.0
+    # Ids that don't name a sensor leave the value alone
+    assert apply_sensor_calibration(0, '125') == '125'
+    assert apply_sensor_calibration('x', 3) == 3
+
+def test_sensor_category():
+    assert get_sensor_category('SENSOR_MODEM_ON') == 'connectivity'
+    assert get_sensor_category('SENSOR_NOT_LISTED') == 'other'
+
+BATCH_CODES = ['sensor8200', 'sensor8201', 'sensor1', 'sensor99999', 'sensor8200', 'sensor8202']
+BATCH_VALUES = ['125', 40.5, 'true', '-3', 'n/a', None]
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_batch_calibration_matches_per_value(use_numpy, monkeypatch):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(telemetry_mapping, 'np', None)
+    descriptors = [get_sensor_descriptor(code) for code in BATCH_CODES]
+    expected = [calibrate(descriptor, value) for descriptor, value in zip(descriptors, BATCH_VALUES)]
+    assert expected == [85.0, 40.5, 'true', -3.0, 'n/a', None]
+    assert calibrate_batch(descriptors, BATCH_VALUES) == expected
+    # All-numeric columns take the single fromiter pass
+    assert calibrate_batch(descriptors[:2], ['125', 40.5]) == [85.0, 40.5]
+    assert calibrate_batch([], []) == []
+
+def test_large_requests_are_calibrated_as_one_batch(monkeypatch):
+    from webhook_parser import WebhookPayload, parse_wialon_data
+
+    details = [{'sensorCode': 'sensor8200', 'value': '125'}, {'sensorCode': 'sensor1', 'value': 'true'},
+               {'sensorCode': 'sensor8202', 'value': 'n/a'}, {'sensorCode': 'sensor8201', 'value': None}]
+    body = json.dumps([{'unit_id': f'U{n}', 'lat': 1, 'lon': 2, 'time': 1700000000, 'telemetryDetails': details}
+                       for n in range(3)]).encode()
+
+    def parse():
+        return [entry['telemetry'] for entry in parse_wialon_data(WebhookPayload(body, 'application/json'))]
+
+    batches = []
+    monkeypatch.setattr(webhook_parser, 'calibrate_batch',
+                        lambda descriptors, values: batches.append(len(values)) or calibrate_batch(descriptors, values))
+    monkeypatch.setattr(telemetry_mapping, 'BATCH_CALIBRATION_THRESHOLD', 0)
+    per_value = parse()
+    assert batches == []
+    monkeypatch.setattr(telemetry_mapping, 'BATCH_CALIBRATION_THRESHOLD', 9)
+    assert parse() == per_value
+    # Readings without a value aren't queued; the rest of the request is one batch
+    assert batches == [9]
+    assert per_value[0]['SENSOR_ENGINE_TEMPERATURE'] == {
+        'value': 85.0, 'raw_value': '125', 'unit': '°C', 'type': 'numeric', 'category': 'engine', 'sensor_id': 8200,
+    }
+    assert per_value[0]['SENSOR_ENGINE_LOAD']['value'] == 'n/a'
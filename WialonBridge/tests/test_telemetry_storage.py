@@ -0,0 +1,120 @@
+"""Telemetry as TelemetryValue rows: packing, reading back and migrating legacy JSON"""
+
+import json
+from datetime import datetime
+
+import migrate_telemetry
+from conftest import db
+from telemetry_mapping import pack_telemetry, unpack_telemetry
+
+TELEMETRY = {
+    'SENSOR_ENGINE_TEMPERATURE': {'value': 85.0, 'raw_value': 125, 'unit': '°C', 'type': 'numeric',
+                                  'category': 'engine', 'sensor_id': 8200},
+    'SENSOR_MODEM_ON': {'value': 'true', 'raw_value': 'true', 'unit': '', 'type': 'bool',
+                        'category': 'connectivity', 'sensor_id': 1},
+    'SENSOR_FUEL_LEVEL_2': {'value': 40.5, 'raw_value': 40.5, 'unit': '%', 'type': 'numeric',
+                            'category': 'other', 'sensor_id': 8201},
+}
+
+def test_pack_keeps_values_and_drops_descriptors():
+    assert sorted(pack_telemetry(TELEMETRY)) == [(1, None, 'true'), (8200, 85.0, None), (8201, 40.5, None)]
+    assert pack_telemetry({'x': {'sensor_id': 8200, 'value': None}}) == []
+
+def test_unpack_joins_descriptors_from_the_sensor_map():
+    telemetry = unpack_telemetry(pack_telemetry(TELEMETRY))
+    assert telemetry['SENSOR_ENGINE_TEMPERATURE'] == TELEMETRY['SENSOR_ENGINE_TEMPERATURE']
+    assert telemetry['SENSOR_MODEM_ON'] == TELEMETRY['SENSOR_MODEM_ON']
+    # Categories come from the current map, not from what was stored
+    assert telemetry['SENSOR_FUEL_LEVEL_2']['category'] == 'engine'
+    # Readings of ids that aren't sensors are skipped
+    assert unpack_telemetry([(0, 1.0, None)]) == {}
+
+def make_point(unit_id, **fields):
+    from models import Device, TrackingData
+
+    device = Device.query.filter_by(unit_id=unit_id).first()
+    if device is None:
+        device = Device(unit_id=unit_id)
+        db.session.add(device)
+        db.session.flush()
+    point = TrackingData(device_id=device.id, latitude=1, longitude=2, timestamp=datetime(2024, 2, 1), **fields)
+    db.session.add(point)
+    db.session.flush()
+    return point
+
+def test_points_read_back_their_readings(app, unit_id):
+    from models import TrackingData
+
+    point = make_point(unit_id)
+    point.set_telemetry(TELEMETRY)
+    db.session.commit()
+    db.session.expire_all()
+    assert db.session.get(TrackingData, point.id).telemetry['SENSOR_ENGINE_TEMPERATURE']['value'] == 85.0
+
+def test_migration_moves_legacy_json_and_can_run_again(app, unit_id):
+    from models import TrackingData, TelemetryValue
+
+    legacy = make_point(unit_id, telemetry_data=json.dumps(TELEMETRY))
+    broken = make_point(unit_id, telemetry_data='{not json')
+    empty = make_point(unit_id, telemetry_data='[]')
+    db.session.commit()
+    ids = legacy.id, broken.id, empty.id
+    start = min(ids) - 1
+
+    last_id, migrated, readings, skipped = migrate_telemetry.migrate_batch(start, 100, dry_run=True)
+    assert (last_id, migrated, readings, skipped) == (max(ids), 2, 3, 1)
+    db.session.rollback()
+    assert TelemetryValue.query.filter_by(tracking_id=legacy.id).count() == 0
+
+    assert migrate_telemetry.migrate_batch(start, 100)[1:] == (2, 3, 1)
+    db.session.expire_all()
+    migrated_point = db.session.get(TrackingData, legacy.id)
+    assert migrated_point.telemetry_data is None
+    assert migrated_point.telemetry['SENSOR_ENGINE_TEMPERATURE']['value'] == 85.0
+    assert db.session.get(TrackingData, broken.id).telemetry_data == '{not json'
+    assert db.session.get(TrackingData, empty.id).telemetry_data is None
+
+    # Only the unparseable row is left, and it stays
+    assert migrate_telemetry.migrate_batch(start, 100)[1:] == (0, 0, 1)
+    assert TelemetryValue.query.filter_by(tracking_id=legacy.id).count() == 3
+    db.session.get(TrackingData, broken.id).telemetry_data = None
+    db.session.commit()
+
+def test_migration_works_in_batches(app, unit_id):
+    points = [make_point(unit_id, telemetry_data=json.dumps(TELEMETRY)) for _ in range(3)]
+    db.session.commit()
+    last_id = points[0].id - 1
+    batches = []
+    while True:
+        last_id, migrated, _, _ = migrate_telemetry.migrate_batch(last_id, 2)
+        if last_id is None:
+            break
+        batches.append(migrated)
+    assert batches == [2, 1]
+
+def test_raw_text_is_kept_when_it_cant_be_recomputed():
+    def reading(value, raw_value, sensor_id=8200):
+        return {'SENSOR': {'value': value, 'raw_value': raw_value, 'sensor_id': sensor_id}}
+
+    assert pack_telemetry(reading(85.0, 125)) == [(8200, 85.0, None)]
+    assert pack_telemetry(reading(85.0, '125')) == [(8200, 85.0, '125')]
+    assert pack_telemetry(reading(85.0, '0125')) == [(8200, 85.0, '0125')]
+    # The round trip through the -40 offset loses this float
+    assert pack_telemetry(reading(-40.0, 1e-12)) == [(8200, -40.0, '1e-12')]
+    assert pack_telemetry(reading(40.5, 40.5, sensor_id=8201)) == [(8201, 40.5, None)]
+
+    for raw_value, read_back in ((125, 125.0), ('125', '125'), ('0125', '0125'), (1e-12, '1e-12')):
+        [unpacked] = unpack_telemetry(pack_telemetry(reading(85.0, raw_value))).values()
+        assert (unpacked['value'], unpacked['raw_value']) == (85.0, read_back)
+
+def test_soap_raw_text_survives_storage(client, unit_id):
+    from conftest import TOKEN, stored_points
+    from test_webhook_ingest import SOAP_TEMPLATE
+
+    response = client.post('/webhook/wialon', data=SOAP_TEMPLATE.format(token=TOKEN, unit_id=unit_id),
+                           content_type='application/soap+xml')
+    assert response.status_code == 200
+    [point] = stored_points(unit_id)
+    assert point.telemetry['SENSOR_ENGINE_TEMPERATURE'] == {
+        'value': 45.5, 'raw_value': '85.5', 'unit': '°C', 'type': 'numeric', 'category': 'engine', 'sensor_id': 8200,
+    }
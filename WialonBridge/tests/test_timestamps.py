@@ -0,0 +1,56 @@
+"""Timestamp decoder chain: epochs, ISO, known formats, dateutil and the per-source memory"""
+
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+from timestamps import TimestampDecoder
+
+@pytest.mark.parametrize('value, expected, counter', [
+    (1700000000, datetime(2023, 11, 14, 22, 13, 20), 'epoch'),
+    (1700000000500, datetime(2023, 11, 14, 22, 13, 20, 500000), 'epoch'),
+    ('1700000000.25', datetime(2023, 11, 14, 22, 13, 20, 250000), 'epoch'),
+    ('-86400', datetime(1969, 12, 31), 'epoch'),
+    ('2024-01-02T03:04:05Z', datetime(2024, 1, 2, 3, 4, 5), 'iso'),
+    ('2024-01-02T05:04:05+02:00', datetime(2024, 1, 2, 3, 4, 5), 'iso'),
+    ('02.01.2024 03:04:05', datetime(2024, 1, 2, 3, 4, 5), 'format'),
+    ('2024/01/02 03:04:05', datetime(2024, 1, 2, 3, 4, 5), 'format'),
+    ('20240102030405', datetime(2024, 1, 2, 3, 4, 5), 'format'),
+    ('Tue, 02 Jan 2024 03:04:05 GMT', datetime(2024, 1, 2, 3, 4, 5), 'format'),
+    ('01/02/2024 3:04 PM', datetime(2024, 1, 2, 15, 4), 'dateutil'),
+])
+def test_each_decoder_in_the_chain(value, expected, counter):
+    decoder = TimestampDecoder()
+    assert decoder.decode(value) == expected
+    assert decoder.stats()[counter] == 1
+
+def test_aware_datetimes_become_naive_utc():
+    value = datetime(2024, 1, 2, 5, 4, 5, tzinfo=timezone(timedelta(hours=2)))
+    assert TimestampDecoder().decode(value) == datetime(2024, 1, 2, 3, 4, 5)
+
+@pytest.mark.parametrize('value', [None, True, '', '   ', 'not a date', float('inf')])
+def test_unparseable_values_give_none(value):
+    assert TimestampDecoder().decode(value) is None
+
+def test_source_decoder_is_remembered():
+    decoder = TimestampDecoder()
+    assert decoder.decode('02.01.2024 03:04:05', 'U1') == datetime(2024, 1, 2, 3, 4, 5)
+    assert decoder.decode('03.01.2024 03:04:05', 'U1') == datetime(2024, 1, 3, 3, 4, 5)
+    # Another format from the same source goes through the chain again and is remembered instead
+    assert decoder.decode('2024-01-04T03:04:05', 'U1') == datetime(2024, 1, 4, 3, 4, 5)
+    assert decoder.decode('2024-01-05T03:04:05', 'U1') == datetime(2024, 1, 5, 3, 4, 5)
+    stats = decoder.stats()
+    assert (stats['format'], stats['iso'], stats['remembered'], stats['sources']) == (1, 1, 2, 1)
+
+def test_remembered_sources_are_bounded():
+    decoder = TimestampDecoder(max_sources=2)
+    for source in ('U1', 'U2', 'U3'):
+        decoder.decode('2024-01-02T03:04:05', source)
+    assert decoder.stats()['sources'] == 1
+
+def test_compact_date_from_a_source_remembered_as_epoch():
+    decoder = TimestampDecoder()
+    assert decoder.decode('1700000000', 'U1') == datetime(2023, 11, 14, 22, 13, 20)
+    assert decoder.decode('20240102030405', 'U1') == datetime(2024, 1, 2, 3, 4, 5)
+    # And back: an epoch from a source remembered as compact dates
+    assert decoder.decode('1700000000', 'U1') == datetime(2023, 11, 14, 22, 13, 20)
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import track
+from conftest import db
+
+@pytest.mark.parametrize('timestamp', [datetime(2024, 5, 1, 12, 0, 0, 250), datetime(1969, 12, 31, 23, 59, 59, 5)])
+def test_cursor_round_trip(timestamp):
+    assert track.decode_cursor(track.encode_cursor(timestamp, 42)) == (timestamp, 42)
+
+@pytest.mark.parametrize('cursor', ['', '123', '-1000-5', 'abc.1', '1.x', '99999999999999999999999.1'])
+def test_malformed_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        track.decode_cursor(cursor)
+
+@pytest.fixture
+def device(app, unit_id):
+    from models import Device, TrackingData
+
+    device = Device(unit_id=unit_id)
+    db.session.add(device)
+    db.session.flush()
+    # Points before 1970 have negative cursor keys
+    start = datetime(1969, 12, 31, 23, 0)
+    db.session.add_all([
+        TrackingData(device_id=device.id, latitude=52.0 + i * 0.01, longitude=21.0, timestamp=start + timedelta(minutes=i))
+        for i in range(5)
+    ])
+    db.session.commit()
+    return device
+
+def test_track_pages_across_1970(app, admin_client, device, monkeypatch):
+    monkeypatch.setitem(app.config, 'TRACK_MAX_POINTS', 2)
+    url = f'/api/devices/{device.id}/track?from=1969-12-31T00:00:00&to=1970-01-02T00:00:00&tolerance=0'
+    times, cursor = [], None
+    for _ in range(5):
+        response = admin_client.get(url + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200
+        data = response.get_json()
+        times += data['times']
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+    assert times == [-3600.0 + 60 * i for i in range(5)]
+
+@pytest.mark.parametrize('query', ['cursor=-1000-5', 'cursor=garbage', 'tolerance=-1', 'tolerance=nan'])
+def test_bad_track_parameters_are_rejected(admin_client, device, query):
+    response = admin_client.get(f'/api/devices/{device.id}/track?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
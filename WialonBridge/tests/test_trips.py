@@ -0,0 +1,141 @@
+"""Trip and stop segmentation: the state machine, late points, saved state and rebuilds"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import ingest
+import trips
+from conftest import db
+from trips import TripSegmenter, make_point, new_state, dump_state, load_state
+
+START = datetime(2024, 7, 1, 8, 0)
+
+# About 0.71 km between consecutive longitudes at this latitude
+LATITUDE = 50.0
+STEP = 0.01
+
+def points(*specs):
+    """Segmenter points from (minute, longitude steps, speed[, ignition[, fuel]])"""
+    result = []
+    for spec in specs:
+        minute, steps, speed, ignition, fuel = (spec + (None, None))[:5]
+        result.append(make_point(minute * 100, START + timedelta(minutes=minute), LATITUDE, 20.0 + steps * STEP,
+                                 speed, ignition, fuel))
+    return result
+
+def segment(specs, segmenter=None):
+    segmenter = segmenter or TripSegmenter(reorder_seconds=0)
+    state = new_state()
+    trips_ended, stops_ended, late = segmenter.add(state, points(*specs))
+    return state, trips_ended, stops_ended, late
+
+# Parked, four minutes of driving, then idle long enough for a stop
+DRIVE = [(0, 0, 0), (1, 0, 0), (2, 1, 40, True, 80.0), (3, 2, 40), (4, 3, 40), (5, 4, 40, True, 79.5),
+         (6, 4, 0), (7, 4, 0), (8, 4, 0), (9, 4, 0)]
+
+def test_trip_runs_from_the_last_stopped_point_to_the_first_idle_one():
+    state, [trip], [stop], late = segment(DRIVE)
+    assert (trip['start_time'], trip['end_time']) == (START + timedelta(minutes=1), START + timedelta(minutes=6))
+    assert (trip['start_tracking_id'], trip['end_tracking_id']) == (100, 600)
+    assert trip['distance_km'] == pytest.approx(4 * 0.715, abs=0.01)
+    assert trip['avg_speed'] == pytest.approx(trip['distance_km'] / (5 / 60), abs=0.1)
+    assert (trip['max_speed'], trip['point_count']) == (40, 6)
+    assert (trip['start_fuel'], trip['end_fuel'], trip['fuel_delta']) == (80.0, 79.5, -0.5)
+
+    # The stop before the trip is written when the trip ends; the one after it is still open
+    assert (stop['start_time'], stop['end_time'], stop['duration_seconds']) == (START, START + timedelta(minutes=1), 60)
+    assert state['trip'] is None and state['stop']['start']['id'] == 600
+    assert late == 0
+
+def test_ignition_off_ends_the_trip_at_once():
+    _, [trip], _, _ = segment([(0, 0, 0), (1, 1, 40), (2, 2, 40), (3, 3, 40), (4, 3, 0, False)])
+    assert trip['end_time'] == START + timedelta(minutes=4)
+    # Speed with the ignition off isn't moving
+    state, ended, _, _ = segment([(0, 0, 0), (1, 1, 40, False), (2, 2, 40, False)])
+    assert ended == [] and state['trip'] is None
+
+def test_silence_ends_the_trip_at_its_last_point():
+    state, [trip], _, _ = segment([(0, 0, 0), (1, 1, 40), (2, 2, 40), (3, 3, 40), (10, 3, 40)])
+    assert trip['end_time'] == START + timedelta(minutes=3)
+    # The point after the silence starts a trip of its own
+    assert state['trip']['start']['t'] == START + timedelta(minutes=10)
+
+def test_short_trips_are_dropped_and_the_stop_goes_on():
+    state, ended, stops_ended, _ = segment([(0, 0, 0), (1, 0.1, 20), (2, 0.2, 0), (3, 0.2, 0), (4, 0.2, 0),
+                                            (5, 0.2, 0)])
+    assert (ended, stops_ended) == ([], [])
+    assert state['stop']['start']['t'] == START
+
+def test_points_are_reordered_and_late_ones_ignored():
+    in_order = segment(DRIVE)[1]
+    segmenter = TripSegmenter(reorder_seconds=180)
+    state = new_state()
+    driven = points(*DRIVE)
+    ended = []
+    # Points up to three minutes out of order are put back in order
+    for batch in (driven[:2], driven[4:6], driven[2:4], driven[6:]):
+        ended += segmenter.add(state, batch)[0]
+    assert ended == []
+    assert [point['id'] for point in state['buffer']] == [700, 800, 900]
+    ended += segmenter.add(state, points((12, 4, 0)))[0]
+    assert ended == in_order
+
+    _, _, late = segmenter.add(state, points((4.5, 3, 40)))
+    assert late == 1 and state['watermark'] == START + timedelta(minutes=9)
+
+def test_saved_state_continues_where_it_left_off():
+    segmenter = TripSegmenter(reorder_seconds=0)
+    state = new_state()
+    driven = points(*DRIVE)
+    segmenter.add(state, driven[:4])
+    assert state['trip'] is not None
+    saved = dump_state(state)
+    assert isinstance(saved, str)
+    restored = load_state(saved)
+    assert restored == state
+    assert segmenter.add(restored, driven[4:])[0] == segment(DRIVE)[1]
+
+@pytest.fixture
+def segmenter(app, monkeypatch):
+    """The ingest segmenter without a reorder delay"""
+    segmenter = TripSegmenter(reorder_seconds=0)
+    monkeypatch.setattr(trips, '_trip_segmenter', segmenter)
+    return segmenter
+
+def store(unit_id, specs):
+    ingest.store_tracking_entries([
+        {'unit_id': unit_id, 'latitude': point['lat'], 'longitude': point['lon'], 'speed': point['speed'],
+         'timestamp': point['t'], 'fuel_level': point['fuel'],
+         'telemetry': {'SENSOR_IGNITION': {'sensor_id': 109, 'value': 'false'}} if point['ignition'] is False else {}}
+        for point in points(*specs)
+    ])
+    db.session.commit()
+
+def test_ingest_segments_trips_and_rebuild_agrees(admin_client, segmenter, unit_id):
+    from models import Device, Trip, Stop
+
+    store(unit_id, DRIVE[:5])
+    device = Device.query.filter_by(unit_id=unit_id).one()
+    current = admin_client.get(f'/api/devices/{device.id}/trips?from=2024-07-01T00:00:00').get_json()['current']
+    assert current['phase'] == 'trip' and current['since'] == (START + timedelta(minutes=1)).isoformat()
+
+    store(unit_id, DRIVE[5:] + [(20, 4, 40), (21, 5, 40), (22, 6, 40), (23, 6, 0, False)])
+    result = admin_client.get(f'/api/devices/{device.id}/trips?from=2024-07-01T00:00:00').get_json()
+    assert [(trip['start_time'], trip['duration_seconds']) for trip in result['trips']] == [
+        ((START + timedelta(minutes=20)).isoformat(), 180), ((START + timedelta(minutes=1)).isoformat(), 300)]
+    assert result['trips'][1]['fuel_delta'] == -0.5
+    assert [stop['duration_seconds'] for stop in result['stops']] == [14 * 60, 60]
+    assert result['current']['phase'] == 'stop'
+    assert segmenter.stats()['trips'] == 2
+
+    def stored():
+        db.session.expire_all()
+        return ([(trip.start_time, trip.end_time, trip.distance_km, trip.start_tracking_id)
+                 for trip in Trip.query.filter_by(device_id=device.id).order_by(Trip.start_time)],
+                [(stop.start_time, stop.end_time) for stop in Stop.query.filter_by(device_id=device.id)
+                 .order_by(Stop.start_time)])
+    ingested = stored()
+    assert trips.rebuild_device(device.id, TripSegmenter(reorder_seconds=0)) == 2
+    assert stored() == ingested
+    assert trips.device_phase(device.id)['phase'] == 'stop'
@@ -0,0 +1,97 @@
+"""Webhook ingest: every body format ends up as stored points"""
+
+import json
+
+from conftest import TOKEN, stored_points
+
+BEARER = {'Authorization': f'Bearer {TOKEN}'}
+
+SOAP_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:web="http://webservice.retranslator.wialon">
+    <soapenv:Header>
+        <wsse:Security xmlns:wsse="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd">
+            <wsse:UsernameToken>
+                <wsse:Username>{token}</wsse:Username>
+            </wsse:UsernameToken>
+        </wsse:Security>
+    </soapenv:Header>
+    <soapenv:Body>
+        <web:submitData>
+            <unitId>{unit_id}</unitId>
+            <latitude>40.7589</latitude>
+            <longitude>-73.9851</longitude>
+            <speed>45.6</speed>
+            <timestamp>2025-08-05T10:48:00Z</timestamp>
+            <telemetryDetails>
+                <sensorCode>sensor8200</sensorCode>
+                <value>85.5</value>
+            </telemetryDetails>
+        </web:submitData>
+    </soapenv:Body>
+</soapenv:Envelope>"""
+
+def test_json_points_are_stored(client, unit_id):
+    body = [
+        {'unitId': unit_id, 'lat': 1.5, 'lon': 2.5, 'speed': 10, 'time': 1700000000},
+        {'unitId': unit_id, 'lat': 1.6, 'lon': 2.6, 'speed': 20, 'time': 1700000060},
+    ]
+    response = client.post('/webhook/wialon', data=json.dumps(body), content_type='application/json',
+                           headers=BEARER)
+    assert response.status_code == 200
+    assert response.get_json()['processed_count'] == 2
+    assert [(point.latitude, point.speed) for point in stored_points(unit_id)] == [(1.5, 10), (1.6, 20)]
+
+def test_form_point_with_bearer_token_is_stored(client, unit_id):
+    response = client.post('/webhook/wialon', data=f'unit_id={unit_id}&lat=1&lon=2',
+                           content_type='application/x-www-form-urlencoded', headers=BEARER)
+    assert response.status_code == 200
+    assert [(point.latitude, point.longitude) for point in stored_points(unit_id)] == [(1, 2)]
+
+def test_form_point_with_api_key_in_body_is_stored(client, unit_id):
+    response = client.post('/webhook/wialon', data=f'unit_id={unit_id}&lat=3&lon=4&api_key={TOKEN}',
+                           content_type='application/x-www-form-urlencoded')
+    assert response.status_code == 200
+    assert [(point.latitude, point.longitude) for point in stored_points(unit_id)] == [(3, 4)]
+
+def test_multipart_form_point_is_stored(client, unit_id):
+    response = client.post('/webhook/wialon', data={'unit_id': unit_id, 'lat': '5', 'lon': '6'},
+                           content_type='multipart/form-data', headers=BEARER)
+    assert response.status_code == 200
+    assert [(point.latitude, point.longitude) for point in stored_points(unit_id)] == [(5, 6)]
+
+def test_soap_point_is_stored(client, unit_id):
+    response = client.post('/webhook/wialon', data=SOAP_TEMPLATE.format(token=TOKEN, unit_id=unit_id),
+                           content_type='application/soap+xml')
+    assert response.status_code == 200
+    points = stored_points(unit_id)
+    assert [(point.latitude, point.speed) for point in points] == [(40.7589, 45.6)]
+    assert points[0].telemetry['SENSOR_ENGINE_TEMPERATURE']['value'] == 45.5
+
+def test_unauthenticated_request_is_rejected(client, unit_id):
+    response = client.post('/webhook/wialon', data=f'unit_id={unit_id}&lat=1&lon=2&api_key=wrong',
+                           content_type='application/x-www-form-urlencoded')
+    assert response.status_code == 401
+    assert stored_points(unit_id) == []
+
+def test_body_without_points_is_rejected(client):
+    response = client.post('/webhook/wialon', data='lat=1&lon=2',
+                           content_type='application/x-www-form-urlencoded', headers=BEARER)
+    assert response.status_code == 400
+
+def test_failure_while_sampling_the_body_is_logged(client, monkeypatch):
+    from models import WebhookLog
+    from webhook_parser import WebhookPayload
+    from webhook_log_buffer import get_webhook_log_buffer
+
+    def broken_sample(self, limit=5000):
+        raise RuntimeError("sample failed")
+
+    monkeypatch.setattr(WebhookPayload, 'sample', broken_sample)
+    response = client.post('/webhook/wialon', data='unit_id=X&lat=1&lon=2',
+                           content_type='application/x-www-form-urlencoded', headers=BEARER)
+    assert response.status_code == 500
+    log_buffer = get_webhook_log_buffer()
+    if log_buffer is not None:
+        log_buffer.flush()
+    log = WebhookLog.query.filter_by(error_message="sample failed").first()
+    assert log is not None and log.status_code == 500
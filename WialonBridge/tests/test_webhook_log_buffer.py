@@ -0,0 +1,146 @@
+"""Buffered webhook logs: flushing, the pending cap, body sampling and the retention sweep"""
+
+import itertools
+import time
+from datetime import datetime
+
+import pytest
+
+import webhook_log_buffer
+from conftest import db, TOKEN
+from webhook_log_buffer import WebhookLogBuffer, sample_request_data, cap_error_message
+
+def make_log(user_agent, status_code=400, timestamp=None):
+    from models import WebhookLog
+
+    return WebhookLog(timestamp=timestamp or datetime.utcnow(), endpoint='/webhook/wialon', method='POST',
+                      user_agent=user_agent, status_code=status_code, processing_time_ms=1.0)
+
+def logged(user_agent):
+    from models import WebhookLog
+
+    db.session.expire_all()
+    return WebhookLog.query.filter_by(user_agent=user_agent).count()
+
+def test_flush_writes_pending_rows_in_one_go(app, unit_id):
+    log_buffer = WebhookLogBuffer(app, flush_rows=3)
+    for _ in range(2):
+        log_buffer.add(make_log(unit_id))
+    assert (log_buffer.pending(), logged(unit_id)) == (2, 0)
+
+    assert log_buffer.flush() == 2
+    assert (log_buffer.pending(), logged(unit_id)) == (0, 2)
+    assert log_buffer.flush() == 0
+    assert (log_buffer.written, log_buffer.flushes) == (2, 1)
+
+def test_background_writer_flushes_when_full_or_on_time(app, unit_id):
+    log_buffer = WebhookLogBuffer(app, flush_rows=2, flush_ms=50, retention_days=0)
+    log_buffer.start()
+    try:
+        log_buffer.add(make_log(unit_id))
+        deadline = time.monotonic() + 5
+        while logged(unit_id) < 1 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert logged(unit_id) == 1
+
+        # A full buffer wakes the writer before the interval is up
+        log_buffer.flush_seconds = 60
+        time.sleep(0.2)
+        log_buffer.add(make_log(unit_id))
+        time.sleep(0.2)
+        assert logged(unit_id) == 1
+        log_buffer.add(make_log(unit_id))
+        deadline = time.monotonic() + 5
+        while logged(unit_id) < 3 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert logged(unit_id) == 3
+    finally:
+        log_buffer.stop()
+
+def test_failed_flush_keeps_rows_up_to_the_cap(app, unit_id, monkeypatch):
+    monkeypatch.setattr(webhook_log_buffer, 'MAX_PENDING_FACTOR', 2)
+    log_buffer = WebhookLogBuffer(app, flush_rows=2)
+
+    def unavailable(rows):
+        raise RuntimeError("database is down")
+    monkeypatch.setattr(log_buffer, '_insert', unavailable)
+    for n in range(3):
+        log_buffer.add(make_log(f'{unit_id}-{n}'))
+    assert log_buffer.flush() == 0
+    assert (log_buffer.pending(), log_buffer.dropped) == (3, 0)
+
+    # Rows that arrive meanwhile go behind the retried ones, the oldest are dropped past the cap
+    for n in range(3, 6):
+        log_buffer.add(make_log(f'{unit_id}-{n}'))
+    assert (log_buffer.pending(), log_buffer.dropped) == (4, 2)
+    assert log_buffer.flush() == 0
+    assert log_buffer.pending() == 4
+
+    monkeypatch.undo()
+    assert log_buffer.flush() == 4
+    assert [logged(f'{unit_id}-{n}') for n in range(6)] == [0, 0, 1, 1, 1, 1]
+
+def test_successful_bodies_are_sampled(app, monkeypatch):
+    monkeypatch.setattr(webhook_log_buffer, '_success_counter', itertools.count())
+    monkeypatch.setitem(app.config, 'WEBHOOK_LOG_SAMPLE_RATE', 3)
+    monkeypatch.setitem(app.config, 'WEBHOOK_LOG_SAMPLE_CHARS', 4)
+
+    assert [sample_request_data(200, 'body-text') for _ in range(4)] == ['body', None, None, 'body']
+    # Every failure keeps its body
+    assert [sample_request_data(400, 'body-text') for _ in range(2)] == ['body', 'body']
+    assert sample_request_data(500, '') == ''
+    assert cap_error_message('error text') == 'erro'
+    assert cap_error_message(None) is None
+
+    monkeypatch.setitem(app.config, 'WEBHOOK_LOG_SAMPLE_RATE', 0)
+    assert sample_request_data(200, 'body-text') is None
+
+def test_rejected_requests_are_buffered(client, unit_id, monkeypatch):
+    log_buffer = WebhookLogBuffer(client.application, flush_rows=100)
+    monkeypatch.setattr(webhook_log_buffer, '_webhook_log_buffer', log_buffer)
+    headers = {'Authorization': f'Bearer {TOKEN}', 'User-Agent': unit_id}
+
+    assert client.post('/webhook/wialon', data='lat=1&lon=2', headers=headers,
+                       content_type='application/x-www-form-urlencoded').status_code == 400
+    assert (log_buffer.pending(), logged(unit_id)) == (1, 0)
+    # Successful requests write their log row with the points that refer to it
+    assert client.post('/webhook/wialon', json={'unit_id': unit_id, 'lat': 1, 'lon': 2},
+                       headers=headers).status_code == 200
+    assert (log_buffer.pending(), logged(unit_id)) == (1, 1)
+    log_buffer.flush()
+    assert logged(unit_id) == 2
+
+@pytest.fixture
+def old_logs(app, unit_id):
+    """Ids of a 1950 log with a point linked to it and of a recent log"""
+    from models import Device, TrackingData, TelemetryValue
+
+    old, recent = make_log(unit_id, 200, datetime(1950, 1, 1)), make_log(unit_id, 200)
+    device = Device(unit_id=unit_id)
+    db.session.add_all([old, recent, device])
+    db.session.flush()
+    point = TrackingData(device_id=device.id, latitude=1, longitude=2, timestamp=datetime(1950, 1, 1),
+                         webhook_log_id=old.id)
+    db.session.add(point)
+    db.session.commit()
+    yield old.id, recent.id, point.id
+
+    db.session.rollback()
+    db.session.execute(TelemetryValue.__table__.delete().where(TelemetryValue.tracking_id == point.id))
+    db.session.execute(TrackingData.__table__.delete().where(TrackingData.id == point.id))
+    db.session.commit()
+
+def test_sweep_deletes_expired_logs_and_unlinks_points(app, old_logs):
+    from models import WebhookLog, TrackingData
+
+    old_id, recent_id, point_id = old_logs
+    assert WebhookLogBuffer(app, retention_days=0).sweep() == 0
+    log_buffer = WebhookLogBuffer(app, flush_rows=1, retention_days=(datetime.utcnow() - datetime(1950, 6, 1)).days)
+    assert log_buffer.sweep() >= 1
+    assert log_buffer.swept >= 1
+
+    db.session.expire_all()
+    assert db.session.get(WebhookLog, old_id) is None
+    assert db.session.get(WebhookLog, recent_id) is not None
+    point = db.session.get(TrackingData, point_id)
+    assert point is not None and point.webhook_log_id is None
@@ -0,0 +1,153 @@
+"""
+Fast timestamp decoding for tracking records
+
+Tries the cheap decoders first (epoch numbers, ISO-8601 via datetime.fromisoformat,
+then a short list of strptime formats seen from retranslators) and only falls
+back to dateutil when nothing else matches. The decoder that last worked for
+each source (unit) is tried first next time, so a unit that always sends the
+same format costs one parse attempt per point.
+
+All results are naive UTC datetimes, matching datetime.utcnow() used elsewhere.
+Values without a timezone are taken as UTC, as documented for Wialon.
+"""
+
+import threading
+from datetime import datetime, timezone, timedelta
+from dateutil import parser as date_parser
+
+EPOCH = datetime(1970, 1, 1)
+
+# Epoch values above this are taken as milliseconds (year ~5138 in seconds)
+EPOCH_MILLIS_THRESHOLD = 100_000_000_000
+
+# Non-ISO formats tried before dateutil, most common first. Dotted dates are
+# day-first as Wialon writes them; slashed dates are left to dateutil (month-first)
+KNOWN_FORMATS = (
+    '%d.%m.%Y %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y/%m/%d %H:%M:%S',
+    '%d.%m.%Y %H:%M',
+    '%Y%m%d%H%M%S',
+    '%a, %d %b %Y %H:%M:%S GMT',
+)
+
+def to_naive_utc(value):
+    """Convert an aware datetime to naive UTC; naive values are assumed to be UTC already"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def from_epoch(value):
+    """Unix seconds (or milliseconds) to naive UTC"""
+    value = float(value)
+    if abs(value) >= EPOCH_MILLIS_THRESHOLD:
+        value /= 1000.0
+    return EPOCH + timedelta(seconds=value)
+
+def from_iso(value):
+    return to_naive_utc(datetime.fromisoformat(value))
+
+def from_dateutil(value):
+    return to_naive_utc(date_parser.parse(value))
+
+def _strptime_decoder(fmt):
+    def decode(value):
+        return datetime.strptime(value, fmt)
+    decode.__name__ = f'strptime({fmt})'
+    return decode
+
+_FORMAT_DECODERS = tuple(_strptime_decoder(fmt) for fmt in KNOWN_FORMATS)
+
+def _is_epoch_text(value):
+    """Numeric strings are epochs, except 14-digit compact dates (YYYYmmddHHMMSS)"""
+    digits = value.lstrip('+-').replace('.', '', 1)
+    return digits.isdigit() and not (len(value) == 14 and value.isdigit())
+
+class TimestampDecoder:
+    """Timestamp parser that remembers the last successful format per source"""
+
+    def __init__(self, max_sources=50000):
+        self.max_sources = max_sources
+        self._last_decoder = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            'epoch': 0,
+            'iso': 0,
+            'format': 0,
+            'dateutil': 0,
+            'remembered': 0,
+            'failed': 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def decode(self, value, source=None):
+        """Decode a raw timestamp value to naive UTC, returns None if it can't be parsed"""
+        if value is None or isinstance(value, bool):
+            return None
+
+        try:
+            if isinstance(value, (int, float)):
+                self._count('epoch')
+                return from_epoch(value)
+            if isinstance(value, datetime):
+                return to_naive_utc(value)
+        except (ValueError, OverflowError):
+            self._count('failed')
+            return None
+
+        value = str(value).strip()
+        if not value:
+            return None
+
+        # The remembered decoder only gets values its kind applies to, so a compact
+        # date from a source that sent epochs isn't read as an epoch
+        is_epoch = _is_epoch_text(value)
+        remembered = self._last_decoder.get(source)
+        if remembered is not None and (remembered is from_epoch) == is_epoch:
+            try:
+                result = remembered(value)
+                self._count('remembered')
+                return result
+            except (ValueError, OverflowError, TypeError):
+                pass
+
+        for name, decoder in self._candidates(is_epoch):
+            try:
+                result = decoder(value)
+            except (ValueError, OverflowError, TypeError):
+                continue
+            self._remember(source, decoder)
+            self._count(name)
+            return result
+
+        self._count('failed')
+        return None
+
+    def _candidates(self, is_epoch):
+        if is_epoch:
+            yield 'epoch', from_epoch
+        yield 'iso', from_iso
+        for decoder in _FORMAT_DECODERS:
+            yield 'format', decoder
+        yield 'dateutil', from_dateutil
+
+    def _remember(self, source, decoder):
+        if source is None:
+            return
+        if len(self._last_decoder) >= self.max_sources:
+            self._last_decoder.clear()
+        self._last_decoder[source] = decoder
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, sources=len(self._last_decoder))
+
+# Process-wide decoder used by the webhook parser
+default_decoder = TimestampDecoder()
+
+def decode_timestamp(value, source=None):
+    """Decode a timestamp with the shared decoder"""
+    return default_decoder.decode(value, source)
@@ -0,0 +1,274 @@
+"""
+Simplified track history of one device
+
+A device's points in a time range are read in (timestamp, id) keyset order,
+FETCH_SIZE rows per query, so no query scans past rows already read and a
+page can resume exactly where the previous one stopped. Points closer than the
+tolerance to the last kept one are dropped while reading, and what is left is
+simplified with Douglas-Peucker, so the result stays within about the
+tolerance of the recorded track. The tolerance is given in metres or derived
+from a map zoom level (TRACK_PIXEL_TOLERANCE screen pixels at that zoom), so a
+day of 1-second fixes comes back as a few hundred points at city zoom.
+
+Positions are returned as a Google encoded polyline (precision 5) and the
+times of the kept points as Unix seconds.
+"""
+
+import math
+from datetime import timedelta
+
+from sqlalchemy import select, or_
+
+from geo import EARTH_RADIUS_KM
+from timestamps import TimestampDecoder, EPOCH
+from dedup import timestamp_key
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EARTH_RADIUS_M = EARTH_RADIUS_KM * 1000
+
+# Ground metres per screen pixel at the equator at zoom 0 (256-pixel Web Mercator tiles)
+METRES_PER_PIXEL_ZOOM_0 = 156543.03392
+
+MAX_ZOOM = 22
+
+# Zoom assumed when neither a tolerance nor a zoom is given
+DEFAULT_ZOOM = 14
+
+# Spans shorter than this are searched in Python, where NumPy's call overhead dominates
+NUMPY_MIN_SPAN = 16
+
+# Rows read per keyset query
+FETCH_SIZE = 5000
+
+# Separate decoder so query parameters don't show up in the ingest timestamp stats
+_decoder = TimestampDecoder(max_sources=1)
+
+def parse_time(value):
+    """Decode a from/to query value (ISO-8601 or Unix seconds), None when missing or invalid"""
+    return _decoder.decode(value)
+
+def encode_cursor(timestamp, tracking_id):
+    # '.' can't occur in either integer; the key is negative before 1970
+    return f"{timestamp_key(timestamp)}.{tracking_id}"
+
+def decode_cursor(cursor):
+    """(timestamp, id) of a cursor, raises ValueError when it is malformed"""
+    key, separator, tracking_id = cursor.partition('.')
+    try:
+        if not separator:
+            raise ValueError(cursor)
+        return EPOCH + timedelta(microseconds=int(key)), int(tracking_id)
+    except (ValueError, OverflowError):
+        raise ValueError("Invalid cursor") from None
+
+def tolerance_for_zoom(zoom, latitude, pixels):
+    """Metres covered by pixels screen pixels at a Web Mercator zoom level and latitude"""
+    zoom = min(max(zoom, 0), MAX_ZOOM)
+    return METRES_PER_PIXEL_ZOOM_0 * math.cos(math.radians(latitude)) / 2 ** zoom * pixels
+
+def encode_polyline(points, precision=5):
+    """Google encoded polyline of (latitude, longitude) pairs"""
+    factor = 10 ** precision
+    chunks = []
+    previous_lat = previous_lon = 0
+    for latitude, longitude in points:
+        lat = int(round(latitude * factor))
+        lon = int(round(longitude * factor))
+        for delta in (lat - previous_lat, lon - previous_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        previous_lat, previous_lon = lat, lon
+    return ''.join(chunks)
+
+def project(points, reference_latitude):
+    """Equirectangular (x, y) metres of (latitude, longitude) pairs, accurate over a few hundred km"""
+    scale = math.cos(math.radians(reference_latitude))
+    return [
+        (math.radians(longitude) * scale * EARTH_RADIUS_M, math.radians(latitude) * EARTH_RADIUS_M)
+        for latitude, longitude in points
+    ]
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    dx = bx - ax
+    dy = by - ay
+    length = dx * dx + dy * dy
+    if length:
+        t = min(1.0, max(0.0, ((px - ax) * dx + (py - ay) * dy) / length))
+        ax += t * dx
+        ay += t * dy
+    return math.hypot(px - ax, py - ay)
+
+def _farthest(xy, first, last):
+    """(index, distance) of the point between first and last farthest from their segment"""
+    ax, ay = xy[first]
+    bx, by = xy[last]
+    index, distance = first, 0.0
+    for position in range(first + 1, last):
+        d = _segment_distance(xy[position][0], xy[position][1], ax, ay, bx, by)
+        if d > distance:
+            index, distance = position, d
+    return index, distance
+
+def _farthest_numpy(x, y, first, last):
+    px = x[first + 1:last]
+    py = y[first + 1:last]
+    dx = x[last] - x[first]
+    dy = y[last] - y[first]
+    length = dx * dx + dy * dy
+    if length:
+        t = np.clip(((px - x[first]) * dx + (py - y[first]) * dy) / length, 0.0, 1.0)
+    else:
+        t = 0.0
+    distances = np.hypot(px - (x[first] + t * dx), py - (y[first] + t * dy))
+    position = int(np.argmax(distances))
+    return first + 1 + position, float(distances[position])
+
+def douglas_peucker(xy, tolerance):
+    """Indexes of the projected points kept by Douglas-Peucker, first and last always kept"""
+    count = len(xy)
+    if count < 3 or tolerance <= 0:
+        return list(range(count))
+
+    if np is not None:
+        coordinates = np.asarray(xy, dtype=np.float64)
+        x, y = coordinates[:, 0], coordinates[:, 1]
+
+    def farthest(first, last):
+        if np is None or last - first < NUMPY_MIN_SPAN:
+            return _farthest(xy, first, last)
+        return _farthest_numpy(x, y, first, last)
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    # Explicit stack: a long, smooth track would exceed the recursion limit
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        index, distance = farthest(first, last)
+        if distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [position for position in range(count) if keep[position]]
+
+class RadialFilter:
+    """Drops points closer than the tolerance to the last kept one as they are read"""
+
+    def __init__(self, tolerance, reference_latitude):
+        # Compared in degrees, longitude scaled to the latitude, to keep the loop cheap
+        self.scale = math.cos(math.radians(reference_latitude))
+        self.threshold = (tolerance / (EARTH_RADIUS_M * math.pi / 180)) ** 2
+        self.points = []
+        self._pending = None
+
+    def extend(self, rows):
+        """Add (id, latitude, longitude) rows in track order"""
+        points = self.points
+        scale = self.scale
+        threshold = self.threshold
+        pending = self._pending
+        if points:
+            last_lat, last_lon = points[-1][1], points[-1][2]
+        for row in rows:
+            if points:
+                dlat = row[1] - last_lat
+                dlon = (row[2] - last_lon) * scale
+                if dlat * dlat + dlon * dlon < threshold:
+                    pending = row
+                    continue
+            points.append(row)
+            last_lat, last_lon = row[1], row[2]
+            pending = None
+        self._pending = pending
+
+    def finish(self):
+        """Kept rows, ending with the last row read"""
+        if self._pending is not None:
+            self.points.append(self._pending)
+            self._pending = None
+        return self.points
+
+def _timestamps(db, table, ids):
+    """{id: timestamp} of the kept points"""
+    times = {}
+    for offset in range(0, len(ids), FETCH_SIZE):
+        chunk = ids[offset:offset + FETCH_SIZE]
+        times.update(db.session.execute(select(table.c.id, table.c.timestamp).where(table.c.id.in_(chunk))).all())
+    return times
+
+def simplified_track(device_id, start, end, tolerance=None, zoom=None, pixels=1.0, cursor=None,
+                     max_points=100000):
+    """
+    Simplified points of a device in [start, end), at most max_points rows read
+    Without a tolerance it is derived from zoom at the track's first latitude.
+    Raises ValueError for a malformed cursor or a negative tolerance
+    """
+    from app import db
+    from models import TrackingData
+
+    # NaN fails the comparison too
+    if tolerance is not None and not tolerance >= 0:
+        raise ValueError("tolerance must be a non-negative number of metres")
+
+    table = TrackingData.__table__
+    conditions = [
+        table.c.device_id == device_id,
+        table.c.timestamp >= start,
+        table.c.timestamp < end,
+        table.c.latitude.isnot(None),
+        table.c.longitude.isnot(None),
+    ]
+    after = decode_cursor(cursor) if cursor else None
+
+    points_in = 0
+    radial = None
+    exhausted = False
+    while points_in < max_points:
+        limit = min(FETCH_SIZE, max_points - points_in)
+        # Timestamps are only ordered by here; decoding them is most of the cost of a row
+        query = select(table.c.id, table.c.latitude, table.c.longitude).where(*conditions)
+        if after is not None:
+            # The redundant >= bound lets the (device_id, timestamp) index seek past read rows
+            query = query.where(table.c.timestamp >= after[0],
+                                or_(table.c.timestamp > after[0], table.c.id > after[1]))
+        rows = db.session.execute(query.order_by(table.c.timestamp, table.c.id).limit(limit)).all()
+
+        if rows:
+            if radial is None:
+                if tolerance is None:
+                    tolerance = tolerance_for_zoom(zoom if zoom is not None else DEFAULT_ZOOM, rows[0][1], pixels)
+                radial = RadialFilter(tolerance, rows[0][1])
+            radial.extend(rows)
+            points_in += len(rows)
+        if len(rows) < limit:
+            exhausted = True
+            break
+        last_id = rows[-1][0]
+        after = (db.session.execute(select(table.c.timestamp).where(table.c.id == last_id)).scalar(), last_id)
+
+    points = radial.finish() if radial is not None else []
+    if points:
+        xy = project([(row[1], row[2]) for row in points], points[0][1])
+        points = [points[index] for index in douglas_peucker(xy, tolerance)]
+    times = _timestamps(db, table, [row[0] for row in points])
+
+    return {
+        'device_id': device_id,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'tolerance_m': round(tolerance, 2) if tolerance is not None else None,
+        'points_in': points_in,
+        'points_out': len(points),
+        'polyline': encode_polyline((row[1], row[2]) for row in points),
+        'times': [round((times[row[0]] - EPOCH).total_seconds(), 3) for row in points],
+        'next_cursor': None if exhausted else encode_cursor(*after),
+    }
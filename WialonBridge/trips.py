@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Trips and stops segmented from points as they are ingested
+
+Each device has a small state machine, saved as JSON in TripSegmenterState, that
+the ingest path feeds with the batch's points in the same transaction. Points
+wait in a reorder buffer until they are TRIP_REORDER_SECONDS older than the
+device's newest point and are then processed in time order; points older than
+the last processed one are late and ignored.
+
+A point is moving at TRIP_MOVING_SPEED km/h or more unless the ignition is
+known to be off: from the SENSOR_IGNITION reading, else SENSOR_ENGINE_WORKING,
+else a true ignition_status (the parser stores false when the flag is missing,
+so a false column doesn't count as off). A trip starts at the last stopped
+point before the device moves and ends at its first idle point once it has
+been idle for TRIP_STOP_SECONDS, as soon as the ignition goes off, or at its
+last point when the device is silent for TRIP_STOP_SECONDS. Trips shorter than
+TRIP_MIN_DISTANCE_M are dropped and the stop before them goes on. A Stop row
+covers the time between two trips and is written when the second one ends.
+
+Distance is the haversine sum over the trip's points, avg_speed is distance
+over duration and fuel_delta is the last fuel level minus the first (fuel_level,
+else SENSOR_FUEL_LEVEL_1). The trip a device is on and the stop it is in are
+only in its state until they end.
+
+Usage: python trips.py [--rebuild] [--device UNIT_ID]
+"""
+
+import argparse
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, delete, or_, func
+from sqlalchemy.orm import aliased
+
+from geo import haversine_km
+from telemetry_mapping import XIRGO_SENSOR_MAP
+
+_SENSOR_IDS = {sensor['name']: sensor_id for sensor_id, sensor in XIRGO_SENSOR_MAP.items()}
+
+# Telemetry fallbacks; the engine reading is for devices that only report whether the engine runs
+FUEL_SENSOR_ID = _SENSOR_IDS['SENSOR_FUEL_LEVEL_1']
+IGNITION_SENSOR_ID = _SENSOR_IDS['SENSOR_IGNITION']
+ENGINE_SENSOR_ID = _SENSOR_IDS['SENSOR_ENGINE_WORKING']
+
+# Keys of the saved state holding datetimes
+DATETIME_KEYS = ('t', 'newest', 'watermark')
+
+# Points read per query when rebuilding
+REBUILD_FETCH_SIZE = 5000
+
+def _flag(value, text_value):
+    """Boolean of a sensor reading, None when there is none"""
+    if value is not None:
+        return value != 0
+    if text_value is not None:
+        return text_value.strip().lower() in ('true', '1', 'on')
+    return None
+
+def _ignition(ignition_status, ignition_value, ignition_text, engine_value, engine_text):
+    """True/False from the ignition or engine reading, else True for a true column, else None"""
+    ignition = _flag(ignition_value, ignition_text)
+    if ignition is None:
+        ignition = _flag(engine_value, engine_text)
+    if ignition is None and ignition_status:
+        ignition = True
+    return ignition
+
+def make_point(tracking_id, timestamp, latitude, longitude, speed, ignition, fuel):
+    return {'id': tracking_id, 't': timestamp, 'lat': latitude, 'lon': longitude,
+            'speed': speed or 0.0, 'ignition': ignition, 'fuel': fuel}
+
+def ingest_point(row, tracking_id, readings):
+    """Segmenter point of an inserted TrackingData row and its (sensor_id, value, text_value) readings"""
+    by_sensor = {sensor_id: (value, text_value) for sensor_id, value, text_value in readings}
+    ignition = _ignition(row['ignition_status'], *by_sensor.get(IGNITION_SENSOR_ID, (None, None)),
+                         *by_sensor.get(ENGINE_SENSOR_ID, (None, None)))
+    fuel = row['fuel_level']
+    if fuel is None:
+        fuel = by_sensor.get(FUEL_SENSOR_ID, (None, None))[0]
+    return make_point(tracking_id, row['timestamp'], row['latitude'], row['longitude'], row['speed'],
+                      ignition, fuel)
+
+def new_state():
+    return {'buffer': [], 'newest': None, 'watermark': None, 'last': None, 'trip': None, 'stop': None}
+
+def dump_state(state):
+    return json.dumps(state, separators=(',', ':'), default=datetime.isoformat)
+
+def _decode_datetimes(obj):
+    for key in DATETIME_KEYS:
+        if obj.get(key) is not None:
+            obj[key] = datetime.fromisoformat(obj[key])
+    return obj
+
+def load_state(text):
+    return json.loads(text, object_hook=_decode_datetimes)
+
+def _order(point):
+    return point['t'], point['id'] or 0
+
+def _new_trip(start):
+    return {
+        'start': start, 'end': start, 'distance_km': 0.0, 'max_speed': start['speed'], 'points': 1,
+        'start_fuel': start['fuel'], 'end_fuel': start['fuel'], 'idle': None,
+    }
+
+def _extend(trip, point):
+    end = trip['end']
+    trip['distance_km'] += haversine_km(end['lat'], end['lon'], point['lat'], point['lon'])
+    trip['max_speed'] = max(trip['max_speed'], point['speed'])
+    trip['points'] += 1
+    if point['fuel'] is not None:
+        if trip['start_fuel'] is None:
+            trip['start_fuel'] = point['fuel']
+        trip['end_fuel'] = point['fuel']
+    trip['end'] = point
+
+def trip_values(trip):
+    start, end = trip['start'], trip['end']
+    hours = (end['t'] - start['t']).total_seconds() / 3600
+    fuel_delta = None
+    if trip['start_fuel'] is not None and trip['end_fuel'] is not None:
+        fuel_delta = round(trip['end_fuel'] - trip['start_fuel'], 3)
+    return {
+        'start_time': start['t'],
+        'end_time': end['t'],
+        'start_latitude': start['lat'],
+        'start_longitude': start['lon'],
+        'end_latitude': end['lat'],
+        'end_longitude': end['lon'],
+        'distance_km': round(trip['distance_km'], 3),
+        'max_speed': trip['max_speed'],
+        'avg_speed': round(trip['distance_km'] / hours, 1) if hours > 0 else None,
+        'start_fuel': trip['start_fuel'],
+        'end_fuel': trip['end_fuel'],
+        'fuel_delta': fuel_delta,
+        'point_count': trip['points'],
+        'start_tracking_id': start['id'],
+        'end_tracking_id': end['id'],
+    }
+
+def stop_values(start, end_time):
+    return {
+        'start_time': start['t'],
+        'end_time': end_time,
+        'latitude': start['lat'],
+        'longitude': start['lon'],
+        'duration_seconds': int(round((end_time - start['t']).total_seconds())),
+    }
+
+class TripSegmenter:
+    """Trip/stop state machine applied to per-device state dicts"""
+
+    def __init__(self, reorder_seconds=60, stop_seconds=180, moving_speed=5, min_distance_m=200):
+        self.reorder = timedelta(seconds=reorder_seconds)
+        self.stop_seconds = stop_seconds
+        self.moving_speed = moving_speed
+        self.min_distance_km = min_distance_m / 1000
+        self.points = 0
+        self.late = 0
+        self.trips = 0
+        self.stops = 0
+
+    def add(self, state, points):
+        """
+        Buffer a device's points and process those past the reorder window
+        Returns (trips, stops, late): values of the trips and stops that ended and the late point count
+        """
+        trips = []
+        stops = []
+        late = 0
+        buffer = state['buffer']
+        for point in points:
+            if state['watermark'] is not None and point['t'] <= state['watermark']:
+                late += 1
+                continue
+            buffer.append(point)
+            if state['newest'] is None or point['t'] > state['newest']:
+                state['newest'] = point['t']
+        if not buffer:
+            return trips, stops, late
+
+        buffer.sort(key=_order)
+        cutoff = state['newest'] - self.reorder
+        released = 0
+        while released < len(buffer) and buffer[released]['t'] <= cutoff:
+            self._step(state, buffer[released], trips, stops)
+            released += 1
+        del buffer[:released]
+        return trips, stops, late
+
+    def _moving(self, point):
+        return point['speed'] >= self.moving_speed and point['ignition'] is not False
+
+    def _step(self, state, point, trips, stops):
+        last = state['last']
+        gap = (point['t'] - last['t']).total_seconds() if last is not None else None
+        trip = state['trip']
+        if trip is not None and gap >= self.stop_seconds:
+            # Silent for a stop's length: the trip ended at its last point
+            self._close(state, trips, stops)
+            trip = None
+
+        if trip is not None:
+            _extend(trip, point)
+            if self._moving(point):
+                trip['idle'] = None
+            else:
+                if trip['idle'] is None:
+                    # The trip ends here if the device stays idle
+                    trip['idle'] = {key: value for key, value in trip.items() if key != 'idle'}
+                idle_seconds = (point['t'] - trip['idle']['end']['t']).total_seconds()
+                if point['ignition'] is False or idle_seconds >= self.stop_seconds:
+                    self._close(state, trips, stops)
+        elif self._moving(point):
+            if last is not None and gap < self.stop_seconds:
+                trip = state['trip'] = _new_trip(last)
+                _extend(trip, point)
+            else:
+                trip = state['trip'] = _new_trip(point)
+        elif state['stop'] is None:
+            state['stop'] = {'start': point}
+
+        state['last'] = point
+        state['watermark'] = point['t']
+
+    def _close(self, state, trips, stops):
+        trip = state['trip']
+        state['trip'] = None
+        if trip['idle'] is not None:
+            trip = trip['idle']
+        if trip['distance_km'] < self.min_distance_km:
+            # Too short to be a trip: the stop before it goes on
+            if state['stop'] is None:
+                state['stop'] = {'start': trip['start']}
+            return
+        stop = state['stop']
+        if stop is not None and stop['start']['t'] < trip['start']['t']:
+            stops.append(stop_values(stop['start'], trip['start']['t']))
+        trips.append(trip_values(trip))
+        state['stop'] = {'start': trip['end']}
+
+    def stats(self):
+        return {'points': self.points, 'late_points': self.late, 'trips': self.trips, 'stops': self.stops}
+
+# Process-wide segmenter, built from the app config on first use
+_trip_segmenter = None
+
+def get_trip_segmenter():
+    """Return the process-wide trip segmenter, or None when TRIP_SEGMENTATION is off"""
+    global _trip_segmenter
+    from app import app
+    if not app.config["TRIP_SEGMENTATION"]:
+        return None
+    if _trip_segmenter is None:
+        _trip_segmenter = TripSegmenter(
+            reorder_seconds=app.config["TRIP_REORDER_SECONDS"],
+            stop_seconds=app.config["TRIP_STOP_SECONDS"],
+            moving_speed=app.config["TRIP_MOVING_SPEED"],
+            min_distance_m=app.config["TRIP_MIN_DISTANCE_M"],
+        )
+    return _trip_segmenter
+
+def load_states(device_ids):
+    """{device_id: state} of the devices that have one, locked for the transaction where supported"""
+    from app import db
+    from models import TripSegmenterState
+
+    return {
+        device_id: load_state(text)
+        for device_id, text in db.session.execute(
+            select(TripSegmenterState.device_id, TripSegmenterState.state)
+            .where(TripSegmenterState.device_id.in_(device_ids))
+            .with_for_update()
+        )
+    }
+
+def save_states(states):
+    """Upsert {device_id: state}"""
+    from app import db
+    from ingest import dialect_insert
+    from models import TripSegmenterState
+
+    now = datetime.utcnow()
+    values = [{'device_id': device_id, 'state': dump_state(state), 'updated_at': now}
+              for device_id, state in states.items()]
+    stmt = dialect_insert(TripSegmenterState.__table__)
+    if hasattr(stmt, 'on_conflict_do_update'):
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['device_id'],
+            set_={'state': stmt.excluded.state, 'updated_at': stmt.excluded.updated_at},
+        ), values)
+        return
+    for row in values:
+        saved = db.session.get(TripSegmenterState, row['device_id'])
+        if saved is None:
+            db.session.add(TripSegmenterState(**row))
+        else:
+            saved.state = row['state']
+            saved.updated_at = row['updated_at']
+
+def _write(device_id, trips, stops):
+    from app import db
+    from models import Trip, Stop
+
+    if trips:
+        db.session.execute(insert(Trip.__table__), [dict(values, device_id=device_id) for values in trips])
+    if stops:
+        db.session.execute(insert(Stop.__table__), [dict(values, device_id=device_id) for values in stops])
+
+def segment_trips(rows, tracking_ids, readings):
+    """
+    Feed a batch of inserted TrackingData rows to their devices' segmenters (caller commits)
+    Returns the number of trips that ended
+    """
+    from ingest import on_commit
+
+    segmenter = get_trip_segmenter()
+    if segmenter is None:
+        return 0
+
+    points_by_device = {}
+    for row, tracking_id, point_readings in zip(rows, tracking_ids, readings):
+        if row['latitude'] is None or row['longitude'] is None:
+            continue
+        points_by_device.setdefault(row['device_id'], []).append(ingest_point(row, tracking_id, point_readings))
+    if not points_by_device:
+        return 0
+
+    states = load_states(list(points_by_device))
+    trip_count = stop_count = late = 0
+    for device_id, points in points_by_device.items():
+        state = states.setdefault(device_id, new_state())
+        trips, stops, device_late = segmenter.add(state, points)
+        _write(device_id, trips, stops)
+        trip_count += len(trips)
+        stop_count += len(stops)
+        late += device_late
+    save_states(states)
+
+    point_count = sum(len(points) for points in points_by_device.values())
+
+    def count():
+        segmenter.points += point_count
+        segmenter.late += late
+        segmenter.trips += trip_count
+        segmenter.stops += stop_count
+    on_commit(count)
+    return trip_count
+
+def device_phase(device_id):
+    """Whether a device is on a trip or in a stop, and since when, from its saved state"""
+    from app import db
+    from models import TripSegmenterState
+
+    saved = db.session.get(TripSegmenterState, device_id)
+    if saved is None:
+        return {'phase': None, 'since': None}
+    state = load_state(saved.state)
+    if state['trip'] is not None:
+        return {'phase': 'trip', 'since': state['trip']['start']['t'].isoformat(),
+                'distance_km': round(state['trip']['distance_km'], 3)}
+    if state['stop'] is not None:
+        return {'phase': 'stop', 'since': state['stop']['start']['t'].isoformat()}
+    return {'phase': None, 'since': None}
+
+def trip_dict(trip):
+    return {
+        'id': trip.id,
+        'start_time': trip.start_time.isoformat(),
+        'end_time': trip.end_time.isoformat(),
+        'start': [trip.start_latitude, trip.start_longitude],
+        'end': [trip.end_latitude, trip.end_longitude],
+        'distance_km': trip.distance_km,
+        'duration_seconds': int((trip.end_time - trip.start_time).total_seconds()),
+        'max_speed': trip.max_speed,
+        'avg_speed': trip.avg_speed,
+        'start_fuel': trip.start_fuel,
+        'end_fuel': trip.end_fuel,
+        'fuel_delta': trip.fuel_delta,
+        'point_count': trip.point_count,
+    }
+
+def stop_dict(stop):
+    return {
+        'id': stop.id,
+        'start_time': stop.start_time.isoformat(),
+        'end_time': stop.end_time.isoformat(),
+        'position': [stop.latitude, stop.longitude],
+        'duration_seconds': stop.duration_seconds,
+    }
+
+def _history_select():
+    """Points of a device with the ignition, engine and fuel readings joined"""
+    from app import db
+    from models import TrackingData, TelemetryValue
+
+    fuel = aliased(TelemetryValue)
+    ignition = aliased(TelemetryValue)
+    engine = aliased(TelemetryValue)
+    return select(
+        TrackingData.id, TrackingData.timestamp, TrackingData.latitude, TrackingData.longitude,
+        TrackingData.speed, TrackingData.ignition_status, ignition.value, ignition.text_value,
+        engine.value, engine.text_value, TrackingData.fuel_level, fuel.value,
+    ).outerjoin(fuel, db.and_(fuel.tracking_id == TrackingData.id, fuel.sensor_id == FUEL_SENSOR_ID))\
+     .outerjoin(ignition, db.and_(ignition.tracking_id == TrackingData.id, ignition.sensor_id == IGNITION_SENSOR_ID))\
+     .outerjoin(engine, db.and_(engine.tracking_id == TrackingData.id, engine.sensor_id == ENGINE_SENSOR_ID))
+
+def _history_point(row):
+    (tracking_id, timestamp, latitude, longitude, speed, ignition_status, ignition_value, ignition_text,
+     engine_value, engine_text, fuel_level, fuel_reading) = row
+    ignition = _ignition(ignition_status, ignition_value, ignition_text, engine_value, engine_text)
+    fuel = fuel_level if fuel_level is not None else fuel_reading
+    return make_point(tracking_id, timestamp, latitude, longitude, speed, ignition, fuel)
+
+def rebuild_device(device_id, segmenter):
+    """Replace a device's trips, stops and state with ones segmented from its whole history"""
+    from app import db
+    from models import TrackingData, Trip, Stop, TripSegmenterState
+
+    db.session.execute(delete(Trip).where(Trip.device_id == device_id))
+    db.session.execute(delete(Stop).where(Stop.device_id == device_id))
+    db.session.execute(delete(TripSegmenterState).where(TripSegmenterState.device_id == device_id))
+
+    query = _history_select().where(TrackingData.device_id == device_id,
+                                    TrackingData.latitude.isnot(None), TrackingData.longitude.isnot(None))
+    state = new_state()
+    after = None
+    trip_count = 0
+    while True:
+        page = query
+        if after is not None:
+            page = page.where(TrackingData.timestamp >= after[0],
+                              or_(TrackingData.timestamp > after[0], TrackingData.id > after[1]))
+        rows = db.session.execute(
+            page.order_by(TrackingData.timestamp, TrackingData.id).limit(REBUILD_FETCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        trips, stops, _ = segmenter.add(state, [_history_point(row) for row in rows])
+        _write(device_id, trips, stops)
+        trip_count += len(trips)
+        after = (rows[-1][1], rows[-1][0])
+
+    if state['last'] is not None:
+        save_states({device_id: state})
+    db.session.commit()
+    return trip_count
+
+def trip_stats():
+    from app import db
+    from models import Trip, Stop
+
+    segmenter = get_trip_segmenter()
+    stats = segmenter.stats() if segmenter is not None else {}
+    stats['stored_trips'] = db.session.execute(select(func.count()).select_from(Trip)).scalar()
+    stats['stored_stops'] = db.session.execute(select(func.count()).select_from(Stop)).scalar()
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rebuild', action='store_true',
+                        help="replace trips and stops with ones segmented from the stored history")
+    parser.add_argument('--device', help="unit_id of the only device to rebuild")
+    args = parser.parse_args()
+
+    from app import app, db
+    from models import Device
+
+    with app.app_context():
+        if args.rebuild:
+            # History is read in order, so nothing needs to wait for reordering
+            segmenter = TripSegmenter(
+                reorder_seconds=0,
+                stop_seconds=app.config["TRIP_STOP_SECONDS"],
+                moving_speed=app.config["TRIP_MOVING_SPEED"],
+                min_distance_m=app.config["TRIP_MIN_DISTANCE_M"],
+            )
+            query = select(Device.id, Device.unit_id).order_by(Device.id)
+            if args.device:
+                query = query.where(Device.unit_id == args.device)
+            for device_id, unit_id in db.session.execute(query).all():
+                print(f"{unit_id}: {rebuild_device(device_id, segmenter)} trips")
+        print(trip_stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Write-behind buffer, body sampling and retention for WebhookLog
+
+Requests whose log row no point refers to (rejected, failed and empty
+requests) are logged through a buffer instead of committing one row per
+request. The buffer is written with one executemany every
+WEBHOOK_LOG_FLUSH_ROWS rows or WEBHOOK_LOG_FLUSH_MS milliseconds, whichever
+comes first, and once more at exit. Successful requests keep writing their log
+row in the same transaction as their points, which reference it.
+
+Request bodies are sampled: every failure keeps its body, one successful
+request in WEBHOOK_LOG_SAMPLE_RATE does, and stored bodies and error messages
+are capped at WEBHOOK_LOG_SAMPLE_CHARS. Log rows older than
+WEBHOOK_LOG_RETENTION_DAYS are swept by the same background thread.
+"""
+
+import atexit
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select, update
+
+# Rows kept while the database is unavailable before the oldest are dropped
+MAX_PENDING_FACTOR = 50
+
+# Seconds between retention sweeps
+SWEEP_INTERVAL = 3600
+
+_success_counter = itertools.count()
+
+def sample_request_data(status_code, request_data_sample):
+    """Body sample to store: every failure, 1 in WEBHOOK_LOG_SAMPLE_RATE successes, capped in size"""
+    from app import app
+
+    if not request_data_sample:
+        return request_data_sample
+    if status_code == 200:
+        rate = app.config["WEBHOOK_LOG_SAMPLE_RATE"]
+        if rate <= 0 or next(_success_counter) % rate:
+            return None
+    return request_data_sample[:app.config["WEBHOOK_LOG_SAMPLE_CHARS"]]
+
+def cap_error_message(error_message):
+    """Error message cut to WEBHOOK_LOG_SAMPLE_CHARS"""
+    from app import app
+
+    if not error_message:
+        return error_message
+    return error_message[:app.config["WEBHOOK_LOG_SAMPLE_CHARS"]]
+
+class WebhookLogBuffer:
+    """Batches WebhookLog rows and writes them from a background thread"""
+
+    def __init__(self, app, flush_rows=200, flush_ms=1000, retention_days=30):
+        self.app = app
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_ms / 1000
+        self.retention_days = retention_days
+        self.max_pending = flush_rows * MAX_PENDING_FACTOR
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='webhook-log-writer', daemon=True)
+        self._last_sweep = 0
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.swept = 0
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self.flush()
+
+    def add(self, log_entry):
+        """Queue a WebhookLog that was not added to the session"""
+        row = {
+            column.name: getattr(log_entry, column.name)
+            for column in log_entry.__table__.columns if column.name != 'id'
+        }
+        with self._lock:
+            self._rows.append(row)
+            if len(self._rows) > self.max_pending:
+                del self._rows[0]
+                self.dropped += 1
+            full = len(self._rows) >= self.flush_rows
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._rows)
+
+    def flush(self):
+        """Write every pending row in one statement, returns the number written"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+
+            with self.app.app_context():
+                try:
+                    ids = self._insert(rows)
+                except Exception as e:
+                    from app import db
+                    db.session.rollback()
+                    logging.error(f"Failed to write {len(rows)} webhook logs: {e}")
+                    with self._lock:
+                        # Retried with the next flush, oldest rows first
+                        self._rows[:0] = rows
+                        overflow = len(self._rows) - self.max_pending
+                        if overflow > 0:
+                            del self._rows[:overflow]
+                            self.dropped += overflow
+                    return 0
+
+            self.written += len(rows)
+            self.flushes += 1
+            if ids:
+                self._publish(rows, ids)
+            return len(rows)
+
+    def _insert(self, rows):
+        """Insert rows, returns their ids when live clients need them"""
+        from app import db
+        from models import WebhookLog
+        from live_feed import get_live_feed
+
+        table = WebhookLog.__table__
+        ids = None
+        if get_live_feed().active and db.engine.dialect.insert_executemany_returning_sort_by_parameter_order:
+            stmt = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+            ids = db.session.execute(stmt, rows).scalars().all()
+        else:
+            db.session.execute(insert(table), rows)
+        db.session.commit()
+        return ids
+
+    def _publish(self, rows, ids):
+        from models import WebhookLog
+        from live_feed import get_live_feed, message_event
+
+        live_feed = get_live_feed()
+        for row, log_id in zip(rows, ids):
+            live_feed.publish('message', message_event(WebhookLog(id=log_id, **row)))
+
+    def sweep(self):
+        """Delete log rows older than the retention period in batches, returns rows deleted"""
+        from app import db
+        from models import WebhookLog, TrackingData
+
+        if self.retention_days <= 0:
+            return 0
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        deleted = 0
+        with self.app.app_context():
+            while True:
+                ids = db.session.execute(
+                    select(WebhookLog.id).where(WebhookLog.timestamp < cutoff).limit(self.flush_rows * 5)
+                ).scalars().all()
+                if not ids:
+                    break
+                # Points keep their data and lose the link, as ON DELETE SET NULL would do
+                db.session.execute(
+                    update(TrackingData).where(TrackingData.webhook_log_id.in_(ids)).values(webhook_log_id=None)
+                )
+                db.session.execute(WebhookLog.__table__.delete().where(WebhookLog.id.in_(ids)))
+                db.session.commit()
+                deleted += len(ids)
+        self.swept += deleted
+        return deleted
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+            if time.time() - self._last_sweep >= SWEEP_INTERVAL:
+                self._last_sweep = time.time()
+                try:
+                    deleted = self.sweep()
+                    if deleted:
+                        logging.info(f"Swept {deleted} webhook logs older than {self.retention_days} days")
+                except Exception as e:
+                    logging.error(f"Webhook log sweep failed: {e}")
+
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'written': self.written,
+            'flushes': self.flushes,
+            'dropped': self.dropped,
+            'swept': self.swept,
+            'flush_rows': self.flush_rows,
+            'flush_ms': int(self.flush_seconds * 1000),
+            'retention_days': self.retention_days,
+        }
+
+# Process-wide buffer, set up by init_webhook_log_buffer
+_webhook_log_buffer = None
+
+def get_webhook_log_buffer():
+    """Return the active buffer, or None when WEBHOOK_LOG_BUFFER is off"""
+    return _webhook_log_buffer
+
+def init_webhook_log_buffer(app):
+    """Start the buffered log writer and its sweeper unless WEBHOOK_LOG_BUFFER is off"""
+    global _webhook_log_buffer
+    if not app.config["WEBHOOK_LOG_BUFFER"]:
+        return
+    _webhook_log_buffer = WebhookLogBuffer(
+        app,
+        flush_rows=app.config["WEBHOOK_LOG_FLUSH_ROWS"],
+        flush_ms=app.config["WEBHOOK_LOG_FLUSH_MS"],
+        retention_days=app.config["WEBHOOK_LOG_RETENTION_DAYS"],
+    )
+    _webhook_log_buffer.start()
@@ -1,65 +1,232 @@
+import io
 import json
 import xml.etree.ElementTree as ET
-import xmltodict
 from datetime import datetime
-from dateutil import parser as date_parser
 import logging
-from telemetry_mapping import (
-    get_sensor_info, 
-    apply_sensor_calibration, 
-    parse_sensor_code,
-    get_sensor_category,
-    SENSOR_CATEGORIES
-)
+from contextvars import ContextVar
+from urllib.parse import parse_qsl, urlencode
+from json_fastpath import parse_json_fast
+from field_aliases import resolve_fields, is_present
+from timestamps import decode_timestamp
+import telemetry_mapping
+from telemetry_mapping import get_sensor_descriptor, calibrate, calibrate_batch
 
-def parse_wialon_data(request):
+# WS-Security namespace used by Wialon's SOAP retranslator
+WSSE_NAMESPACE = 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd'
+WSSE_USERNAME_TAG = f'{{{WSSE_NAMESPACE}}}Username'
+
+# Telemetry values awaiting calibration while a request is being parsed,
+# as (telemetry item, descriptor, raw value); None outside parse_wialon_data
+_pending_calibration = ContextVar('pending_calibration', default=None)
+
+# Child elements/keys that mark an element as a tracking record
+TRACKING_KEYS = frozenset([
+    'coordX', 'coordY', 'gpsCode', 'latitude', 'longitude',
+    'unitId', 'unit_id', 'telemetryDetails', 'lat', 'lon'
+])
+
+class WebhookPayload:
+    """
+    Request body decoded once and shared by every stage of the webhook
+    
+    The format is detected once, the text is decoded at most once, and a single
+    SoapStream pass serves both WS-Security authentication and record extraction.
+    Per-entry raw_data values are memoryview slices of the original bytes (or
+    str slices of the decoded text for non-ASCII bodies) instead of re-serialised copies.
+    """
+    
+    def __init__(self, body, content_type=None, form=None):
+        self.body = bytes(body or b'')
+        self.view = memoryview(self.body)
+        self.content_type = content_type or ''
+        self.is_ascii = self.body.isascii()
+        self._text = None
+        self._form = form
+        self._soap_stream = None
+        self.format = self._detect_format()
+    
+    @classmethod
+    def from_request(cls, request):
+        """Build a payload from a Flask/Werkzeug request"""
+        body = request.get_data(cache=True)
+        form = None
+        # Multipart bodies can't be parsed as a query string, keep Werkzeug's parse; so does
+        # a urlencoded body whose stream an earlier request.form access already consumed
+        if request.mimetype == 'multipart/form-data' or (
+                not body and request.mimetype == 'application/x-www-form-urlencoded'):
+            form = request.form.to_dict()
+        return cls(body, request.content_type, form)
+    
+    def _detect_format(self):
+        content_type = self.content_type
+        if 'application/json' in content_type:
+            return 'json'
+        if 'xml' in content_type:
+            return 'xml'
+        if 'application/x-www-form-urlencoded' in content_type or 'multipart/form-data' in content_type:
+            return 'form'
+        
+        # Auto-detect from the first significant byte
+        head = self.body.lstrip()[:1]
+        if head in (b'{', b'['):
+            return 'json'
+        if head == b'<':
+            return 'xml'
+        return 'form'
+    
+    @property
+    def is_soap(self):
+        return 'soap+xml' in self.content_type
+    
+    @property
+    def text(self):
+        """Body decoded as UTF-8, computed once"""
+        if self._text is None:
+            self._text = self.body.decode('utf-8', errors='replace')
+        return self._text
+    
+    @property
+    def form(self):
+        """Form fields (first value wins), parsed once"""
+        if self._form is None:
+            self._form = {}
+            for key, value in parse_qsl(self.text, keep_blank_values=True):
+                self._form.setdefault(key, value)
+        return self._form
+    
+    @property
+    def soap_stream(self):
+        """The single SoapStream over this body"""
+        if self._soap_stream is None:
+            self._soap_stream = SoapStream(self.body)
+        return self._soap_stream
+    
+    def serialized(self):
+        """(body, content_type) that rebuild this payload without the request, as the ingest queue does"""
+        if 'multipart/form-data' in self.content_type:
+            # The queue worker has no multipart parser; the fields are stored urlencoded instead
+            return urlencode(self.form).encode(), 'application/x-www-form-urlencoded'
+        return self.body, self.content_type
+    
+    def slice(self, start=None, end=None):
+        """Zero-copy slice of the raw body, valid while the payload is alive"""
+        if self.is_ascii:
+            return self.view[start:end]
+        return self.text[start:end]
+    
+    def sample(self, limit=5000):
+        """Leading part of the body for request logging"""
+        if not self.body and self._form:
+            # Multipart bodies are consumed by Werkzeug's form parser
+            return str(self._form)[:limit]
+        if self._text is None and self.is_ascii:
+            return self.body[:limit].decode('ascii')
+        return self.text[:limit]
+    
+    def iter_json(self):
+        """
+        Yield (entry, start, end) for each top-level JSON object
+        Offsets index into the decoded text, which equals the byte offsets for ASCII bodies
+        """
+        text = self.text
+        decoder = json.JSONDecoder()
+        index = _skip_whitespace(text, 0)
+        
+        if text.startswith('[', index):
+            index = _skip_whitespace(text, index + 1)
+            while index < len(text) and text[index] != ']':
+                entry, end = decoder.raw_decode(text, index)
+                yield entry, index, end
+                index = _skip_whitespace(text, end)
+                if text.startswith(',', index):
+                    index = _skip_whitespace(text, index + 1)
+        elif index < len(text):
+            entry, end = decoder.raw_decode(text, index)
+            yield entry, index, end
+
+def _skip_whitespace(text, index):
+    while index < len(text) and text[index] in ' \t\r\n':
+        index += 1
+    return index
+
+def raw_data_text(raw_data):
+    """Materialise a raw_data slice for storage"""
+    if isinstance(raw_data, memoryview):
+        return raw_data.tobytes().decode('utf-8', errors='replace')
+    return raw_data
+
+def parse_wialon_data(payload):
     """
     Parse incoming Wialon retranslator data from various formats
+    Accepts a WebhookPayload (or a request, which is wrapped in one)
     Returns a list of parsed data entries
     """
-    content_type = request.content_type or ''
-    parsed_data = []
+    if not isinstance(payload, WebhookPayload):
+        payload = WebhookPayload.from_request(payload)
     
+    # Telemetry is calibrated once for the whole request after parsing
+    pending = []
+    token = _pending_calibration.set(pending)
     try:
-        if 'application/json' in content_type:
-            parsed_data = parse_json_data(request)
-        elif 'application/xml' in content_type or 'text/xml' in content_type:
-            parsed_data = parse_xml_data(request)
-        elif 'application/x-www-form-urlencoded' in content_type:
-            parsed_data = parse_form_data(request)
+        if payload.format == 'json':
+            parsed_entries = parse_json_data(payload)
+        elif payload.format == 'xml':
+            parsed_entries = parse_xml_data(payload)
         else:
-            # Try to auto-detect format
-            data = request.get_data(as_text=True)
-            if data.strip().startswith('{') or data.strip().startswith('['):
-                parsed_data = parse_json_data(request)
-            elif data.strip().startswith('<'):
-                parsed_data = parse_xml_data(request)
-            else:
-                parsed_data = parse_form_data(request)
-                
+            parsed_entries = parse_form_data(payload)
+        calibrate_pending(pending)
+        return parsed_entries
+        
     except Exception as e:
         logging.error(f"Error parsing webhook data: {e}")
         return []
-    
-    return parsed_data
+    finally:
+        _pending_calibration.reset(token)
 
-def parse_json_data(request):
+def has_tracking_record(payload):
+    """
+    Whether the body's first record names a unit, without parsing the rest
+    The queued path acknowledges on this and leaves the full parse to the queue worker
+    """
+    try:
+        if payload.format == 'json':
+            first = next((entry for entry, _, _ in payload.iter_json() if isinstance(entry, dict) and entry), None)
+        elif payload.format == 'xml':
+            first = next(payload.soap_stream.records(), None) if payload.body else None
+        else:
+            first = payload.form
+        return bool(first) and is_present(resolve_fields(first).get('unit_id'))
+    except Exception as e:
+        logging.debug(f"Body has no readable first record: {e}")
+        return False
+
+def calibrate_pending(pending):
+    """Fill in calibrated values, as one NumPy batch for requests above the threshold"""
+    threshold = telemetry_mapping.BATCH_CALIBRATION_THRESHOLD
+    if threshold and len(pending) >= threshold:
+        calibrated = calibrate_batch([descriptor for _, descriptor, _ in pending],
+                                     [raw_value for _, _, raw_value in pending])
+        for (item, _, _), value in zip(pending, calibrated):
+            item['value'] = value
+    else:
+        for item, descriptor, raw_value in pending:
+            item['value'] = calibrate(descriptor, raw_value)
+
+def parse_json_data(payload):
     """Parse JSON format data from Wialon retranslator"""
     try:
-        data = request.get_json()
-        if not data:
-            return []
+        # Typed msgspec path when available, generic dict path otherwise
+        parsed_entries = parse_json_fast(payload)
+        if parsed_entries is not None:
+            return parsed_entries
         
         parsed_entries = []
         
-        # Handle single entry or array of entries
-        if isinstance(data, list):
-            entries = data
-        else:
-            entries = [data]
-        
-        for entry in entries:
-            parsed_entry = extract_tracking_data(entry, 'json', json.dumps(entry))
+        # Handle single entry or array of entries; raw_data is the entry's own slice of the body
+        for entry, start, end in payload.iter_json():
+            if not isinstance(entry, dict) or not entry:
+                continue
+            parsed_entry = extract_tracking_data(entry, 'json', payload.slice(start, end))
             if parsed_entry:
                 parsed_entries.append(parsed_entry)
         
@@ -69,46 +236,18 @@ def parse_json_data(request):
         logging.error(f"Error parsing JSON data: {e}")
         return []
 
-def parse_xml_data(request):
+def parse_xml_data(payload):
     """Parse XML/SOAP format data from Wialon retranslator"""
     try:
-        xml_data = request.get_data(as_text=True)
-        if not xml_data:
+        if not payload.body:
             return []
         
-        # Convert XML to dict for easier processing
-        parsed_xml = xmltodict.parse(xml_data)
-        
         parsed_entries = []
+        raw_sample = payload.slice(0, 1000)
         
-        # Handle SOAP envelope with different namespace prefixes
-        envelope_key = None
-        body_key = None
-        
-        # Find envelope and body keys regardless of namespace prefix
-        for key in parsed_xml.keys():
-            if 'Envelope' in key:
-                envelope_key = key
-                break
-        
-        if envelope_key:
-            envelope = parsed_xml[envelope_key]
-            for key in envelope.keys():
-                if 'Body' in key:
-                    body_key = key
-                    break
-            
-            if body_key:
-                body = envelope[body_key]
-                entries = extract_entries_from_soap(body)
-            else:
-                entries = [envelope]
-        else:
-            # Direct XML format
-            entries = [parsed_xml]
-        
-        for entry in entries:
-            parsed_entry = extract_tracking_data(entry, 'xml', xml_data[:1000])
+        # Records are converted one submitData block at a time
+        for entry in payload.soap_stream.records():
+            parsed_entry = extract_tracking_data(entry, 'xml', raw_sample)
             if parsed_entry:
                 parsed_entries.append(parsed_entry)
         
@@ -118,14 +257,15 @@ def parse_xml_data(request):
         logging.error(f"Error parsing XML data: {e}")
         return []
 
-def parse_form_data(request):
+def parse_form_data(payload):
     """Parse form-encoded data from Wialon retranslator"""
     try:
-        form_data = request.form.to_dict()
+        form_data = payload.form
         if not form_data:
             return []
         
-        parsed_entry = extract_tracking_data(form_data, 'form', str(form_data))
+        raw_data = payload.slice() if payload.body else str(form_data)
+        parsed_entry = extract_tracking_data(form_data, 'form', raw_data)
         if parsed_entry:
             return [parsed_entry]
         
@@ -135,166 +275,215 @@ def parse_form_data(request):
         logging.error(f"Error parsing form data: {e}")
         return []
 
-def extract_entries_from_soap(soap_body):
-    """Extract data entries from SOAP body"""
-    entries = []
-    
-    def extract_telemetry_recursive(data):
-        """Recursively search for telemetry data"""
-        if isinstance(data, dict):
-            # Check if this dict contains tracking data (GPS coordinates, unit ID, or telemetry details)
-            has_tracking_data = any(key in data for key in [
-                'coordX', 'coordY', 'gpsCode', 'latitude', 'longitude', 
-                'unitId', 'unit_id', 'telemetryDetails', 'lat', 'lon'
-            ])
-            
-            if has_tracking_data:
-                entries.append(data)
-            
-            # Also search nested structures for additional data
-            for key, value in data.items():
-                if isinstance(value, (dict, list)):
-                    extract_telemetry_recursive(value)
-                    
-        elif isinstance(data, list):
-            for item in data:
-                if isinstance(item, (dict, list)):
-                    extract_telemetry_recursive(item)
-    
-    # Start recursive search from SOAP body
-    extract_telemetry_recursive(soap_body)
-    
-    return entries
-
-def extract_tracking_data(data, data_format, raw_data):
+class SoapStream:
     """
-    Extract standardized tracking data from parsed entry
-    Handles various field naming conventions from Wialon retranslator
+    Single-pass incremental reader for SOAP/XML retranslator payloads
+    
+    read_header() advances to the SOAP body and returns the WS-Security username,
+    records() then yields one dict per submitData block as soon as it is complete.
+    Converted elements are detached from the tree, so memory stays bounded by
+    the size of a single record rather than the whole document.
     """
-    try:
-        # Initialize result
-        result = {
-            'data_format': data_format,
-            'raw_data': raw_data
-        }
-        
-        # Extract unit/device ID (various possible field names)
-        unit_id = (data.get('unit_id') or 
-                  data.get('unitId') or 
-                  data.get('id') or 
-                  data.get('device_id') or 
-                  data.get('deviceId') or 
-                  data.get('imei') or
-                  data.get('uid') or
-                  data.get('gpsCode') or    # Wialon specific
-                  data.get('gps_code') or
-                  data.get('code'))
-        
-        if not unit_id:
-            logging.warning("No unit ID found in data entry")
-            return None
-        
-        result['unit_id'] = str(unit_id)
-        
-        # Extract location data (Wialon uses coordX/coordY)
-        result['latitude'] = safe_float(data.get('lat') or data.get('latitude') or data.get('y') or data.get('coordY'))
-        result['longitude'] = safe_float(data.get('lon') or data.get('lng') or data.get('longitude') or data.get('x') or data.get('coordX'))
-        result['altitude'] = safe_float(data.get('alt') or data.get('altitude') or data.get('z'))
-        result['speed'] = safe_float(data.get('speed') or data.get('spd'))
-        result['heading'] = safe_float(data.get('heading') or data.get('course') or data.get('dir'))
+    
+    def __init__(self, source):
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
         
-        # Extract timestamp (Wialon uses 'date' field)
-        timestamp_fields = ['timestamp', 'time', 't', 'datetime', 'dt', 'server_time', 'date']
-        timestamp = None
+        self.username = None
+        self._events = ET.iterparse(source, events=('start', 'end'))
+        self._stack = []
+        self._header_read = False
+        self._in_body = False
+    
+    def read_header(self):
+        """Advance to the start of the body, returning the WS-Security username if present"""
+        if self._header_read:
+            return self.username
+        self._header_read = True
         
-        for field in timestamp_fields:
-            if field in data and data[field]:
-                try:
-                    if isinstance(data[field], (int, float)):
-                        # Unix timestamp
-                        timestamp = datetime.fromtimestamp(data[field])
-                    else:
-                        # Parse string timestamp
-                        timestamp = date_parser.parse(str(data[field]))
+        for event, elem in self._events:
+            if event == 'start':
+                self._stack.append(elem)
+                name = local_name(elem.tag)
+                if len(self._stack) == 1 and name != 'Envelope':
+                    # Plain XML document without a SOAP envelope
+                    self._in_body = True
                     break
-                except:
-                    continue
+                if len(self._stack) == 2 and name == 'Body':
+                    self._in_body = True
+                    break
+            else:
+                self._stack.pop()
+                if elem.tag == WSSE_USERNAME_TAG and self.username is None:
+                    self.username = elem.text
         
-        result['timestamp'] = timestamp or datetime.utcnow()
+        return self.username
+    
+    def records(self):
+        """Yield each tracking record in the body as an xmltodict-style dict"""
+        self.read_header()
+        if not self._in_body:
+            return
         
-        # Extract Xirgo/vehicle specific data
-        result['odometer'] = safe_float(data.get('odometer') or data.get('mileage'))
-        result['fuel_level'] = safe_float(data.get('fuel') or data.get('fuel_level'))
-        result['engine_hours'] = safe_float(data.get('engine_hours') or data.get('hours'))
-        result['battery_voltage'] = safe_float(data.get('battery') or data.get('battery_voltage'))
-        result['external_voltage'] = safe_float(data.get('external_voltage') or data.get('ext_voltage'))
+        for event, elem in self._events:
+            if event == 'start':
+                self._stack.append(elem)
+                continue
+            
+            self._stack.pop()
+            if any(local_name(child.tag) in TRACKING_KEYS for child in elem):
+                record = element_to_dict(elem)
+                # Detach the converted element so the tree never holds more than one record
+                if self._stack:
+                    self._stack[-1].remove(elem)
+                else:
+                    elem.clear()
+                yield record
+
+def local_name(tag):
+    """Strip the namespace from an ElementTree tag"""
+    return tag.rsplit('}', 1)[-1]
+
+def element_to_dict(elem):
+    """Convert an element to the nested dict shape xmltodict produces (without namespace prefixes)"""
+    result = {f'@{local_name(key)}': value for key, value in elem.attrib.items()}
+    
+    for child in elem:
+        key = local_name(child.tag)
+        if len(child) or child.attrib:
+            value = element_to_dict(child)
+        else:
+            text = child.text.strip() if child.text else ''
+            value = text or None
         
-        # Extract status flags
-        result['ignition_status'] = safe_bool(data.get('ignition') or data.get('ign'))
-        result['gps_valid'] = safe_bool(data.get('gps_valid') or data.get('valid'), default=True)
-        result['panic_button'] = safe_bool(data.get('panic') or data.get('sos'), default=False)
+        if key in result:
+            if isinstance(result[key], list):
+                result[key].append(value)
+            else:
+                result[key] = [result[key], value]
+        else:
+            result[key] = value
+    
+    text = elem.text.strip() if elem.text else ''
+    if text and result:
+        result['#text'] = text
+    
+    return result
+
+def extract_tracking_data(data, data_format, raw_data):
+    """
+    Extract standardized tracking data from parsed entry
+    Handles various field naming conventions from Wialon retranslator
+    """
+    try:
+        # Compiled per key set; zero and False are kept as real values
+        values = resolve_fields(data)
         
-        # Extract telemetry details if present (from SOAP XML)
         telemetry_details = data.get('telemetryDetails', [])
-        if telemetry_details:
-            mapped_telemetry = {}
-            
+        if telemetry_details and not isinstance(telemetry_details, list):
             # Handle both single detail and list of details
-            if not isinstance(telemetry_details, list):
-                telemetry_details = [telemetry_details]
-            
-            for detail in telemetry_details:
-                sensor_code = detail.get('sensorCode')
-                raw_value = detail.get('value')
-                
-                if sensor_code and raw_value is not None:
-                    try:
-                        # Import telemetry mapping functions
-                        from telemetry_mapping import parse_sensor_code, get_sensor_info, apply_sensor_calibration, get_sensor_category
-                        
-                        # Parse and map sensor code to Xirgo specification
-                        sensor_id = parse_sensor_code(sensor_code)
-                        if sensor_id:
-                            sensor_info = get_sensor_info(sensor_id)
-                            
-                            # Apply calibration (multiplier and offset)
-                            calibrated_value = apply_sensor_calibration(sensor_id, raw_value)
-                            
-                            # Store mapped telemetry with sensor info
-                            mapped_telemetry[sensor_info['name']] = {
-                                'value': calibrated_value,
-                                'raw_value': raw_value,
-                                'unit': sensor_info['unit'],
-                                'type': sensor_info['type'],
-                                'category': get_sensor_category(sensor_info['name']),
-                                'sensor_id': sensor_id
-                            }
-                    except Exception as e:
-                        # Log error but continue processing
-                        print(f"Error processing sensor {sensor_code}: {e}")
-                        continue
-            
-            if mapped_telemetry:
-                result['telemetry'] = mapped_telemetry
+            telemetry_details = [telemetry_details]
+        details = [(detail.get('sensorCode'), detail.get('value')) for detail in telemetry_details or []]
         
-        # Extract sensor data if present (for other formats)
-        if 'sensors' in data:
-            sensors = data['sensors']
-            if isinstance(sensors, dict):
-                for sensor_id, sensor_value in sensors.items():
-                    # Map common sensor IDs to fields
-                    if 'fuel' in str(sensor_id).lower():
-                        result['fuel_level'] = safe_float(sensor_value)
-                    elif 'temp' in str(sensor_id).lower():
-                        # Could add temperature fields if needed
-                        pass
-        
-        return result
+        return build_tracking_entry(values, data_format, raw_data, details, data.get('sensors'))
         
     except Exception as e:
         logging.error(f"Error extracting tracking data: {e}")
         return None
 
+def build_tracking_entry(values, data_format, raw_data, telemetry_details=None, sensors=None):
+    """
+    Build a standardized entry from resolved field values
+    Shared by the generic dict path and the typed JSON fast path
+    """
+    # Initialize result
+    result = {
+        'data_format': data_format,
+        'raw_data': raw_data
+    }
+    
+    unit_id = values.get('unit_id')
+    if not is_present(unit_id):
+        logging.warning("No unit ID found in data entry")
+        return None
+    
+    result['unit_id'] = str(unit_id)
+    
+    # Extract location data (Wialon uses coordX/coordY)
+    result['latitude'] = safe_float(values.get('latitude'))
+    result['longitude'] = safe_float(values.get('longitude'))
+    result['altitude'] = safe_float(values.get('altitude'))
+    result['speed'] = safe_float(values.get('speed'))
+    result['heading'] = safe_float(values.get('heading'))
+    
+    # Extract timestamp (Wialon uses 'date' field), normalised to naive UTC
+    timestamp = decode_timestamp(values.get('timestamp'), result['unit_id'])
+    result['timestamp'] = timestamp or datetime.utcnow()
+    
+    # Extract Xirgo/vehicle specific data
+    result['odometer'] = safe_float(values.get('odometer'))
+    result['fuel_level'] = safe_float(values.get('fuel_level'))
+    result['engine_hours'] = safe_float(values.get('engine_hours'))
+    result['battery_voltage'] = safe_float(values.get('battery_voltage'))
+    result['external_voltage'] = safe_float(values.get('external_voltage'))
+    
+    # Extract status flags
+    result['ignition_status'] = safe_bool(values.get('ignition_status'))
+    result['gps_valid'] = safe_bool(values.get('gps_valid'), default=True)
+    result['panic_button'] = safe_bool(values.get('panic_button'), default=False)
+    
+    # Extract telemetry details if present (from SOAP XML)
+    if telemetry_details:
+        mapped_telemetry = map_telemetry_details(telemetry_details)
+        if mapped_telemetry:
+            result['telemetry'] = mapped_telemetry
+    
+    # Extract sensor data if present (for other formats)
+    if isinstance(sensors, dict):
+        for sensor_id, sensor_value in sensors.items():
+            # Map common sensor IDs to fields
+            if 'fuel' in str(sensor_id).lower():
+                result['fuel_level'] = safe_float(sensor_value)
+            elif 'temp' in str(sensor_id).lower():
+                # Could add temperature fields if needed
+                pass
+    
+    return result
+
+def map_telemetry_details(telemetry_details):
+    """Map (sensorCode, value) pairs to calibrated Xirgo telemetry keyed by sensor name"""
+    mapped_telemetry = {}
+    # Inside parse_wialon_data calibration is deferred to calibrate_pending
+    pending = _pending_calibration.get()
+    
+    for sensor_code, raw_value in telemetry_details:
+        if sensor_code and raw_value is not None:
+            try:
+                # One table lookup gives the Xirgo name, unit, category and calibration
+                descriptor = get_sensor_descriptor(sensor_code)
+                if descriptor:
+                    item = {
+                        'value': raw_value,
+                        'raw_value': raw_value,
+                        'unit': descriptor.unit,
+                        'type': descriptor.type,
+                        'category': descriptor.category,
+                        'sensor_id': descriptor.sensor_id
+                    }
+                    if pending is None:
+                        item['value'] = calibrate(descriptor, raw_value)
+                    else:
+                        pending.append((item, descriptor, raw_value))
+                    mapped_telemetry[descriptor.name] = item
+            except Exception as e:
+                # Log error but continue processing
+                logging.warning(f"Error processing sensor {sensor_code}: {e}")
+                continue
+    
+    return mapped_telemetry
+
 def safe_float(value):
     """Safely convert value to float, return None if not possible"""
     if value is None: